@@ -38,8 +38,7 @@ from produce_dsm import produce_dsm_from_points
 from visualization.plot_height_map import plot_height_map
 import logging
 import multiprocessing
-from coordinate_system import local_to_global
-from lib.latlon_utm_converter import latlon_to_eastnorh
+from coordinate_system import local_to_utm
 
 
 def convert_depth_map_worker(work_dir, out_dir, item, depth_type):
@@ -93,9 +92,8 @@ def convert_depth_map_worker(work_dir, out_dir, item, depth_type):
     points = tmp[:, valid_mask].T
 
     # convert to UTM
-    lat, lon, alt = local_to_global(work_dir, points[:, 0:1], points[:, 1:2], points[:, 2:3])
-    east, north = latlon_to_eastnorh(lat, lon)
-    points = np.hstack((east, north, alt))
+    east, north, alt = local_to_utm(work_dir, points[:, 0], points[:, 1], points[:, 2])
+    points = np.stack((east, north, alt), axis=1)
 
     tif_to_write = os.path.join(out_dir, 'dsm_tif', img_name[:-4] + '.tif')
     jpg_to_write = os.path.join(out_dir, 'dsm_jpg', img_name[:-4] + '.jpg')
@@ -34,9 +34,8 @@ from lib.run_cmd import run_cmd
 import os
 from lib.ply_np_converter import ply2np, np2ply
 import json
-from coordinate_system import local_to_global
+from coordinate_system import local_to_utm
 import numpy as np
-from lib.latlon_utm_converter import latlon_to_eastnorh
 from produce_dsm import produce_dsm_from_points
 
 
@@ -64,12 +63,10 @@ def run_fuse(work_dir):
 
     points, color, comments = ply2np(os.path.join(work_dir, 'colmap/mvs/fused.ply'))
 
-    lat, lon, alt = local_to_global(work_dir, points[:, 0:1], points[:, 1:2], points[:, 2:3])
-
     # convert to utm coordinate frame
     # note the normals are in ENU system, not sure how to convert to UTM
-    east, north = latlon_to_eastnorh(lat, lon)
-    points = np.hstack((east, north, alt))
+    east, north, alt = local_to_utm(work_dir, points[:, 0], points[:, 1], points[:, 2])
+    points = np.stack((east, north, alt), axis=1)
     with open(os.path.join(work_dir, 'aoi.json')) as fp:
         aoi_dict = json.load(fp)
     comment_1 = 'projection: UTM {}{}'.format(aoi_dict['zone_number'], aoi_dict['hemisphere'])
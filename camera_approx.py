@@ -32,19 +32,25 @@
 
 import os
 import json
-from lib.rpc_model import RPCModel
+from lib.rpc_model import RPCModel, RPCModelBatch
 from lib.gen_grid import gen_grid
-from lib.solve_affine import solve_affine
-from lib.solve_perspective import solve_perspective
+from lib.solve_affine import solve_affine_batch
+from lib.solve_perspective import solve_perspective_batch, factorize
 import numpy as np
 from pyquaternion import Quaternion
 from lib.check_error import check_perspective_error
 import logging
+import time
+import hashlib
+import shutil
+import glob
 from lib.latlon_utm_converter import eastnorth_to_latlon
 from coordinate_system import global_to_local
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 
 
-def discretize_volume(work_dir):
+def discretize_volume(work_dir, xy_axis_grid_points=100, z_axis_grid_points=20):
     bbx_file = os.path.join(work_dir, 'aoi.json')
     with open(bbx_file) as fp:
         bbx = json.load(fp)
@@ -58,10 +64,7 @@ def discretize_volume(work_dir):
     alt_min = bbx['alt_min']
     alt_max = bbx['alt_max']
 
-    # each grid-cell is about 5 meters * 5 meters * 5 meters
-    xy_axis_grid_points = 100
-    z_axis_grid_points = 20
-
+    # with the default 100 * 100 * 20 points, each grid-cell is about 5 meters * 5 meters * 5 meters
     # create north_east_height grid
     # note that this is a left-handed coordinate system
     north_points = np.linspace(ul_northing, lr_northing, xy_axis_grid_points)
@@ -87,11 +90,49 @@ def discretize_volume(work_dir):
     return latlonalt, utm_local, enu
 
 
+def discretize_volume_cached(work_dir, xy_axis_grid_points=100, z_axis_grid_points=20):
+    """
+    Same as discretize_volume, but the grids are stored as .npy files under
+    approx_camera/grid_cache_<hash of aoi.json>/, so that the geodetic
+    conversions are done once per AOI.
+    """
+    with open(os.path.join(work_dir, 'aoi.json'), 'rb') as fp:
+        aoi_hash = hashlib.sha1(fp.read()).hexdigest()[:16]
+
+    approx_dir = os.path.join(work_dir, 'approx_camera')
+    cache_dir = os.path.join(approx_dir, 'grid_cache_{}'.format(aoi_hash))
+    names = ['latlonalt', 'utm_local', 'enu']
+    files = [os.path.join(cache_dir, '{}_{}_{}.npy'.format(name, xy_axis_grid_points, z_axis_grid_points))
+             for name in names]
+    if all([os.path.exists(x) for x in files]):
+        logging.info('loading grid {} * {} * {} from {}'.format(xy_axis_grid_points, xy_axis_grid_points,
+                                                               z_axis_grid_points, cache_dir))
+        return tuple([np.load(x) for x in files])
+
+    grids = discretize_volume(work_dir, xy_axis_grid_points, z_axis_grid_points)
+
+    # caches of other AOIs are stale
+    for item in glob.glob(os.path.join(approx_dir, 'grid_cache_*')):
+        if item != cache_dir:
+            shutil.rmtree(item)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    for grid, file in zip(grids, files):
+        # write to a temporary file first, so that an interrupted run leaves no truncated grid
+        with open(file + '.tmp', 'wb') as fp:
+            np.save(fp, grid)
+        os.replace(file + '.tmp', file)
+    return grids
+
+
 class CameraApprox(object):
-    def __init__(self, work_dir):
+    def __init__(self, work_dir, max_threads=-1):
         self.work_dir = work_dir
+        # the per-image factorization and error checks run on a thread pool; numpy releases the GIL
+        self.max_threads = max_threads if max_threads > 0 else multiprocessing.cpu_count()
 
-        self.latlonalt, self.utm_local, self.enu = discretize_volume(work_dir)
+        # grids are discretized on demand, keyed by (xy_axis_grid_points, z_axis_grid_points)
+        self.grids = {}
 
         self.img_names = []
         self.rpc_models = []
@@ -104,36 +145,48 @@ class CameraApprox(object):
                 self.rpc_models.append(RPCModel(json.load(fp)))
 
         self.cnt = len(self.rpc_models)
+        self.rpc_batch = RPCModelBatch(self.rpc_models)
 
         self.out_dir = os.path.join(work_dir, 'approx_camera')
         if not os.path.exists(self.out_dir):
             os.mkdir(self.out_dir)
 
-    def approx_affine_latlonalt(self):
+    def grid(self, xy_axis_grid_points=100, z_axis_grid_points=20):
+        key = (xy_axis_grid_points, z_axis_grid_points)
+        if key not in self.grids:
+            self.grids[key] = discretize_volume_cached(self.work_dir, xy_axis_grid_points, z_axis_grid_points)
+        return self.grids[key]
+
+    def inside_mask(self, all_col, all_row, rpc_batch=None):
+        if rpc_batch is None:
+            rpc_batch = self.rpc_batch
+        # make sure all the points lie inside the image
+        keep_mask = np.logical_and(all_col >= 0, all_row >= 0)
+        keep_mask = np.logical_and(keep_mask, all_col < rpc_batch.width)
+        keep_mask = np.logical_and(keep_mask, all_row < rpc_batch.height)
+        return keep_mask
+
+    def approx_affine_latlonalt(self, xy_axis_grid_points=100, z_axis_grid_points=20):
         logging.info('deriving an affine camera approximation...')
         logging.info('scene coordinate frame is in lat, lon, alt')
 
-        lat_points = self.latlonalt[:, 0:1]
-        lon_points = self.latlonalt[:, 1:2]
-        alt_points = self.latlonalt[:, 2:3]
+        latlonalt, _, _ = self.grid(xy_axis_grid_points, z_axis_grid_points)
+        lat_points = latlonalt[:, 0:1]
+        lon_points = latlonalt[:, 1:2]
+        alt_points = latlonalt[:, 2:3]
 
-        affine_dict = {}
-        for i in range(self.cnt):
-            col, row = self.rpc_models[i].projection(lat_points, lon_points, alt_points)
+        # project the grid into all the images at once
+        all_col, all_row = self.rpc_batch.projection(lat_points, lon_points, alt_points)
+        keep_mask = self.inside_mask(all_col, all_row)
 
-            # make sure all the points lie inside the image
-            width = self.rpc_models[i].width
-            height = self.rpc_models[i].height
-            keep_mask = np.logical_and(col >= 0, row >= 0)
-            keep_mask = np.logical_and(keep_mask, col < width)
-            keep_mask = np.logical_and(keep_mask, row < height)
-
-            P = solve_affine(lat_points, lon_points, alt_points, col, row, keep_mask)
+        all_P = solve_affine_batch(lat_points, lon_points, alt_points, all_col, all_row, keep_mask)
 
+        affine_dict = {}
+        for i in range(self.cnt):
             # write to file
             img_name = self.img_names[i]
-            P = list(P.reshape((8,)))
-            affine_dict[img_name] = [width, height] + P
+            P = list(all_P[i].reshape((8,)))
+            affine_dict[img_name] = [self.rpc_models[i].width, self.rpc_models[i].height] + P
 
         with open(os.path.join(self.out_dir, 'affine_latlonalt.json'), 'w') as fp:
             json.dump(affine_dict, fp, indent=2)
@@ -147,33 +200,164 @@ class CameraApprox(object):
         with open(os.path.join(self.out_dir, 'bbx_latlonalt.json'), 'w') as fp:
             json.dump(bbx, fp, indent=2)
 
-    def approx_perspective_enu(self):
+    def fit_perspective(self, latlonalt, enu, img_indices):
+        """
+        Fits perspective cameras for a subset of the images on the given grid.
+
+        Returns:
+            list of (K, R, t, errors), errors being the output of check_perspective_error
+        """
+        lat_points = latlonalt[:, 0:1]
+        lon_points = latlonalt[:, 1:2]
+        alt_points = latlonalt[:, 2:3]
+
+        xx = enu[:, 0:1]
+        yy = enu[:, 1:2]
+        zz = enu[:, 2:3]
+
+        # project the grid into all the images at once
+        if len(img_indices) == self.cnt:
+            rpc_batch = self.rpc_batch
+        else:
+            rpc_batch = RPCModelBatch([self.rpc_models[i] for i in img_indices])
+        all_col, all_row = rpc_batch.projection(lat_points, lon_points, alt_points)
+        keep_mask = self.inside_mask(all_col, all_row, rpc_batch)
+
+        all_P = solve_perspective_batch(xx, yy, zz, all_col, all_row, keep_mask)
+
+        def finish(i):
+            col = all_col[:, i:i+1]
+            row = all_row[:, i:i+1]
+
+            # factorize into standard form
+            K, R, t = factorize(all_P[i])
+
+            # check approximation error
+            err = check_perspective_error(xx, yy, zz, col, row, K, R, t, keep_mask[:, i:i+1])
+            return K, R, t, err
+
+        pool = ThreadPool(min(self.max_threads, max(len(img_indices), 1)))
+        results = pool.map(finish, range(len(img_indices)))
+        pool.close()
+        pool.join()
+        return results
+
+    def check_perspective(self, latlonalt, enu, results):
+        """
+        Measures the errors of fitted perspective cameras, one per image, on the given grid.
+
+        Returns:
+            results with the errors replaced
+        """
+        xx = enu[:, 0:1]
+        yy = enu[:, 1:2]
+        zz = enu[:, 2:3]
+
+        all_col, all_row = self.rpc_batch.projection(latlonalt[:, 0:1], latlonalt[:, 1:2], latlonalt[:, 2:3])
+        keep_mask = self.inside_mask(all_col, all_row)
+
+        def check(i):
+            K, R, t, _ = results[i]
+            err = check_perspective_error(xx, yy, zz, all_col[:, i:i+1], all_row[:, i:i+1], K, R, t,
+                                          keep_mask[:, i:i+1])
+            return K, R, t, err
+
+        pool = ThreadPool(min(self.max_threads, max(self.cnt, 1)))
+        checked = pool.map(check, range(self.cnt))
+        pool.close()
+        pool.join()
+        return checked
+
+    def fit_perspective_adaptive(self, levels, tol):
+        """
+        Refines the grid level by level; an image is done as soon as its mean projection error changes by
+        less than tol pixels from one level to the next, or when the finest level is reached.
+
+        Returns:
+            the results of fit_perspective, each with the errors measured on the grid of its last level,
+            and the finest level fitted
+        """
+        results = [None] * self.cnt
+        active = list(range(self.cnt))
+        prev_err = {}
+        used_points = {}
+        finest_level = 0
+        start_time = time.time()
+        for level, (xy_axis_grid_points, z_axis_grid_points) in enumerate(levels):
+            latlonalt, _, enu = self.grid(xy_axis_grid_points, z_axis_grid_points)
+            level_results = self.fit_perspective(latlonalt, enu, active)
+            finest_level = level
+
+            still_active = []
+            for i, result in zip(active, level_results):
+                results[i] = result
+                used_points[i] = latlonalt.shape[0]
+                err = result[3][0]
+                if level < len(levels) - 1 and (i not in prev_err or abs(err - prev_err[i]) >= tol):
+                    still_active.append(i)
+                prev_err[i] = err
+
+            logging.info('grid level {}: {} * {} * {} points, {} images fitted, {} need refinement, '
+                         'elapsed time: {} seconds'.format(level, xy_axis_grid_points, xy_axis_grid_points,
+                                                           z_axis_grid_points, len(active), len(still_active),
+                                                           time.time() - start_time))
+            active = still_active
+            if len(active) == 0:
+                break
+
+        for i in range(self.cnt):
+            logging.info('{}: fitted with {} grid points, mean proj. err: {} pixels'.format(
+                self.img_names[i], used_points[i], results[i][3][0]))
+        return results, levels[finest_level]
+
+    def approx_perspective_enu(self, adaptive_levels=None, adaptive_tol=0.01, check_grid=None):
+        """
+        Args:
+            adaptive_levels: optional list of (xy_axis_grid_points, z_axis_grid_points), from coarse to fine;
+                if given, the grid of each image is refined only until the fitting error is stable
+            adaptive_tol: stability tolerance on the mean projection error, in pixels
+            check_grid: (xy_axis_grid_points, z_axis_grid_points) of the grid on which the errors of all
+                the images are measured; defaults to the finest level fitted
+
+        Returns:
+            the (xy_axis_grid_points, z_axis_grid_points) of the grid the errors were measured on
+        """
         logging.info('deriving a perspective camera approximation...')
         logging.info('scene coordinate frame is in ENU')
 
+        if adaptive_levels is not None:
+            results, fitted_grid = self.fit_perspective_adaptive(adaptive_levels, adaptive_tol)
+        else:
+            fitted_grid = (100, 20)
+            latlonalt, _, enu = self.grid(*fitted_grid)
+            results = self.fit_perspective(latlonalt, enu, list(range(self.cnt)))
+
+        if check_grid is None:
+            check_grid = fitted_grid
+        latlonalt, _, enu = self.grid(*check_grid)
+        # with adaptive levels, the images stopped at different levels; their errors are only comparable
+        # once measured on a common grid
+        if adaptive_levels is not None or tuple(check_grid) != fitted_grid:
+            logging.info('measuring the errors on the {} * {} * {} grid'.format(check_grid[0], check_grid[0],
+                                                                                check_grid[1]))
+            results = self.check_perspective(latlonalt, enu, results)
+
+        self.write_perspective(self.out_dir, list(range(self.cnt)), results, enu)
+        return check_grid
+
+    def write_perspective(self, out_dir, img_indices, results, enu):
         perspective_dict = {}
 
         errors_txt = 'img_name, mean_proj_err (pixels), median_proj_err (pixels), max_proj_err (pixels), mean_inv_proj_err (meters), median_inv_proj_err (meters), max_inv_proj_err (meters)\n'
 
-        lat_points = self.latlonalt[:, 0:1]
-        lon_points = self.latlonalt[:, 1:2]
-        alt_points = self.latlonalt[:, 2:3]
+        xx = enu[:, 0:1]
+        yy = enu[:, 1:2]
+        zz = enu[:, 2:3]
 
-        xx = self.enu[:, 0:1]
-        yy = self.enu[:, 1:2]
-        zz = self.enu[:, 2:3]
-
-        for i in range(self.cnt):
-            col, row = self.rpc_models[i].projection(lat_points, lon_points, alt_points)
-
-            # make sure all the points lie inside the image
+        for i, result in zip(img_indices, results):
+            K, R, t, tmp = result
             width = self.rpc_models[i].width
             height = self.rpc_models[i].height
-            keep_mask = np.logical_and(col >= 0, row >= 0)
-            keep_mask = np.logical_and(keep_mask, col < width)
-            keep_mask = np.logical_and(keep_mask, row < height)
-
-            K, R, t = solve_perspective(xx, yy, zz, col, row, keep_mask)
 
             qvec = Quaternion(matrix=R)
             # fx, fy, cx, cy, s, qvec, t
@@ -184,14 +368,12 @@ class CameraApprox(object):
             img_name = self.img_names[i]
             perspective_dict[img_name] = params
 
-            # check approximation error
-            tmp = check_perspective_error(xx, yy, zz, col, row, K, R, t, keep_mask)
             errors_txt += '{}, {}, {}, {}, {}, {}, {}\n'.format(img_name, tmp[0], tmp[1], tmp[2], tmp[3], tmp[4], tmp[5])
 
-        with open(os.path.join(self.out_dir, 'perspective_enu.json'), 'w') as fp:
+        with open(os.path.join(out_dir, 'perspective_enu.json'), 'w') as fp:
             json.dump(perspective_dict, fp, indent=2)
 
-        with open(os.path.join(self.out_dir, 'perspective_enu_error.csv'), 'w') as fp:
+        with open(os.path.join(out_dir, 'perspective_enu_error.csv'), 'w') as fp:
             fp.write(errors_txt)
 
         bbx = { 'xx_min': np.min(xx),
@@ -200,9 +382,65 @@ class CameraApprox(object):
                 'yy_max': np.max(yy),
                 'zz_min': np.min(zz),
                 'zz_max': np.max(zz)}
-        with open(os.path.join(self.out_dir, 'bbx_enu.json'), 'w') as fp:
+        with open(os.path.join(out_dir, 'bbx_enu.json'), 'w') as fp:
             json.dump(bbx, fp, indent=2)
 
+    def approx_perspective_enu_tiled(self, tile_rows, tile_cols, overlap=0.1, min_visible_ratio=0.5):
+        """
+        Splits the AOI into tile_rows * tile_cols overlapping sub-volumes and fits one perspective camera
+        per tile and image; the results of tile (i, j), i counting from north and j from west, are written
+        to approx_camera/tiles/tile_i_j/.
+
+        Args:
+            overlap: extension of each tile on every side, as a fraction of the tile size
+            min_visible_ratio: images seeing a smaller part of a tile are left out of that tile
+        """
+        logging.info('deriving tiled perspective camera approximations, {} * {} tiles...'.format(tile_rows,
+                                                                                                 tile_cols))
+        latlonalt, _, enu = self.grid()
+
+        # visibility of the grid points, for choosing the images of each tile
+        all_col, all_row = self.rpc_batch.projection(latlonalt[:, 0:1], latlonalt[:, 1:2], latlonalt[:, 2:3])
+        visible = self.inside_mask(all_col, all_row)
+        del all_col, all_row
+
+        xx_min, xx_max = np.min(enu[:, 0]), np.max(enu[:, 0])
+        yy_min, yy_max = np.min(enu[:, 1]), np.max(enu[:, 1])
+        tile_width = (xx_max - xx_min) / tile_cols
+        tile_height = (yy_max - yy_min) / tile_rows
+
+        tiles_dir = os.path.join(self.out_dir, 'tiles')
+        if os.path.exists(tiles_dir):
+            shutil.rmtree(tiles_dir)
+        os.mkdir(tiles_dir)
+
+        for i in range(tile_rows):
+            for j in range(tile_cols):
+                tile_bounds = {'xx_min': xx_min + j * tile_width,
+                               'xx_max': xx_min + (j + 1) * tile_width,
+                               'yy_min': yy_max - (i + 1) * tile_height,
+                               'yy_max': yy_max - i * tile_height}
+                mask = np.logical_and.reduce((enu[:, 0] >= tile_bounds['xx_min'] - overlap * tile_width,
+                                              enu[:, 0] <= tile_bounds['xx_max'] + overlap * tile_width,
+                                              enu[:, 1] >= tile_bounds['yy_min'] - overlap * tile_height,
+                                              enu[:, 1] <= tile_bounds['yy_max'] + overlap * tile_height))
+
+                visible_ratio = np.sum(visible[mask, :], axis=0) / np.sum(mask)
+                img_indices = [k for k in range(self.cnt) if visible_ratio[k] >= min_visible_ratio]
+                logging.info('tile_{}_{}: {} grid points, {}/{} images'.format(i, j, np.sum(mask),
+                                                                               len(img_indices), self.cnt))
+                if len(img_indices) == 0:
+                    continue
+
+                results = self.fit_perspective(latlonalt[mask], enu[mask], img_indices)
+
+                tile_dir = os.path.join(tiles_dir, 'tile_{}_{}'.format(i, j))
+                os.mkdir(tile_dir)
+                self.write_perspective(tile_dir, img_indices, results, enu[mask])
+                # bbx_enu.json holds the extended tile; tile_bounds.json the part the tile is responsible for
+                with open(os.path.join(tile_dir, 'tile_bounds.json'), 'w') as fp:
+                    json.dump(tile_bounds, fp, indent=2)
+
 
 if __name__ == '__main__':
     pass
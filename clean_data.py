@@ -35,6 +35,8 @@ import tarfile
 import shutil
 import unicodedata
 import logging
+import json
+import multiprocessing
 
 # first find .NTF file, and extract order_id, prod_id, standard name
 # then extract rpc file and preview image from the .tar file
@@ -50,46 +52,83 @@ def clean_image_info(file_name):
     return img_name, order_id, prod_id
 
 
-def process_clean_data_item(item, dataset_dir, out_dir, tmp_dir):
+def remove_control_chars(content):
+    # the category is only looked up once per distinct character
+    table = {ord(ch): None for ch in set(content) if unicodedata.category(ch)[0] == "C"}
+    return content.translate(table)
+
+
+def clean_data_outputs(item):
+    # files written to out_dir for an item: link to the .NTF, rpc xml and preview image
+    img_name, _, _ = clean_image_info(item)
+    return ['{}.NTF'.format(img_name), '{}.XML'.format(img_name), '{}-BROWSE.JPG'.format(img_name)]
+
+
+def process_clean_data_item(item, dataset_dir, out_dir):
     if item[-4:] == '.NTF' and os.path.exists(os.path.join(dataset_dir, '{}.tar'.format(item[:-4]))):
         logging.info('cleaning {}'.format(item))
         img_name, order_id, prod_id = clean_image_info(item)
-        os.symlink(os.path.join(dataset_dir, item), os.path.join(out_dir, '{}.NTF'.format(img_name)))
-        tar = tarfile.open(os.path.join(dataset_dir, '{}.tar'.format(item[:-4])))
-        tar.extractall(os.path.join(tmp_dir, img_name))
-
-        subfolder = 'DVD_VOL_1'
-        for x in os.listdir(os.path.join(tmp_dir, img_name, order_id)):
-            if 'DVD_VOL' in x:
-                subfolder = x
-                break
-
-        des_folder = os.path.join(tmp_dir, img_name, order_id, subfolder, order_id)
-        # walk through des_folder
-        # img_files = []
-        # for root, dirs, files in os.walk(des_folder):
-        #     img_files.extend([os.path.join(root, x) for x in files
-        #                       if img_name in x and (x[-4:] == '.XML' or x[-4:] == '.JPG')])
-
-        rpc_file = os.path.join(des_folder, '{}_PAN'.format(prod_id), '{}.XML'.format(img_name))
-        jpg_file = os.path.join(des_folder, '{}_PAN'.format(prod_id), '{}-BROWSE.JPG'.format(img_name))
-        img_files = [rpc_file, jpg_file]
-        for x in img_files:
-            shutil.copy(x, out_dir)
-
-        # remove control characters in the xml file
-        rpc_file = os.path.join(out_dir, '{}.XML'.format(img_name))
-        with open(rpc_file, encoding='utf-8', errors='ignore') as fp:
-            content = fp.read()
-        content = "".join([ch for ch in content if unicodedata.category(ch)[0] != "C"])
-        with open(rpc_file, 'w') as fp:
-            fp.write(content)
-        return True
-    return False
-
-
-def clean_data(dataset_dirs, out_dir, pairing=None):
-    # out_dir must exist and be empty
+
+        # the files we need are in <order_id>/<DVD_VOL*>/<order_id>/<prod_id>_PAN/;
+        # scan the member headers once and only read the data of those two members
+        rpc_name = '{}.XML'.format(img_name)
+        jpg_name = '{}-BROWSE.JPG'.format(img_name)
+        pan_folder = '{}_PAN'.format(prod_id)
+        members = {}
+        with tarfile.open(os.path.join(dataset_dir, '{}.tar'.format(item[:-4]))) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                folder, name = os.path.split(member.name)
+                if name in (rpc_name, jpg_name) and os.path.basename(folder) == pan_folder \
+                        and name not in members:
+                    members[name] = member
+                    if len(members) == 2:
+                        break
+
+            for name in (rpc_name, jpg_name):
+                if name not in members:
+                    raise FileNotFoundError('{}/{} not found in {}.tar'.format(pan_folder, name, item[:-4]))
+
+            # remove control characters in the xml file
+            content = tar.extractfile(members[rpc_name]).read().decode('utf-8', errors='ignore')
+            content = remove_control_chars(content)
+            with open(os.path.join(out_dir, rpc_name), 'w') as fp:
+                fp.write(content)
+
+            with open(os.path.join(out_dir, jpg_name), 'wb') as fp:
+                shutil.copyfileobj(tar.extractfile(members[jpg_name]), fp)
+
+        # link the .NTF last, so that image_crop never sees it without its xml
+        ntf_link = os.path.join(out_dir, '{}.NTF'.format(img_name))
+        if os.path.lexists(ntf_link):
+            os.remove(ntf_link)
+        os.symlink(os.path.join(dataset_dir, item), ntf_link)
+        return [os.path.basename(ntf_link), rpc_name, jpg_name]
+    return []
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def clean_data_worker(item, dataset_dir, out_dir):
+    try:
+        return process_clean_data_item(item, dataset_dir, out_dir)
+    except Exception as e:
+        logging.error('failed to clean {}: {}'.format(os.path.join(dataset_dir, item), e))
+        # do not leave partial outputs behind
+        for x in clean_data_outputs(item):
+            path = os.path.join(out_dir, x)
+            if os.path.lexists(path):
+                os.remove(path)
+        return None
+
+
+def clean_data(dataset_dirs, out_dir, pairing=None, max_processes=-1):
+    # items already cleaned into out_dir are listed in out_dir/manifest.json,
+    # together with the size and mtime of their source files; unchanged items are skipped
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
@@ -98,30 +137,84 @@ def clean_data(dataset_dirs, out_dir, pairing=None):
     logging.info('will save files to folder: {}'.format(out_dir))
     logging.info('the standard format is: <7 char date><6 char time>-P1BS-<20 char product id>.NTF\n\n')
 
-    tmp_dir = os.path.join(out_dir, 'tmp')
-    if os.path.exists(tmp_dir):
-        shutil.rmtree(tmp_dir)
-    os.mkdir(tmp_dir)
-
-    cnt = 0
+    all_items = []
     if pairing is not None:
         for p in pairing:
             pan_ntf = p[0]
-            item = os.path.basename(pan_ntf)
-            dataset_dir = os.path.dirname(pan_ntf)
-            if process_clean_data_item(item, dataset_dir, out_dir, tmp_dir):
-                cnt += 1
+            all_items.append((os.path.basename(pan_ntf), os.path.abspath(os.path.dirname(pan_ntf))))
     else:
         for dataset_dir in sorted(dataset_dirs):
             for item in sorted(os.listdir(dataset_dir)):
                 # if 'WV03' not in item:  # only select 'WV03' satellite images
                 #     continue
-                if process_clean_data_item(item, dataset_dir, out_dir, tmp_dir):
-                    cnt += 1
-
-    logging.info('processed {} items in total'.format(cnt))
-    # remove tmp_dir
-    shutil.rmtree(tmp_dir)
+                all_items.append((item, dataset_dir))
+    all_items = [(item, dataset_dir) for item, dataset_dir in all_items
+                 if item[-4:] == '.NTF' and os.path.exists(os.path.join(dataset_dir, '{}.tar'.format(item[:-4])))]
+
+    manifest_file = os.path.join(out_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as fp:
+            manifest = json.load(fp)
+
+    # find the items whose sources are new or have changed
+    new_manifest = {}
+    to_process = []
+    for item, dataset_dir in all_items:
+        ntf_file = os.path.join(dataset_dir, item)
+        sources = [file_signature(ntf_file), file_signature('{}.tar'.format(ntf_file[:-4]))]
+        entry = manifest.get(ntf_file)
+        if entry is not None and entry['sources'] == sources \
+                and all([os.path.lexists(os.path.join(out_dir, x)) for x in entry['outputs']]):
+            new_manifest[ntf_file] = entry
+        else:
+            to_process.append((item, dataset_dir, sources))
+
+    # remove the outputs of the items that are gone or will be redone
+    kept_outputs = set([x for entry in new_manifest.values() for x in entry['outputs']])
+    for ntf_file in manifest:
+        if ntf_file not in new_manifest:
+            for x in manifest[ntf_file]['outputs']:
+                path = os.path.join(out_dir, x)
+                if x not in kept_outputs and os.path.lexists(path):
+                    os.remove(path)
+
+    # outputs of the items no longer in the input set, including those the manifest does not list,
+    # e.g. left by a run interrupted before writing it; image_crop would pick them up otherwise
+    current_outputs = set([x for item, _ in all_items for x in clean_data_outputs(item)])
+    for x in os.listdir(out_dir):
+        if x[-4:] in ('.NTF', '.XML') or x[-11:] == '-BROWSE.JPG':
+            if x not in current_outputs:
+                logging.info('removing stale output: {}'.format(x))
+                os.remove(os.path.join(out_dir, x))
+
+    unchanged_cnt = len(new_manifest)
+    logging.info('{} items in total, {} unchanged, {} to be processed'.format(
+        len(all_items), unchanged_cnt, len(to_process)))
+
+    if len(to_process) > 0:
+        if max_processes <= 0:
+            max_processes = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(min(max_processes, len(to_process)))
+        results = [pool.apply_async(clean_data_worker, (item, dataset_dir, out_dir))
+                   for item, dataset_dir, _ in to_process]
+        pool.close()
+        pool.join()
+
+        for (item, dataset_dir, sources), result in zip(to_process, results):
+            outputs = result.get()
+            if outputs:
+                new_manifest[os.path.join(dataset_dir, item)] = {'sources': sources, 'outputs': outputs}
+
+    # write the manifest at once, so that an interrupted run leaves the previous one in place
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        json.dump(new_manifest, fp, indent=2)
+    os.replace(tmp_file, manifest_file)
+
+    processed_cnt = len(new_manifest) - unchanged_cnt
+    logging.info('processed {} items in this run, {} failed, {} skipped as unchanged'.format(
+        processed_cnt, len(to_process) - processed_cnt, unchanged_cnt))
 
 
 if __name__ == '__main__':
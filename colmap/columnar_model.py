@@ -0,0 +1,234 @@
+#  ===============================================================================================================
+#  Copyright (c) 2019, Cornell University. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without modification, are permitted provided that
+#  the following conditions are met:
+#
+#      * Redistributions of source code must retain the above copyright otice, this list of conditions and
+#        the following disclaimer.
+#
+#      * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and
+#        the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#      * Neither the name of Cornell University nor the names of its contributors may be used to endorse or
+#        promote products derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+#  WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+#  OF SUCH DAMAGE.
+#
+#  Author: Kai Zhang (kz298@cornell.edu)
+#
+#  The research is based upon work supported by the Office of the Director of National Intelligence (ODNI),
+#  Intelligence Advanced Research Projects Activity (IARPA), via DOI/IBC Contract Number D17PC00287.
+#  The U.S. Government is authorized to reproduce and distribute copies of this work for Governmental purposes.
+#  ===============================================================================================================
+
+
+
+import os
+import struct
+import numpy as np
+from colmap.read_model import read_cameras_text, read_cameras_binary, \
+    read_images_text, read_points3D_text, detect_model_ext
+
+
+class ColumnarImages(object):
+    """
+    All the images of a colmap model as flat arrays.
+
+    Row i is the image with colmap id ids[i]; its key points are
+    xys[keypoint_offsets[i]:keypoint_offsets[i+1]], with the matching
+    point3D_ids (-1 for key points that are not triangulated).
+    """
+    def __init__(self, ids, qvecs, tvecs, camera_ids, names, keypoint_offsets, xys, point3D_ids):
+        self.ids = ids
+        self.qvecs = qvecs
+        self.tvecs = tvecs
+        self.camera_ids = camera_ids
+        self.names = names
+        self.keypoint_offsets = keypoint_offsets
+        self.xys = xys
+        self.point3D_ids = point3D_ids
+
+        # colmap image id -> row
+        self.id_to_row = np.full((int(np.max(ids)) + 1 if len(ids) > 0 else 0, ), -1, dtype=np.int64)
+        self.id_to_row[ids] = np.arange(len(ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, image_ids):
+        return self.id_to_row[image_ids]
+
+    @classmethod
+    def from_dict(cls, images):
+        images = list(images.values())
+        keypoint_cnt = np.array([len(image.point3D_ids) for image in images], dtype=np.int64)
+        keypoint_offsets = np.concatenate(([0, ], np.cumsum(keypoint_cnt)))
+        xys = np.zeros((keypoint_offsets[-1], 2))
+        point3D_ids = np.zeros((keypoint_offsets[-1], ), dtype=np.int64)
+        for i, image in enumerate(images):
+            if keypoint_cnt[i] > 0:
+                xys[keypoint_offsets[i]:keypoint_offsets[i+1]] = image.xys
+                point3D_ids[keypoint_offsets[i]:keypoint_offsets[i+1]] = image.point3D_ids
+
+        return cls(np.array([image.id for image in images], dtype=np.int64),
+                   np.array([image.qvec for image in images], dtype=np.float64).reshape((-1, 4)),
+                   np.array([image.tvec for image in images], dtype=np.float64).reshape((-1, 3)),
+                   np.array([image.camera_id for image in images], dtype=np.int64),
+                   [image.name for image in images], keypoint_offsets, xys, point3D_ids)
+
+
+class ColumnarPoints3D(object):
+    """
+    All the 3D points of a colmap model as flat arrays.
+
+    The track of point i is stored CSR-style:
+    image_ids[track_offsets[i]:track_offsets[i+1]] and the matching point2D_idxs.
+    """
+    def __init__(self, ids, xyz, rgb, error, track_offsets, image_ids, point2D_idxs):
+        self.ids = ids
+        self.xyz = xyz
+        self.rgb = rgb
+        self.error = error
+        self.track_offsets = track_offsets
+        self.image_ids = image_ids
+        self.point2D_idxs = point2D_idxs
+
+    def __len__(self):
+        return len(self.ids)
+
+    def track_lengths(self):
+        return np.diff(self.track_offsets)
+
+    def observation_points(self):
+        # index of the 3D point of each observation
+        return np.repeat(np.arange(len(self.ids), dtype=np.int64), self.track_lengths())
+
+    @classmethod
+    def from_dict(cls, points3D):
+        points3D = list(points3D.values())
+        track_len = np.array([len(point3D.image_ids) for point3D in points3D], dtype=np.int64)
+        track_offsets = np.concatenate(([0, ], np.cumsum(track_len)))
+        image_ids = np.zeros((track_offsets[-1], ), dtype=np.int64)
+        point2D_idxs = np.zeros((track_offsets[-1], ), dtype=np.int64)
+        for i, point3D in enumerate(points3D):
+            if track_len[i] > 0:
+                image_ids[track_offsets[i]:track_offsets[i+1]] = point3D.image_ids
+                point2D_idxs[track_offsets[i]:track_offsets[i+1]] = point3D.point2D_idxs
+
+        return cls(np.array([point3D.id for point3D in points3D], dtype=np.int64),
+                   np.array([point3D.xyz for point3D in points3D], dtype=np.float64).reshape((-1, 3)),
+                   np.array([point3D.rgb for point3D in points3D], dtype=np.uint8).reshape((-1, 3)),
+                   np.array([point3D.error for point3D in points3D], dtype=np.float64),
+                   track_offsets, image_ids, point2D_idxs)
+
+
+def gather_records(buf, offsets, dtype):
+    # view the fixed-size records starting at the given byte offsets as a structured array
+    idx = offsets.reshape((-1, 1)) + np.arange(dtype.itemsize, dtype=np.int64).reshape((1, -1))
+    return buf[idx].view(dtype).reshape((-1, ))
+
+
+def read_images_binary_columnar(path_to_model_file):
+    """
+    see: colmap.read_model.read_images_binary
+    """
+    with open(path_to_model_file, "rb") as fid:
+        data = fid.read()
+
+    header_struct = struct.Struct("<idddddddi")
+    keypoint_dtype = np.dtype([("xy", "<f8", (2, )), ("point3D_id", "<i8")])
+
+    num_reg_images = struct.unpack_from("<Q", data, 0)[0]
+    offset = 8
+    headers = []
+    names = []
+    keypoints = []
+    for image_index in range(num_reg_images):
+        headers.append(header_struct.unpack_from(data, offset))
+        offset += header_struct.size
+        name_end = data.index(b"\x00", offset)
+        names.append(data[offset:name_end].decode("utf-8"))
+        offset = name_end + 1
+        num_points2D = struct.unpack_from("<Q", data, offset)[0]
+        offset += 8
+        keypoints.append(np.frombuffer(data, dtype=keypoint_dtype, count=num_points2D, offset=offset))
+        offset += keypoint_dtype.itemsize * num_points2D
+
+    headers = np.array(headers, dtype=np.float64).reshape((-1, 9))
+    keypoint_cnt = np.array([len(x) for x in keypoints], dtype=np.int64)
+    keypoints = np.concatenate(keypoints) if keypoints else np.zeros((0, ), dtype=keypoint_dtype)
+
+    return ColumnarImages(headers[:, 0].astype(np.int64), headers[:, 1:5], headers[:, 5:8],
+                          headers[:, 8].astype(np.int64), names,
+                          np.concatenate(([0, ], np.cumsum(keypoint_cnt))),
+                          keypoints["xy"].astype(np.float64), keypoints["point3D_id"].astype(np.int64))
+
+
+def read_points3d_binary_columnar(path_to_model_file):
+    """
+    see: colmap.read_model.read_points3d_binary
+    """
+    with open(path_to_model_file, "rb") as fid:
+        data = fid.read()
+
+    header_dtype = np.dtype([("id", "<u8"), ("xyz", "<f8", (3, )), ("rgb", "u1", (3, )),
+                             ("error", "<f8"), ("track_len", "<u8")])
+    track_len_offset = header_dtype.fields["track_len"][1]
+    track_len_struct = struct.Struct("<Q")
+
+    # records have variable lengths, so only their start offsets are found sequentially
+    num_points = struct.unpack_from("<Q", data, 0)[0]
+    header_offsets = []
+    offset = 8
+    for point_line_index in range(num_points):
+        header_offsets.append(offset)
+        track_len = track_len_struct.unpack_from(data, offset + track_len_offset)[0]
+        offset += header_dtype.itemsize + 8 * track_len
+    header_offsets = np.array(header_offsets, dtype=np.int64)
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    headers = gather_records(buf, header_offsets, header_dtype)
+
+    track_len = headers["track_len"].astype(np.int64)
+    track_offsets = np.concatenate(([0, ], np.cumsum(track_len)))
+    # each track element is a pair of int32: image_id, point2D_idx
+    elem_offsets = np.repeat(header_offsets + header_dtype.itemsize - track_offsets[:-1] * 8, track_len) \
+                   + 8 * np.arange(track_offsets[-1], dtype=np.int64)
+    track_elems = gather_records(buf, elem_offsets, np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")]))
+
+    return ColumnarPoints3D(headers["id"].astype(np.int64), headers["xyz"].astype(np.float64),
+                            headers["rgb"].astype(np.uint8), headers["error"].astype(np.float64), track_offsets,
+                            track_elems["image_id"].astype(np.int64), track_elems["point2D_idx"].astype(np.int64))
+
+
+def read_columnar_model(path, ext=None):
+    if ext is None:
+        ext = detect_model_ext(path)
+    if ext == ".txt":
+        cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
+        images = ColumnarImages.from_dict(read_images_text(os.path.join(path, "images" + ext)))
+        points3D = ColumnarPoints3D.from_dict(read_points3D_text(os.path.join(path, "points3D" + ext)))
+    else:
+        cameras = read_cameras_binary(os.path.join(path, "cameras" + ext))
+        images = read_images_binary_columnar(os.path.join(path, "images" + ext))
+        points3D = read_points3d_binary_columnar(os.path.join(path, "points3D" + ext))
+    return cameras, images, points3D
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    start = time.time()
+    cameras, images, points3D = read_columnar_model(sys.argv[1])
+    print('num_cameras: {}, num_images: {}, num_points3D: {}, num_observations: {}'.format(
+        len(cameras), len(images), len(points3D), len(points3D.image_ids)))
+    print('read in {:.3f} seconds'.format(time.time() - start))
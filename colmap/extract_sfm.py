@@ -30,7 +30,7 @@
 #  ===============================================================================================================
 
 
-from colmap.read_model import read_model
+from colmap.columnar_model import read_columnar_model
 import numpy as np
 import json
 import os
@@ -38,38 +38,46 @@ import os
 
 def read_tracks(colmap_images, colmap_points3D):
     all_tracks = []     # list of dicts; each dict represents a track
-    all_points = []     # list of all 3D points
     view_keypoints = {} # dict of lists; each list represents the triangulated key points of a view
 
-
-    for point3D_id in colmap_points3D:
-        point3D = colmap_points3D[point3D_id]
-        image_ids = point3D.image_ids
-        point2D_idxs = point3D.point2D_idxs
-
+    xyz = colmap_points3D.xyz
+    track_len = colmap_points3D.track_lengths()
+    all_points = np.hstack((xyz, colmap_points3D.error.reshape((-1, 1)), track_len.reshape((-1, 1)),
+                            colmap_points3D.rgb))   # array of all 3D points
+
+    # key point of each observation
+    obs_point = colmap_points3D.observation_points()
+    obs_row = colmap_images.rows(colmap_points3D.image_ids)
+    obs_keypoint = colmap_images.keypoint_offsets[obs_row] + colmap_points3D.point2D_idxs
+    assert (np.all(colmap_images.point3D_ids[obs_keypoint] == colmap_points3D.ids[obs_point]))
+    obs_u = colmap_images.xys[obs_keypoint, 0]
+    obs_v = colmap_images.xys[obs_keypoint, 1]
+
+    # views are listed in the order they are first seen
+    order = np.argsort(obs_row, kind='stable')
+    bounds = np.searchsorted(obs_row[order], np.arange(len(colmap_images) + 1))
+    rows = [i for i in range(len(colmap_images)) if bounds[i + 1] > bounds[i]]
+    for i in sorted(rows, key=lambda i: order[bounds[i]]):
+        idx = order[bounds[i]:bounds[i + 1]]
+        pts = obs_point[idx]
+        view_keypoints[colmap_images.names[i]] = list(zip(obs_u[idx].tolist(), obs_v[idx].tolist(),
+                                                          xyz[pts, 0].tolist(), xyz[pts, 1].tolist(),
+                                                          xyz[pts, 2].tolist(), track_len[pts].tolist()))
+
+    # sort the pixels of each track by the img_name
+    name_rank = np.argsort(np.argsort(np.array(colmap_images.names, dtype=object), kind='stable'))
+    perm = np.lexsort((np.arange(len(obs_point)), name_rank[obs_row], obs_point))
+    pixels = list(zip(np.array(colmap_images.names, dtype=object)[obs_row[perm]].tolist(),
+                      obs_u[perm].tolist(), obs_v[perm].tolist()))
+
+    xyz_list = xyz.tolist()
+    err_list = colmap_points3D.error.tolist()
+    track_offsets = colmap_points3D.track_offsets.tolist()
+    for i in range(len(colmap_points3D)):
         cur_track = {}
-        cur_track['xyz'] = (point3D.xyz[0], point3D.xyz[1], point3D.xyz[2])
-        cur_track['err'] = point3D.error
-
-        cur_track_len = len(image_ids)
-        assert (cur_track_len == len(point2D_idxs))
-        all_points.append(list(cur_track['xyz'] + (cur_track['err'], cur_track_len) + tuple(point3D.rgb)))
-
-        pixels = []
-        for i in range(cur_track_len):
-            image = colmap_images[image_ids[i]]
-            img_name = image.name
-            point2D_idx = point2D_idxs[i]
-            point2D = image.xys[point2D_idx]
-            assert (image.point3D_ids[point2D_idx] == point3D_id)
-            pixels.append((img_name, point2D[0], point2D[1]))
-
-            if img_name not in view_keypoints:
-                view_keypoints[img_name] = [(point2D[0], point2D[1]) + cur_track['xyz'] + (cur_track_len, ), ]
-            else:
-                view_keypoints[img_name].append((point2D[0], point2D[1]) + cur_track['xyz'] + (cur_track_len, ))
-
-        cur_track['pixels'] = sorted(pixels, key=lambda x: x[0]) # sort pixels by the img_name
+        cur_track['xyz'] = tuple(xyz_list[i])
+        cur_track['err'] = err_list[i]
+        cur_track['pixels'] = pixels[track_offsets[i]:track_offsets[i + 1]]
         all_tracks.append(cur_track)
 
     return all_tracks, all_points, view_keypoints
@@ -77,16 +85,14 @@ def read_tracks(colmap_images, colmap_points3D):
 
 def read_camera_dict(colmap_cameras, colmap_images):
     camera_dict = {}
-    for image_id in colmap_images:
-        image = colmap_images[image_id]
-
-        img_name = image.name
-        cam = colmap_cameras[image.camera_id]
+    for i in range(len(colmap_images)):
+        img_name = colmap_images.names[i]
+        cam = colmap_cameras[int(colmap_images.camera_ids[i])]
 
         img_size = (cam.width, cam.height)
         params = tuple(cam.params)
-        qvec = tuple(image.qvec)
-        tvec = tuple(image.tvec)
+        qvec = tuple(colmap_images.qvecs[i])
+        tvec = tuple(colmap_images.tvecs[i])
 
         # w, h, fx, fy, cx, cy, s, qvec, tvec
         camera_dict[img_name] = img_size + params + qvec + tvec
@@ -94,15 +100,15 @@ def read_camera_dict(colmap_cameras, colmap_images):
     return camera_dict
 
 
-def extract_camera_dict(sparse_dir, ext='.txt'):
-    colmap_cameras, colmap_images, _ = read_model(sparse_dir, ext)
+def extract_camera_dict(sparse_dir, ext=None):
+    colmap_cameras, colmap_images, _ = read_columnar_model(sparse_dir, ext)
 
     camera_dict = read_camera_dict(colmap_cameras, colmap_images)
 
     return camera_dict
 
 
-def extract_all_to_dir(sparse_dir, out_dir, ext='.txt'):
+def extract_all_to_dir(sparse_dir, out_dir, ext=None):
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
@@ -111,19 +117,22 @@ def extract_all_to_dir(sparse_dir, out_dir, ext='.txt'):
     track_file = os.path.join(out_dir, 'kai_tracks.json')
     keypoints_file = os.path.join(out_dir, 'kai_keypoints.json')
     
-    colmap_cameras, colmap_images, colmap_points3D = read_model(sparse_dir, ext)
+    colmap_cameras, colmap_images, colmap_points3D = read_columnar_model(sparse_dir, ext)
     camera_dict = read_camera_dict(colmap_cameras, colmap_images)
     with open(camera_dict_file, 'w') as fp:
         json.dump(camera_dict, fp, indent=2, sort_keys=True)
 
     all_tracks, all_points, view_keypoints = read_tracks(colmap_images, colmap_points3D)
-    np.savetxt(xyz_file, np.array(all_points), header='# format: x, y, z, reproj_err, track_len, color(RGB)', fmt='%.6f')
+    np.savetxt(xyz_file, all_points, header='# format: x, y, z, reproj_err, track_len, color(RGB)', fmt='%.6f')
 
+    # json.dumps uses the C encoder, which json.dump does not
     with open(track_file, 'w') as fp:
-        json.dump(all_tracks, fp)
+        fp.write(json.dumps(all_tracks))
 
     with open(keypoints_file, 'w') as fp:
-        json.dump(view_keypoints, fp)
+        fp.write(json.dumps(view_keypoints))
+
+    return colmap_cameras, colmap_images, colmap_points3D
 
 
 if __name__ == '__main__':
@@ -66,6 +66,8 @@ CAMERA_MODELS = {
 }
 CAMERA_MODEL_IDS = dict([(camera_model.model_id, camera_model) \
                          for camera_model in CAMERA_MODELS])
+CAMERA_MODEL_NAMES = dict([(camera_model.model_name, camera_model) \
+                           for camera_model in CAMERA_MODELS])
 
 
 def read_next_bytes(fid, num_bytes, format_char_sequence, endian_character="<"):
@@ -80,6 +82,19 @@ def read_next_bytes(fid, num_bytes, format_char_sequence, endian_character="<"):
     return struct.unpack(endian_character + format_char_sequence, data)
 
 
+def write_next_bytes(fid, data, format_char_sequence, endian_character="<"):
+    """Pack and write the next bytes to a binary file.
+    :param fid:
+    :param data: Data to pack, a single value or a list/tuple of values.
+    :param format_char_sequence: List of {c, e, f, d, h, H, i, I, l, L, q, Q}.
+    :param endian_character: Any of {@, =, <, >, !}
+    """
+    if isinstance(data, (list, tuple)):
+        fid.write(struct.pack(endian_character + format_char_sequence, *data))
+    else:
+        fid.write(struct.pack(endian_character + format_char_sequence, data))
+
+
 def read_cameras_text(path):
     """
     see: src/base/reconstruction.cc
@@ -243,7 +258,7 @@ def read_points3d_binary(path_to_model_file):
             point3D_id = binary_point_line_properties[0]
             xyz = np.array(binary_point_line_properties[1:4])
             rgb = np.array(binary_point_line_properties[4:7])
-            error = np.array(binary_point_line_properties[7])
+            error = float(binary_point_line_properties[7])
             track_length = read_next_bytes(
                 fid, num_bytes=8, format_char_sequence="Q")[0]
             track_elems = read_next_bytes(
@@ -258,7 +273,85 @@ def read_points3d_binary(path_to_model_file):
     return points3D
 
 
-def read_model(path, ext):
+def write_cameras_binary(cameras, path_to_model_file):
+    """
+    see: src/base/reconstruction.cc
+        void Reconstruction::WriteCamerasBinary(const std::string& path)
+        void Reconstruction::ReadCamerasBinary(const std::string& path)
+    """
+    with open(path_to_model_file, "wb") as fid:
+        write_next_bytes(fid, len(cameras), "Q")
+        for _, cam in cameras.items():
+            model_id = CAMERA_MODEL_NAMES[cam.model].model_id
+            camera_properties = [cam.id, model_id, cam.width, cam.height]
+            write_next_bytes(fid, camera_properties, "iiQQ")
+            params = [float(p) for p in cam.params]
+            write_next_bytes(fid, params, "d"*len(params))
+
+
+def write_images_binary(images, path_to_model_file):
+    """
+    see: src/base/reconstruction.cc
+        void Reconstruction::ReadImagesBinary(const std::string& path)
+        void Reconstruction::WriteImagesBinary(const std::string& path)
+    """
+    with open(path_to_model_file, "wb") as fid:
+        write_next_bytes(fid, len(images), "Q")
+        for _, img in images.items():
+            write_next_bytes(fid, img.id, "i")
+            write_next_bytes(fid, [float(x) for x in img.qvec], "dddd")
+            write_next_bytes(fid, [float(x) for x in img.tvec], "ddd")
+            write_next_bytes(fid, img.camera_id, "i")
+            fid.write(img.name.encode("utf-8") + b"\x00")
+            num_points2D = len(img.point3D_ids)
+            write_next_bytes(fid, num_points2D, "Q")
+            x_y_id_s = np.zeros(num_points2D, dtype=[("x", "<f8"), ("y", "<f8"), ("id", "<i8")])
+            if num_points2D > 0:
+                x_y_id_s["x"] = img.xys[:, 0]
+                x_y_id_s["y"] = img.xys[:, 1]
+                x_y_id_s["id"] = img.point3D_ids
+            fid.write(x_y_id_s.tobytes())
+
+
+def write_points3d_binary(points3D, path_to_model_file):
+    """
+    see: src/base/reconstruction.cc
+        void Reconstruction::ReadPoints3DBinary(const std::string& path)
+        void Reconstruction::WritePoints3DBinary(const std::string& path)
+    """
+    with open(path_to_model_file, "wb") as fid:
+        write_next_bytes(fid, len(points3D), "Q")
+        for _, pt in points3D.items():
+            write_next_bytes(fid, pt.id, "Q")
+            write_next_bytes(fid, [float(x) for x in pt.xyz], "ddd")
+            write_next_bytes(fid, [int(x) for x in pt.rgb], "BBB")
+            write_next_bytes(fid, float(pt.error), "d")
+            track_length = len(pt.image_ids)
+            write_next_bytes(fid, track_length, "Q")
+            track_elems = np.empty((track_length, 2), dtype="<i4")
+            track_elems[:, 0] = pt.image_ids
+            track_elems[:, 1] = pt.point2D_idxs
+            fid.write(track_elems.tobytes())
+
+
+def detect_model_ext(path):
+    """
+    Return ".bin" or ".txt", whichever complete model in path was written last.
+    """
+    latest = {}
+    for ext in [".bin", ".txt"]:
+        files = [os.path.join(path, name + ext) for name in ["cameras", "images", "points3D"]]
+        if all([os.path.exists(x) for x in files]):
+            latest[ext] = max([os.path.getmtime(x) for x in files])
+    if not latest:
+        raise IOError("no colmap model found in {}".format(path))
+    # binary wins ties
+    return max(latest.keys(), key=lambda ext: (latest[ext], ext == ".bin"))
+
+
+def read_model(path, ext=None):
+    if ext is None:
+        ext = detect_model_ext(path)
     if ext == ".txt":
         cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
         images = read_images_text(os.path.join(path, "images" + ext))
@@ -270,6 +363,12 @@ def read_model(path, ext):
     return cameras, images, points3D
 
 
+def write_model(cameras, images, points3D, path):
+    write_cameras_binary(cameras, os.path.join(path, "cameras.bin"))
+    write_images_binary(images, os.path.join(path, "images.bin"))
+    write_points3d_binary(points3D, os.path.join(path, "points3D.bin"))
+
+
 def qvec2rotmat(qvec):
     return np.array([
         [1 - 2 * qvec[2]**2 - 2 * qvec[3]**2,
@@ -298,11 +397,12 @@ def rotmat2qvec(R):
 
 
 def main():
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in [2, 3]:
         print("Usage: python read_model.py path/to/model/folder [.txt,.bin]")
         return
 
-    cameras, images, points3D = read_model(path=sys.argv[1], ext=sys.argv[2])
+    ext = sys.argv[2] if len(sys.argv) == 3 else None
+    cameras, images, points3D = read_model(path=sys.argv[1], ext=ext)
 
     print("num_cameras:", len(cameras))
     print("num_images:", len(images))
@@ -33,6 +33,7 @@
 import os
 from lib.run_cmd import run_cmd
 from colmap_sfm_utils import create_init_files
+from colmap.read_model import detect_model_ext
 
 gpu_index = '-1'
 
@@ -71,8 +72,11 @@ def run_point_triangulation(img_dir, db_file, out_dir, template_file, tri_merge_
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
-    # create initial poses
-    create_init_files(db_file, template_file, out_dir)
+    # create initial poses; keep them apart from the output, so that the two never get mixed up
+    init_dir = out_dir.rstrip('/') + '_init'
+    if not os.path.exists(init_dir):
+        os.mkdir(init_dir)
+    create_init_files(db_file, template_file, init_dir)
     
     # triangulate points
     cmd = 'colmap point_triangulator --Mapper.ba_refine_principal_point 1 \
@@ -94,7 +98,7 @@ def run_point_triangulation(img_dir, db_file, out_dir, template_file, tri_merge_
                                              --Mapper.ba_local_max_num_iterations 100 \
                                              --Mapper.ba_global_images_ratio 1.0000001\
                                              --Mapper.ba_global_max_num_iterations 100 \
-                                             --Mapper.tri_ignore_two_view_tracks 1'.format(db_file, img_dir, out_dir, out_dir,
+                                             --Mapper.tri_ignore_two_view_tracks 1'.format(db_file, img_dir, init_dir, out_dir,
                                                                                                tri_merge_max_reproj_error,
                                                                                                tri_complete_max_reproj_error,
                                                                                                filter_max_reproj_error)
@@ -122,6 +126,17 @@ def run_global_ba(in_dir, out_dir, weight):
     run_cmd(cmd)
 
 
+def run_model_converter(in_dir, out_dir, output_type='BIN'):
+    cmd = 'colmap model_converter --input_path {} --output_path {} --output_type {}'.format(in_dir, out_dir, output_type)
+    run_cmd(cmd)
+
+
+# downstream readers parse binary models much faster than text ones
+def ensure_binary_model(sparse_dir):
+    if detect_model_ext(sparse_dir) != '.bin':
+        run_model_converter(sparse_dir, sparse_dir, output_type='BIN')
+
+
 # def run_normalize(in_dir, out_dir, tform_file):
 #     # normalize sparse reconstruction
 #     cmd = 'colmap normalize --input_path {} --output_path {} --save_transform_to_file {}'.format(in_dir, out_dir, tform_file)
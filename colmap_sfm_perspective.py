@@ -70,10 +70,12 @@ def run_sfm(work_dir, sfm_dir, init_camera_file, weight):
         tri_dir = os.path.join(sfm_dir, 'tri')
         colmap_sfm_commands.run_point_triangulation(img_dir, db_file, tri_dir, init_template,
                                                     reproj_err_threshold, reproj_err_threshold, reproj_err_threshold)
+        colmap_sfm_commands.ensure_binary_model(tri_dir)
 
         # global bundle adjustment
         tri_ba_dir = os.path.join(sfm_dir, 'tri_ba')
         colmap_sfm_commands.run_global_ba(tri_dir, tri_ba_dir, weight)
+        colmap_sfm_commands.ensure_binary_model(tri_ba_dir)
 
         # update camera dict
         init_camera_dict = extract_camera_dict(tri_ba_dir)
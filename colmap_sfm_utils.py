@@ -32,8 +32,10 @@
 
 import os
 import json
+import numpy as np
 import colmap.database as database
 from colmap.extract_sfm import extract_camera_dict
+from colmap.read_model import Camera, Image, write_model
 
 
 def convert_colmap_sfm_to_template(sfm_dir, camera_model, template_file):
@@ -116,25 +118,22 @@ def create_init_files(db_file, template_file, out_dir):
     with open(template_file) as fp:
         template = json.load(fp)
 
-    cameras_txt_lines = []
-    images_txt_lines = []
+    cameras = {}
+    images = {}
     for img_name, img_id in img_name2id_dict.items():
         camera_line = template[img_name][0].format(camera_id=img_id)
-        cameras_txt_lines.append(camera_line)
+        elems = camera_line.split()
+        cameras[img_id] = Camera(id=img_id, model=elems[1], width=int(elems[2]), height=int(elems[3]),
+                                 params=np.array([float(x) for x in elems[4:]]))
 
         image_line = template[img_name][1].format(image_id=img_id, camera_id=img_id)
-        images_txt_lines.append(image_line)
+        elems = image_line.split()
+        images[img_id] = Image(id=img_id, qvec=np.array([float(x) for x in elems[1:5]]),
+                               tvec=np.array([float(x) for x in elems[5:8]]), camera_id=img_id, name=elems[9],
+                               xys=np.zeros((0, 2)), point3D_ids=np.zeros((0,), dtype=np.int64))
 
-    with open(os.path.join(out_dir, 'cameras.txt'), 'w') as fp:
-        fp.writelines(cameras_txt_lines)
-
-    with open(os.path.join(out_dir, 'images.txt'), 'w') as fp:
-        fp.writelines(images_txt_lines)
-        fp.write('\n')
-
-    # create an empty points3D.txt
-    fp = open(os.path.join(out_dir, 'points3D.txt'), 'w')
-    fp.close()
+    # binary model without any 3D points
+    write_model(cameras, images, {}, out_dir)
 
     # add inspector
     with open(os.path.join(out_dir, 'img_name2id.txt'), 'w') as fp:
@@ -32,33 +32,210 @@
 
 import os
 import json
-from lib.latlonalt_enu_converter import latlonalt_to_enu, enu_to_latlonalt
+import numpy as np
+from lib.latlon_utm_converter import latlon_to_utm
 
 
-# global: (xx, yy, zz) = (lat, lon, alt)
-# local: enu
+# content of each aoi.json already read, keyed by (path, mtime, size)
+_aoi_cache = {}
+
+
+def get_aoi(work_dir):
+    aoi_file = os.path.abspath(os.path.join(work_dir, 'aoi.json'))
+    stat = os.stat(aoi_file)
+    key = (aoi_file, stat.st_mtime_ns, stat.st_size)
+    if key not in _aoi_cache:
+        with open(aoi_file) as fp:
+            _aoi_cache[key] = json.load(fp)
+    return _aoi_cache[key]
+
+
+def get_enu_origin(work_dir):
+    bbx = get_aoi(work_dir)
 
-def local_to_global(work_dir, xx, yy, zz):
-    with open(os.path.join(work_dir, 'aoi.json')) as fp:
-        bbx = json.load(fp)
-    
     lat0 = (bbx['lat_min'] + bbx['lat_max']) / 2.0
     lon0 = (bbx['lon_min'] + bbx['lon_max']) / 2.0
     alt0 = bbx['alt_min']
+    return lat0, lon0, alt0
+
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1.0 / 298.257223563
+WGS84_B = WGS84_A * (1.0 - WGS84_F)
+WGS84_E2 = WGS84_F * (2.0 - WGS84_F)
+WGS84_EP2 = WGS84_E2 / (1.0 - WGS84_E2)
+
+
+def geodetic_to_ecef(lat, lon, alt):
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    # prime vertical radius of curvature
+    N = WGS84_A / np.sqrt(1.0 - WGS84_E2 * sin_lat * sin_lat)
+
+    x = (N + alt) * cos_lat * np.cos(lon)
+    y = (N + alt) * cos_lat * np.sin(lon)
+    z = (N * (1.0 - WGS84_E2) + alt) * sin_lat
+    return x, y, z
+
+
+def ecef_to_geodetic(x, y, z):
+    # closed-form solution of Heikkinen (1982); exact up to rounding away from the earth's center
+    a2 = WGS84_A * WGS84_A
+    b2 = WGS84_B * WGS84_B
+    e4 = WGS84_E2 * WGS84_E2
+
+    p2 = x * x + y * y
+    p = np.sqrt(p2)
+    z2 = z * z
+    F = 54.0 * b2 * z2
+    G = p2 + (1.0 - WGS84_E2) * z2 - WGS84_E2 * (a2 - b2)
+    c = e4 * F * p2 / (G * G * G)
+    s = np.cbrt(1.0 + c + np.sqrt(c * c + 2.0 * c))
+    k = s + 1.0 + 1.0 / s
+    P = F / (3.0 * k * k * G * G)
+    Q = np.sqrt(1.0 + 2.0 * e4 * P)
+    # near the poles the terms under the square root cancel and rounding can make their sum negative;
+    # r0 only enters through (p - e^2 * r0) ** 2 there, so clamping to 0 costs no accuracy
+    r0 = -P * WGS84_E2 * p / (1.0 + Q) \
+        + np.sqrt(np.maximum(a2 / 2.0 * (1.0 + 1.0 / Q) - P * (1.0 - WGS84_E2) * z2 / (Q * (1.0 + Q))
+                             - P * p2 / 2.0, 0.0))
+    tmp = (p - WGS84_E2 * r0) ** 2
+    U = np.sqrt(tmp + z2)
+    V = np.sqrt(tmp + (1.0 - WGS84_E2) * z2)
+    z0 = b2 * z / (WGS84_A * V)
+
+    alt = U * (1.0 - b2 / (WGS84_A * V))
+    lat = np.degrees(np.arctan2(z + WGS84_EP2 * z0, p))
+    lon = np.degrees(np.arctan2(y, x))
+    return lat, lon, alt
+
+
+class LocalFrame(object):
+    """
+    ENU frame tangent to the WGS84 ellipsoid at (lat0, lon0, alt0).
+
+    The ECEF position of the origin and the ECEF-to-ENU rotation are computed
+    once; converting points is then a 3x3 matrix product plus the closed-form
+    ECEF <-> geodetic conversions.
+    """
+    def __init__(self, lat0, lon0, alt0):
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.alt0 = alt0
+
+        self.origin = np.array(geodetic_to_ecef(lat0, lon0, alt0))
+
+        sin_lat, cos_lat = np.sin(np.radians(lat0)), np.cos(np.radians(lat0))
+        sin_lon, cos_lon = np.sin(np.radians(lon0)), np.cos(np.radians(lon0))
+        # rows are the east, north and up directions in ECEF
+        self.rotation = np.array([[-sin_lon, cos_lon, 0.],
+                                  [-sin_lat * cos_lon, -sin_lat * sin_lon, cos_lat],
+                                  [cos_lat * cos_lon, cos_lat * sin_lon, sin_lat]])
+
+    def enu_to_ecef(self, e, n, u):
+        enu = np.stack((np.asarray(e, dtype=np.float64), np.asarray(n, dtype=np.float64),
+                        np.asarray(u, dtype=np.float64)), axis=-1)
+        ecef = np.dot(enu, self.rotation)
+        ecef += self.origin
+        return ecef[..., 0], ecef[..., 1], ecef[..., 2]
+
+    def ecef_to_enu(self, x, y, z):
+        ecef = np.stack((np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+                         np.asarray(z, dtype=np.float64)), axis=-1)
+        ecef -= self.origin
+        enu = np.dot(ecef, self.rotation.T)
+        return enu[..., 0], enu[..., 1], enu[..., 2]
+
+    def enu_to_geodetic(self, e, n, u):
+        return ecef_to_geodetic(*self.enu_to_ecef(e, n, u))
+
+    def geodetic_to_enu(self, lat, lon, alt):
+        return self.ecef_to_enu(*geodetic_to_ecef(np.asarray(lat, dtype=np.float64),
+                                                  np.asarray(lon, dtype=np.float64),
+                                                  np.asarray(alt, dtype=np.float64)))
 
-    xx, yy, zz = enu_to_latlonalt(xx, yy, zz, lat0, lon0, alt0)
+
+# local frame of each aoi.json already read
+_local_frame_cache = {}
+
+
+def get_local_frame(work_dir):
+    origin = get_enu_origin(work_dir)
+    if origin not in _local_frame_cache:
+        _local_frame_cache[origin] = LocalFrame(*origin)
+    return _local_frame_cache[origin]
+
+
+# global: (xx, yy, zz) = (lat, lon, alt)
+# local: enu
+
+def local_to_global(work_dir, xx, yy, zz):
+    xx, yy, zz = get_local_frame(work_dir).enu_to_geodetic(xx, yy, zz)
 
     return xx, yy, zz
 
 
 def global_to_local(work_dir, xx, yy, zz):
-    with open(os.path.join(work_dir, 'aoi.json')) as fp:
-        bbx = json.load(fp)
+    xx, yy, zz = get_local_frame(work_dir).geodetic_to_enu(xx, yy, zz)
 
-    lat0 = (bbx['lat_min'] + bbx['lat_max']) / 2.0
-    lon0 = (bbx['lon_min'] + bbx['lon_max']) / 2.0
-    alt0 = bbx['alt_min']
+    return xx, yy, zz
 
-    xx, yy, zz = latlonalt_to_enu(xx, yy, zz, lat0, lon0, alt0)
 
-    return xx, yy, zz
+# local: enu
+# utm: (east, north, alt) in the utm zone of aoi.json; alt is the height above the ellipsoid
+# the conversion is done chunk by chunk so that the intermediate arrays stay in cache
+def local_to_utm(work_dir, xx, yy, zz, chunk_size=65536):
+    frame = get_local_frame(work_dir)
+    aoi_dict = get_aoi(work_dir)
+    zone_number, hemisphere = aoi_dict['zone_number'], aoi_dict['hemisphere']
+
+    xx, yy, zz = np.broadcast_arrays(np.asarray(xx, dtype=np.float64), np.asarray(yy, dtype=np.float64),
+                                     np.asarray(zz, dtype=np.float64))
+    shape = xx.shape
+    xx, yy, zz = xx.ravel(), yy.ravel(), zz.ravel()
+    east = np.empty(xx.size)
+    north = np.empty(xx.size)
+    alt = np.empty(xx.size)
+    for start in range(0, xx.size, chunk_size):
+        end = min(start + chunk_size, xx.size)
+        lat, lon, alt[start:end] = frame.enu_to_geodetic(xx[start:end], yy[start:end], zz[start:end])
+        east[start:end], north[start:end] = latlon_to_utm(lat, lon, zone_number, hemisphere)
+
+    return east.reshape(shape), north.reshape(shape), alt.reshape(shape)
+
+
+if __name__ == '__main__':
+    # timing against pymap3d; the accuracy is tested in tests/test_coordinate_system.py
+    import pymap3d
+    import time
+    import logging
+
+    logging.basicConfig(level=logging.INFO)
+
+    lat0, lon0, alt0 = -34.448, -58.577, -30.0
+    frame = LocalFrame(lat0, lon0, alt0)
+
+    rng = np.random.RandomState(0)
+    point_cnt = 10 ** 6
+    e = rng.uniform(-5000., 5000., point_cnt)
+    n = rng.uniform(-5000., 5000., point_cnt)
+    u = rng.uniform(-100., 500., point_cnt)
+
+    start = time.time()
+    frame.enu_to_geodetic(e, n, u)
+    frame_time = time.time() - start
+    start = time.time()
+    lat_ref, lon_ref, alt_ref = pymap3d.enu2geodetic(e, n, u, lat0, lon0, alt0)
+    pymap3d_time = time.time() - start
+    logging.info('enu -> geodetic, LocalFrame: {:.3f} s, pymap3d: {:.3f} s'.format(frame_time, pymap3d_time))
+
+    start = time.time()
+    frame.geodetic_to_enu(lat_ref, lon_ref, alt_ref)
+    frame_time = time.time() - start
+    start = time.time()
+    pymap3d.geodetic2enu(lat_ref, lon_ref, alt_ref, lat0, lon0, alt0)
+    pymap3d_time = time.time() - start
+    logging.info('geodetic -> enu, LocalFrame: {:.3f} s, pymap3d: {:.3f} s'.format(frame_time, pymap3d_time))
@@ -41,6 +41,7 @@ from colmap.extract_sfm import extract_all_to_dir
 from colmap.extract_raw_matches import extract_raw_matches
 import json
 import imageio
+from scipy.ndimage import maximum_filter
 
 
 def plot_reproj_err(reproj_errs, fpath):
@@ -80,7 +81,7 @@ def vector_angle(vec1, vec2):
 
 
 class SparseInspector(object):
-    def __init__(self, sparse_dir, db_path, out_dir, camera_model, ext='.txt'):
+    def __init__(self, sparse_dir, db_path, out_dir, camera_model, ext=None):
         assert (camera_model == 'PINHOLE' or camera_model == 'PERSPECTIVE')
         self.camera_model = camera_model
         self.out_dir = out_dir
@@ -90,17 +91,27 @@ class SparseInspector(object):
         self.db_path = db_path
 
         # extract colmap sfm results
-        extract_all_to_dir(sparse_dir, self.out_dir, ext)
+        _, colmap_images, colmap_points3D = extract_all_to_dir(sparse_dir, self.out_dir, ext)
         with open(os.path.join(self.out_dir, 'kai_cameras.json')) as fp:
             camera_params = json.load(fp)
 
-        self.points = np.loadtxt(os.path.join(self.out_dir, 'kai_points.txt'))
-
-        with open(os.path.join(self.out_dir, 'kai_tracks.json')) as fp:
-            self.tracks = json.load(fp)
-
-        with open(os.path.join(self.out_dir, 'kai_keypoints.json')) as fp:
-            self.view_keypoints = json.load(fp)
+        # x, y, z, reproj_err, track_len, color(RGB)
+        track_len = colmap_points3D.track_lengths()
+        self.points = np.hstack((colmap_points3D.xyz, colmap_points3D.error.reshape((-1, 1)),
+                                 track_len.reshape((-1, 1)), colmap_points3D.rgb))
+
+        # triangulated key points of each view: u, v, x, y, z, track_len
+        obs_point = colmap_points3D.observation_points()
+        obs_row = colmap_images.rows(colmap_points3D.image_ids)
+        obs_keypoint = colmap_images.keypoint_offsets[obs_row] + colmap_points3D.point2D_idxs
+        order = np.argsort(obs_row, kind='stable')
+        bounds = np.searchsorted(obs_row[order], np.arange(len(colmap_images) + 1))
+        self.view_keypoints = {}
+        for i, img_name in enumerate(colmap_images.names):
+            idx = order[bounds[i]:bounds[i + 1]]
+            self.view_keypoints[img_name] = np.hstack((colmap_images.xys[obs_keypoint[idx]],
+                                                       colmap_points3D.xyz[obs_point[idx]],
+                                                       track_len[obs_point[idx]].reshape((-1, 1))))
 
         self.img_names = sorted(camera_params.keys())
         self.camera_mats = {}
@@ -165,33 +176,30 @@ class SparseInspector(object):
             cnt = len(keypoints)
             used_keypoint_cnt[idx] = cnt
 
-            reproj_errs = np.zeros((cnt, ))
-            track_lens = np.zeros((cnt, ))
-            depth_ranges = np.zeros((cnt, ))
             K, R, tvec = self.camera_mats[img_name]
             w, h = self.img_sizes[img_name]
-            location_image = np.zeros((h, w), dtype=np.uint8)
-            for key_point_idx, key_point in enumerate(keypoints):
-                u, v, x, y, z, track_len = key_point
-                xyz = np.array([x, y, z]).reshape((3, 1))
-                xyz = np.dot(R, xyz) + tvec
-                
-                depth_ranges[key_point_idx] = xyz[2, 0]
-
-                tmp = np.dot(K, xyz)
-                u1 = tmp[0, 0] / tmp[2, 0]
-                v1 = tmp[1, 0] / tmp[2, 0]
-                err = np.sqrt((u - u1) ** 2 + (v - v1) ** 2)
-                reproj_errs[key_point_idx] = err
-
-                track_lens[key_point_idx] = track_len
-
-                radius = 5
-                col_idx1 = max([int(u) - radius, 0])
-                col_idx2 = min([int(u) + radius, w-1])
-                row_idx1 = max([int(v) - radius, 0])
-                row_idx2 = min([int(v) + radius, h-1])
-                location_image[row_idx1:row_idx2+1, col_idx1:col_idx2+1] = 255
+            u = keypoints[:, 0]
+            v = keypoints[:, 1]
+            xyz = np.dot(keypoints[:, 2:5], R.T) + tvec.T
+
+            depth_ranges = xyz[:, 2]
+
+            tmp = np.dot(xyz, K.T)
+            u1 = tmp[:, 0] / tmp[:, 2]
+            v1 = tmp[:, 1] / tmp[:, 2]
+            reproj_errs = np.sqrt((u - u1) ** 2 + (v - v1) ** 2)
+
+            track_lens = keypoints[:, 5]
+
+            # mark a (2 * radius + 1) square around each key point
+            radius = 5
+            col = u.astype(np.int64) + radius
+            row = v.astype(np.int64) + radius
+            mask = (col >= 0) & (col < w + 2 * radius) & (row >= 0) & (row < h + 2 * radius)
+            location_image = np.zeros((h + 2 * radius, w + 2 * radius), dtype=np.uint8)
+            location_image[row[mask], col[mask]] = 255
+            location_image = maximum_filter(location_image, size=2 * radius + 1, mode='constant')
+            location_image = location_image[radius:radius + h, radius:radius + w]
 
             locations.append(location_image)
             view_reproj_errs[idx, :] = (np.mean(reproj_errs), np.median(reproj_errs))
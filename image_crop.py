@@ -32,25 +32,46 @@
 
 # cut the AOI out of the big satellite image
 
-from lib.rpc_model import RPCModel
-from lib.parse_meta import parse_meta
+from lib.rpc_model import RPCModel, RPCModelBatch
+from lib.meta_index import MetaIndex
+from lib.footprint_index import FootprintIndex
 from lib.gen_grid import gen_grid
-from lib.check_bbx import check_bbx
-from lib.tone_map import tone_map
+from lib.tone_map import tone_map_array, compute_histogram, tone_map_lut, apply_lut
 import utm
+import imageio
+from osgeo import gdal
 import json
 import numpy as np
 import shutil
-from lib.blank_ratio import blank_ratio
+from lib.blank_ratio import blank_ratio_array, blank_ratio_hist
+from lib.browse_screen import browse_coverage
+from lib.png_writer import PNGStripWriter
 import multiprocessing
 import glob
-import dateutil.parser
 import os
-from lib.run_cmd import run_cmd
 import logging
 
 
-def crop_ntf(in_ntf, out_png, ntf_size, bbx_size):
+def read_ntf_window(band, ul_col, ul_row, width, height):
+    """
+    Reads a window of the ntf band into a uint16 array.
+
+    The window is read strip by strip, each strip spanning whole rows of
+    the file's blocks, so that GDAL decodes every block once.
+    """
+    block_height = band.GetBlockSize()[1]
+
+    im = np.empty((height, width), dtype=np.uint16)
+    row = ul_row
+    while row < ul_row + height:
+        # end of the block row containing the current row
+        next_row = min((row // block_height + 1) * block_height, ul_row + height)
+        band.ReadAsArray(ul_col, row, width, next_row - row, buf_obj=im[row - ul_row:next_row - ul_row, :])
+        row = next_row
+    return im
+
+
+def check_crop_bbx(in_ntf, ntf_size, bbx_size):
     (ntf_width, ntf_height) = ntf_size
     (ul_col, ul_row, width, height) = bbx_size
 
@@ -61,16 +82,75 @@ def crop_ntf(in_ntf, out_png, ntf_size, bbx_size):
     logging.info('ntf image to cut: {}, width, height: {}, {}'.format(in_ntf, ntf_width, ntf_height))
     logging.info('cut image bounding box, ul_col, ul_row, width, height: {}, {}, {}, {}'.format(ul_col, ul_row,
                                                                                                 width, height))
-    logging.info('png image to save: {}'.format(out_png))
 
-    # note the coordinate system of .ntf
-    cmd = 'gdal_translate -of png -ot UInt16 -srcwin {} {} {} {} {} {}' \
-        .format(ul_col, ul_row, width, height, in_ntf, out_png)
-    run_cmd(cmd)
-    os.remove('{}.aux.xml'.format(out_png))
 
+def crop_ntf(in_ntf, ntf_size, bbx_size):
+    """
+    Reads the bounding box of the ntf image into a uint16 array.
+    """
+    check_crop_bbx(in_ntf, ntf_size, bbx_size)
+
+    ds = gdal.Open(in_ntf, gdal.GA_ReadOnly)
+    im = read_ntf_window(ds.GetRasterBand(1), *bbx_size)     # band index is one-based
+    del ds
+    return im
+
+
+def crop_ntf_tiled(in_ntf, ntf_size, bbx_size, tile_size, out_png, blank_thres=0.2):
+    """
+    Crops and tone maps the bounding box of the ntf image into out_png,
+    holding at most one 16-bit tile and one 8-bit strip of tile_size rows
+    in memory.
+
+    The first pass over the tiles accumulates the histogram, which gives both
+    the tone mapping lookup table and the blank ratio; the second pass maps
+    the tiles strip by strip, and appends each strip to the png file. The
+    second pass is skipped, and nothing is written, if the blank ratio is
+    above blank_thres.
+
+    Returns:
+        the blank ratio
+    """
+    check_crop_bbx(in_ntf, ntf_size, bbx_size)
+    (ul_col, ul_row, width, height) = bbx_size
+
+    tiles = [(col, row, min(tile_size, width - col), min(tile_size, height - row))
+             for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+    logging.info('tone mapping {} tiles of size {}'.format(len(tiles), tile_size))
 
-def image_crop_worker(ntf_file, xml_file, n, total_cnt, utm_bbx_file, out_dir, result_file):
+    ds = gdal.Open(in_ntf, gdal.GA_ReadOnly)
+    band = ds.GetRasterBand(1)     # band index is one-based
+
+    hist = None
+    for col, row, tile_width, tile_height in tiles:
+        hist = compute_histogram(read_ntf_window(band, ul_col + col, ul_row + row, tile_width, tile_height), hist)
+    lut = tone_map_lut(hist)
+
+    ratio = blank_ratio_hist(hist, lut)
+    if ratio > blank_thres:
+        del ds
+        return ratio
+
+    writer = PNGStripWriter(out_png, width, height)
+    try:
+        for row in range(0, height, tile_size):
+            strip_height = min(tile_size, height - row)
+            strip = np.empty((strip_height, width), dtype=np.uint8)
+            for col in range(0, width, tile_size):
+                tile_width = min(tile_size, width - col)
+                tile = read_ntf_window(band, ul_col + col, ul_row + row, tile_width, strip_height)
+                strip[:, col:col + tile_width] = apply_lut(lut, tile)
+            writer.write(strip)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        del ds
+    return ratio
+
+
+def aoi_latlonalt_grid(utm_bbx_file):
     with open(utm_bbx_file) as fp:
         utm_bbx = json.load(fp)
     ul_easting = utm_bbx['ul_easting']
@@ -88,127 +168,163 @@ def image_crop_worker(ntf_file, xml_file, n, total_cnt, utm_bbx_file, out_dir, r
     lat_points = np.array([ul_lat, lr_lat])
     lon_points = np.array([ul_lon, lr_lon])
     alt_points = np.array([alt_min, alt_max])
-    xx_lat, yy_lon, zz_alt = gen_grid(lat_points, lon_points, alt_points)
-
-    pid = os.getpid()
-    effective_file_list = []
-    logging.info('process {}, cropping {}/{}, ntf: {}'.format(pid, n, total_cnt, ntf_file))
-    try:
-        meta_dict = parse_meta(xml_file)
-        # check whether the image is too cloudy
-        cloudy_thres = 0.5
-        if meta_dict['cloudCover'] > cloudy_thres:
+    return gen_grid(lat_points, lon_points, alt_points)
+
+
+def prefilter_scenes(ntf_list, meta_dict_list, footprints, utm_bbx_file, cloudy_thres=0.5, overlap_thres=0.8):
+    """
+    Selects the scenes to crop, before any image is opened.
+
+    Args:
+        ntf_list: list of ntf files
+        meta_dict_list: their parsed meta_dict
+        footprints: their (min_lat, max_lat, min_lon, max_lon) ground footprints
+        utm_bbx_file: aoi.json
+
+    Returns:
+        list of (ntf_file, meta_dict, (ul_col, ul_row, width, height)); the bounding box is the part of the
+        AOI's projection that lies inside the image
+    """
+    xx_lat, yy_lon, zz_alt = aoi_latlonalt_grid(utm_bbx_file)
+
+    # scenes whose footprint misses the AOI
+    footprint_index = FootprintIndex(footprints)
+    candidates = footprint_index.query(np.min(xx_lat), np.max(xx_lat), np.min(yy_lon), np.max(yy_lon))
+    logging.info('{}/{} scenes intersect the AOI'.format(len(candidates), len(ntf_list)))
+
+    # check whether the images are too cloudy
+    selected = []
+    for i in candidates:
+        if meta_dict_list[i]['cloudCover'] > cloudy_thres:
             logging.warning('discarding this image because of too many clouds, cloudy level: {}, ntf: {}'
-                            .format(meta_dict['cloudCover'], ntf_file))
-            return
-
-        # compute the bounding box
-        rpc_model = RPCModel(meta_dict)
-        col, row = rpc_model.projection(xx_lat, yy_lon, zz_alt)
-
-        ul_col = int(np.round(np.min(col)))
-        ul_row = int(np.round(np.min(row)))
-        width = int(np.round(np.max(col))) - ul_col + 1
-        height = int(np.round(np.max(row))) - ul_row + 1
-
-        # check whether the bounding box lies in the image
-        ntf_width = meta_dict['width']
-        ntf_height = meta_dict['height']
-        intersect, _, overlap = check_bbx((0, 0, ntf_width, ntf_height),
-                                          (ul_col, ul_row, width, height))
-        overlap_thres = 0.8
-        if overlap < overlap_thres:
+                            .format(meta_dict_list[i]['cloudCover'], ntf_list[i]))
+            continue
+        selected.append(i)
+    if len(selected) == 0:
+        return []
+
+    # project the AOI corners into all the remaining images at once
+    rpc_batch = RPCModelBatch([RPCModel(meta_dict_list[i]) for i in selected])
+    col, row = rpc_batch.projection(xx_lat, yy_lon, zz_alt)
+
+    ul_col = np.round(np.min(col, axis=0)).astype(np.int64)
+    ul_row = np.round(np.min(row, axis=0)).astype(np.int64)
+    width = np.round(np.max(col, axis=0)).astype(np.int64) - ul_col + 1
+    height = np.round(np.max(row, axis=0)).astype(np.int64) - ul_row + 1
+
+    # check whether the bounding boxes lie in the images; same as check_bbx, vectorized over the images
+    inter_ul_col = np.maximum(ul_col, 0)
+    inter_ul_row = np.maximum(ul_row, 0)
+    inter_w = np.minimum(ul_col + width, rpc_batch.width.astype(np.int64)) - inter_ul_col
+    inter_h = np.minimum(ul_row + height, rpc_batch.height.astype(np.int64)) - inter_ul_row
+    # check_bbx reports no intersection when the boxes only share their border
+    intersect = (inter_w > 1) & (inter_h > 1)
+    overlap = np.where(intersect, inter_w * inter_h / (width * height).astype(np.float64), 0.)
+
+    scenes = []
+    for k, i in enumerate(selected):
+        if overlap[k] < overlap_thres:
             logging.warning('discarding this image due to small coverage of target area, overlap: {}, ntf: {}'
-                            .format(overlap, ntf_file))
-            return
-
-        ul_col, ul_row, width, height = intersect
-
-        # crop ntf
-        idx1 = ntf_file.rfind('/')
-        idx2 = ntf_file.rfind('.')
-        base_name = ntf_file[idx1+1:idx2]
-        out_png = os.path.join(out_dir, '{}:{:04d}:{}.png'.format(pid, n, base_name))
-
-        crop_ntf(ntf_file, out_png, (ntf_width, ntf_height), (ul_col, ul_row, width, height))
+                            .format(overlap[k], ntf_list[i]))
+            continue
+        bbx = (int(inter_ul_col[k]), int(inter_ul_row[k]), int(inter_w[k]), int(inter_h[k]))
+        scenes.append((ntf_list[i], meta_dict_list[i], bbx))
+    return scenes
+
+
+def image_crop_worker(ntf_file, meta_dict, bbx, n, total_cnt, out_dir, tile_size=None):
+    """
+    Returns:
+        None if the image is discarded, otherwise a record with the png written to out_dir under a temporary
+        name, the cropped meta_dict, the capture time and the sensor id
+    """
+    pid = os.getpid()
+    logging.info('process {}, cropping {}/{}, ntf: {}'.format(pid, n, total_cnt, ntf_file))
+    rpc_model = RPCModel(meta_dict)
+    ntf_width = meta_dict['width']
+    ntf_height = meta_dict['height']
+    ul_col, ul_row, width, height = bbx
+
+    # crop ntf
+    idx1 = ntf_file.rfind('/')
+    idx2 = ntf_file.rfind('.')
+    base_name = ntf_file[idx1+1:idx2]
+    # temporary name; the parent renames it once the chronological order is known
+    out_png = os.path.join(out_dir, '.tmp_{:04d}_{}.png'.format(n, base_name))
+
+    # pre-screen with the browse image; the thresholds are loose as the browse image is coarse,
+    # the full resolution blank ratio below remains the actual test
+    coverage = browse_coverage(ntf_file[:-4] + '-BROWSE.JPG', (ntf_width, ntf_height),
+                               (ul_col, ul_row, width, height))
+    if coverage is not None:
+        browse_blank, browse_cloud = coverage
+        if browse_blank > 0.5 or browse_cloud > 0.7:
+            logging.warning('discarding this image after browse pre-screening, blank ratio: {}, '
+                            'cloud-like ratio: {}, ntf: {}'.format(browse_blank, browse_cloud, ntf_file))
+            return None
+
+    blank_thres = 0.2
+    if tile_size is not None and width * height > tile_size * tile_size:
+        # the png is written strip by strip, unless the image is discarded
+        ratio = crop_ntf_tiled(ntf_file, (ntf_width, ntf_height), (ul_col, ul_row, width, height),
+                               tile_size, out_png, blank_thres=blank_thres)
+        im = None
+    else:
+        im = crop_ntf(ntf_file, (ntf_width, ntf_height), (ul_col, ul_row, width, height))
 
         # tone mapping
-        tone_map(out_png, out_png)
-
-        ratio = blank_ratio(out_png)
-        if ratio > 0.2:
-            logging.warning('discarding this image due to large portion of black pixels, ratio: {}, ntf: {}'
-                            .format(ratio, ntf_file))
-            os.remove(out_png)
-            return
-
-        # save meta_dict
-        # subtract the cutting offset here
-        rpc_dict = meta_dict['rpc']
-        rpc_dict['colOff'] = rpc_dict['colOff'] - ul_col
-        rpc_dict['rowOff'] = rpc_dict['rowOff'] - ul_row
-        meta_dict['rpc'] = rpc_dict
-        # modify width, height
-        meta_dict['width'] = width
-        meta_dict['height'] = height
-        # change datetime object to string
-        meta_dict['capTime'] = meta_dict['capTime'].isoformat()
-
-        meta_dict['ul_col_original'] = ul_col
-        meta_dict['ul_row_original'] = ul_row
-
-        out_json = os.path.join(out_dir, '{}:{:04d}:{}.json'.format(pid, n, base_name))
-        with open(out_json, 'w') as fp:
-            json.dump(meta_dict, fp, indent=2)
-        effective_file_list.append((out_png, out_json))
+        im = tone_map_array(im)
 
-    finally:
-        with open(result_file, 'w') as fp:
-            json.dump(effective_file_list, fp, indent=2)
+        ratio = blank_ratio_array(im)
+    if ratio > blank_thres:
+        logging.warning('discarding this image due to large portion of black pixels, ratio: {}, ntf: {}'
+                        .format(ratio, ntf_file))
+        return None
 
-
-def image_crop(work_dir):
+    logging.info('png image to save: {}'.format(out_png))
+    if im is not None:
+        imageio.imwrite(out_png, im)
+
+    # save meta_dict
+    # the camera of the cropped image; this subtracts the cutting offset
+    crop_meta_dict = rpc_model.crop(ul_col, ul_row, width, height).to_meta_dict()
+    meta_dict['rpc'] = crop_meta_dict['rpc']
+    # modify width, height
+    meta_dict['width'] = width
+    meta_dict['height'] = height
+    # change datetime object to string
+    cap_time = meta_dict['capTime']
+    meta_dict['capTime'] = cap_time.isoformat()
+
+    meta_dict['ul_col_original'] = ul_col
+    meta_dict['ul_row_original'] = ul_row
+
+    return {'img_file': out_png,
+            'base_name': base_name,
+            'capTime': cap_time,
+            'sensor_id': meta_dict['sensor_id'],
+            'meta_dict': meta_dict}
+
+
+def image_crop(work_dir, meta_index_file=None, tile_size=None):
     cleaned_data_dir = os.path.join(work_dir, 'cleaned_data')
     ntf_list = glob.glob('{}/*.NTF'.format(cleaned_data_dir))
     xml_list = [item[:-4] + '.XML' for item in ntf_list]
 
-    # create a tmp dir
-    tmp_dir = os.path.join(work_dir, 'tmp')
-    if not os.path.exists(tmp_dir):
-        os.mkdir(tmp_dir)
-
-    pool = multiprocessing.Pool(multiprocessing.cpu_count())
-    result_file_list = []
-    cnt = len(ntf_list)
-    for i in range(cnt):
-        ntf_file = ntf_list[i]
-        xml_file = xml_list[i]
-
-        utm_bbx_file = os.path.join(work_dir, 'aoi.json')
-        out_dir = tmp_dir
-        result_file = os.path.join(tmp_dir, 'image_crop_result_{}.json'.format(i))
-        result_file_list.append(result_file)
-        pool.apply_async(image_crop_worker, (ntf_file, xml_file, i, cnt, utm_bbx_file, out_dir, result_file))
-    pool.close()
-    pool.join()
+    # the xml files are parsed only once, and only if they are not in the index yet
+    if meta_index_file is None:
+        meta_index_file = os.path.join(cleaned_data_dir, 'meta_index.db')
+    # the files missing from the index are parsed on a process pool
+    meta_index = MetaIndex(meta_index_file)
+    lookups = meta_index.lookup_many(xml_list)
+    meta_index.close()
+    meta_dict_list = [x[0] for x in lookups]
+    footprints = [x[1] for x in lookups]
 
-    # now try to merge the cropping result
-    all_files = []
-    for result_file in result_file_list:
-        with open(result_file) as fp:
-            all_files += json.load(fp)
+    # only the scenes covering the AOI get scheduled
+    utm_bbx_file = os.path.join(work_dir, 'aoi.json')
+    scenes = prefilter_scenes(ntf_list, meta_dict_list, footprints, utm_bbx_file)
 
-    # sort the files in chronological order
-    cap_times = {}
-    sensor_ids = {}
-    for img_file, meta_file in all_files:
-        with open(meta_file) as fp:
-            meta_dict = json.load(fp)
-        cap_times[img_file] = dateutil.parser.parse(meta_dict['capTime'])
-        sensor_ids[img_file] = meta_dict['sensor_id']
-    all_files = sorted(all_files, key=lambda x: cap_times[x[0]])
-
-    # copy data to target dir and prepend with increasing index
     images_subdir = os.path.join(work_dir, 'images')
     metas_subdir = os.path.join(work_dir, 'metas')
     for subdir in [images_subdir, metas_subdir]:
@@ -216,22 +332,43 @@ def image_crop(work_dir):
             shutil.rmtree(subdir)
         os.mkdir(subdir)
 
-    for i in range(len(all_files)):
-        img_file, meta_file = all_files[i]
-        idx = img_file.rfind(':')
-        sensor = sensor_ids[img_file]
-        time = img_file[idx+1:idx+8]
-        target_img_name = '{:04d}_{}_{}_{}'.format(i, sensor, time, img_file[idx+8:])
+    # the workers write the images directly into images_subdir, and return the records through the pool
+    pool = multiprocessing.Pool(multiprocessing.cpu_count())
+    results = []
+    cnt = len(scenes)
+    for i in range(cnt):
+        ntf_file, meta_dict, bbx = scenes[i]
+        results.append(pool.apply_async(image_crop_worker,
+                                        (ntf_file, meta_dict, bbx, i, cnt, images_subdir, tile_size)))
+    pool.close()
+    pool.join()
+
+    records = []
+    for i in range(cnt):
+        try:
+            record = results[i].get()
+        except Exception as e:
+            logging.error('failed to crop {}: {}'.format(scenes[i][0], e))
+            continue
+        if record is not None:
+            records.append(record)
+
+    # sort the files in chronological order
+    records = sorted(records, key=lambda x: x['capTime'])
 
-        idx = meta_file.rfind(':')
-        time = img_file[idx+1:idx+8]
-        target_xml_name = '{:04d}_{}_{}_{}'.format(i, sensor, time, meta_file[idx+8:])
+    # rename the images and write the metas, prepending increasing index
+    for i in range(len(records)):
+        record = records[i]
+        base_name = record['base_name']
+        target_name = '{:04d}_{}_{}_{}'.format(i, record['sensor_id'], base_name[:7], base_name[7:])
 
-        shutil.copyfile(img_file, os.path.join(images_subdir, target_img_name))
-        shutil.copyfile(meta_file, os.path.join(metas_subdir, target_xml_name))
+        os.replace(record['img_file'], os.path.join(images_subdir, target_name + '.png'))
+        with open(os.path.join(metas_subdir, target_name + '.json'), 'w') as fp:
+            json.dump(record['meta_dict'], fp, indent=2)
 
-    # remove tmp_dir
-    shutil.rmtree(tmp_dir)
+    # images left behind by failed workers
+    for item in glob.glob(os.path.join(images_subdir, '.tmp_*')):
+        os.remove(item)
 
 
 if __name__ == '__main__':
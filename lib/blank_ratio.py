@@ -34,7 +34,18 @@ import numpy as np
 import imageio
 
 
-def blank_ratio(img_path, thres=1e-3):
-    im = imageio.imread(img_path).astype(dtype=np.float64) / 255.0
+def blank_ratio_array(im, thres=1e-3):
+    im = im.astype(dtype=np.float64) / 255.0
 
     return np.sum(im < thres) / im.size
+
+
+# blank ratio of the 8-bit image obtained by applying the lookup table lut to an image of histogram hist
+def blank_ratio_hist(hist, lut, thres=1e-3):
+    blank = lut.astype(dtype=np.float64) / 255.0 < thres
+
+    return np.sum(hist[blank]) / np.sum(hist)
+
+
+def blank_ratio(img_path, thres=1e-3):
+    return blank_ratio_array(imageio.imread(img_path), thres)
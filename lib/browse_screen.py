@@ -0,0 +1,77 @@
+#  ===============================================================================================================
+#  Copyright (c) 2019, Cornell University. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without modification, are permitted provided that
+#  the following conditions are met:
+#
+#      * Redistributions of source code must retain the above copyright otice, this list of conditions and
+#        the following disclaimer.
+#
+#      * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and
+#        the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#      * Neither the name of Cornell University nor the names of its contributors may be used to endorse or
+#        promote products derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+#  WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+#  OF SUCH DAMAGE.
+#
+#  Author: Kai Zhang (kz298@cornell.edu)
+#
+#  The research is based upon work supported by the Office of the Director of National Intelligence (ODNI),
+#  Intelligence Advanced Research Projects Activity (IARPA), via DOI/IBC Contract Number D17PC00287.
+#  The U.S. Government is authorized to reproduce and distribute copies of this work for Governmental purposes.
+#  ===============================================================================================================
+
+
+# estimate the no-data and cloud coverage of a crop from the low resolution browse image delivered with the ntf
+
+import numpy as np
+import imageio
+import os
+
+
+def browse_coverage(jpg_file, ntf_size, bbx_size, blank_level=3, cloud_level=245):
+    """
+    Args:
+        jpg_file: the -BROWSE.JPG of the ntf
+        ntf_size: (width, height) of the full resolution image
+        bbx_size: (ul_col, ul_row, width, height) of the crop in the full resolution image
+        blank_level: browse pixels at or below this level are counted as no-data;
+            it leaves a margin for jpeg compression artifacts
+        cloud_level: browse pixels at or above this level are counted as cloud-like
+
+    Returns:
+        (blank ratio, cloud ratio) inside the crop, or None if the browse image
+        is missing or the crop covers too few browse pixels to tell
+    """
+    if not os.path.exists(jpg_file):
+        return None
+
+    im = imageio.imread(jpg_file)
+    if im.ndim == 3:
+        im = np.mean(im[:, :, :3], axis=2)
+
+    # the browse image is a scaled down version of the whole ntf
+    (ntf_width, ntf_height) = ntf_size
+    (ul_col, ul_row, width, height) = bbx_size
+    scale_x = im.shape[1] / float(ntf_width)
+    scale_y = im.shape[0] / float(ntf_height)
+    col1 = int(np.floor(ul_col * scale_x))
+    row1 = int(np.floor(ul_row * scale_y))
+    col2 = int(np.ceil((ul_col + width) * scale_x))
+    row2 = int(np.ceil((ul_row + height) * scale_y))
+
+    region = im[max(row1, 0):row2, max(col1, 0):col2]
+    if region.size < 64:
+        return None
+
+    blank = np.sum(region <= blank_level) / region.size
+    cloud = np.sum(region >= cloud_level) / region.size
+    return blank, cloud
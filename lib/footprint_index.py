@@ -0,0 +1,82 @@
+#  ===============================================================================================================
+#  Copyright (c) 2019, Cornell University. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without modification, are permitted provided that
+#  the following conditions are met:
+#
+#      * Redistributions of source code must retain the above copyright otice, this list of conditions and
+#        the following disclaimer.
+#
+#      * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and
+#        the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#      * Neither the name of Cornell University nor the names of its contributors may be used to endorse or
+#        promote products derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+#  WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+#  OF SUCH DAMAGE.
+#
+#  Author: Kai Zhang (kz298@cornell.edu)
+#
+#  The research is based upon work supported by the Office of the Director of National Intelligence (ODNI),
+#  Intelligence Advanced Research Projects Activity (IARPA), via DOI/IBC Contract Number D17PC00287.
+#  The U.S. Government is authorized to reproduce and distribute copies of this work for Governmental purposes.
+#  ===============================================================================================================
+
+
+# in-memory index of the ground footprints of a set of images, for finding the scenes that may cover an AOI
+
+import numpy as np
+
+
+class FootprintIndex(object):
+    """
+    Sorted interval index over lat/lon bounding boxes.
+
+    The boxes are sorted by their minimum latitude; a query only scans the
+    slice of boxes whose minimum latitude can still reach the query range,
+    then tests the remaining intervals with vectorized comparisons.
+    """
+    def __init__(self, footprints):
+        """
+        Args:
+            footprints: (N, 4) array of (min_lat, max_lat, min_lon, max_lon)
+        """
+        footprints = np.asarray(footprints, dtype=np.float64).reshape((-1, 4))
+        self.order = np.argsort(footprints[:, 0], kind='stable')
+        self.footprints = footprints[self.order]
+        if len(self.footprints) > 0:
+            self.max_lat_extent = np.max(self.footprints[:, 1] - self.footprints[:, 0])
+        else:
+            self.max_lat_extent = 0.
+
+    def __len__(self):
+        return len(self.footprints)
+
+    def query(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns:
+            sorted indices (into the input footprints) of the boxes intersecting the query box
+        """
+        # boxes starting below min_lat - max_lat_extent end before min_lat
+        idx1 = np.searchsorted(self.footprints[:, 0], min_lat - self.max_lat_extent, side='left')
+        idx2 = np.searchsorted(self.footprints[:, 0], max_lat, side='right')
+        candidates = self.footprints[idx1:idx2]
+        mask = (candidates[:, 1] >= min_lat) & (candidates[:, 2] <= max_lon) & (candidates[:, 3] >= min_lon)
+        return np.sort(self.order[idx1:idx2][mask])
+
+
+if __name__ == '__main__':
+    footprints = np.array([[0., 1., 0., 1.],
+                           [0.5, 2., 0.5, 2.],
+                           [3., 4., 3., 4.],
+                           [-1., 0.2, 0.8, 1.5]])
+    index = FootprintIndex(footprints)
+    print(index.query(0.1, 0.6, 0.9, 1.2))
+    print(index.query(2.5, 3.5, 2.5, 3.5))
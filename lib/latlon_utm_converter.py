@@ -33,34 +33,64 @@
 import utm
 import numpy as np
 import pyproj
+import logging
+from functools import lru_cache
 
 
-# pyproj implementation of the coordinate conversion
-def latlon_to_eastnorh(lat, lon):
-    # assume all the points are either on north or south hemisphere
-    assert(np.all(lat >= 0) or np.all(lat < 0))
-
-    if lat[0, 0] >= 0: # north hemisphere
-        south = False
+# transformers are expensive to construct, so keep them for each (zone, hemisphere, direction)
+@lru_cache(maxsize=32)
+def get_transformer(zone_number, hemisphere, inverse=False):
+    utm_crs = 'EPSG:{}'.format((32600 if hemisphere == 'N' else 32700) + int(zone_number))
+    if inverse:
+        return pyproj.Transformer.from_crs(utm_crs, 'EPSG:4326', always_xy=True)
     else:
-        south = True
+        return pyproj.Transformer.from_crs('EPSG:4326', utm_crs, always_xy=True)
+
+
+def choose_utm_zone(lat, lon):
+    # pick a single zone for all the points: the one containing the center of their bounding box;
+    # points in the neighbouring zones are projected with this zone too, which is what we want for one aoi
+    lat_min, lat_max = np.min(lat), np.max(lat)
+    lon_min, lon_max = np.min(lon), np.max(lon)
+    _, _, zone_number, _ = utm.from_latlon((lat_min + lat_max) / 2.0, (lon_min + lon_max) / 2.0)
+    hemisphere = 'N' if (lat_min + lat_max) / 2.0 >= 0 else 'S'
+
+    _, _, zone_min, _ = utm.from_latlon(lat_min, lon_min)
+    _, _, zone_max, _ = utm.from_latlon(lat_max, lon_max)
+    if zone_min != zone_max or (lat_min < 0 <= lat_max):
+        logging.warning('points span utm zones {}{} to {}{}, projecting all of them to zone {}{}'.format(
+            zone_min, 'N' if lat_min >= 0 else 'S', zone_max, 'N' if lat_max >= 0 else 'S', zone_number, hemisphere))
 
-    _, _, zone_number, _ = utm.from_latlon(lat[0, 0], lon[0, 0])
+    return zone_number, hemisphere
 
-    proj = pyproj.Proj(proj='utm', ellps='WGS84', zone=zone_number, south=south)
-    east, north = proj(lon, lat)
+
+# lat, lon, east, north are flat float64 arrays
+def latlon_to_utm(lat, lon, zone_number, hemisphere):
+    east, north = get_transformer(zone_number, hemisphere).transform(lon, lat)
     return east, north
 
 
+def utm_to_latlon(east, north, zone_number, hemisphere):
+    lon, lat = get_transformer(zone_number, hemisphere, inverse=True).transform(east, north)
+    return lat, lon
+
+
+# pyproj implementation of the coordinate conversion
+def latlon_to_eastnorh(lat, lon):
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    zone_number, hemisphere = choose_utm_zone(lat, lon)
+
+    east, north = latlon_to_utm(lat.ravel(), lon.ravel(), zone_number, hemisphere)
+    return east.reshape(lat.shape), north.reshape(lat.shape)
+
+
 def eastnorth_to_latlon(east, north, zone_number, hemisphere):
-    if hemisphere == 'N':
-        south = False
-    else:
-        south = True
+    east = np.asarray(east, dtype=np.float64)
+    north = np.asarray(north, dtype=np.float64)
 
-    proj = pyproj.Proj(proj='utm', ellps='WGS84', zone=zone_number, south=south)
-    lon, lat = proj(east, north, inverse=True)
-    return lat, lon
+    lat, lon = utm_to_latlon(east.ravel(), north.ravel(), zone_number, hemisphere)
+    return lat.reshape(east.shape), lon.reshape(east.shape)
 
 
 if __name__ == '__main__':
@@ -91,3 +121,12 @@ if __name__ == '__main__':
 
     lat, lon = eastnorth_to_latlon(east, north, zone_number=32, hemisphere='S')
     print('lat, lon: {}'.format(np.hstack((lat, lon))))
+
+    print('\n')
+    # points on both sides of the boundary between zone 31 and zone 32
+    lat = np.array([47.9941214, 47.9941214]).reshape((2, 1))
+    lon = np.array([5.9, 6.1]).reshape((2, 1))
+    print('lat, lon: {}'.format(np.hstack((lat, lon))))
+
+    east, north = latlon_to_eastnorh(lat, lon)
+    print('utm: {}'.format(np.hstack((east, north))))
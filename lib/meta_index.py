@@ -0,0 +1,238 @@
+#  ===============================================================================================================
+#  Copyright (c) 2019, Cornell University. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without modification, are permitted provided that
+#  the following conditions are met:
+#
+#      * Redistributions of source code must retain the above copyright otice, this list of conditions and
+#        the following disclaimer.
+#
+#      * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and
+#        the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#      * Neither the name of Cornell University nor the names of its contributors may be used to endorse or
+#        promote products derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+#  WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+#  OF SUCH DAMAGE.
+#
+#  Author: Kai Zhang (kz298@cornell.edu)
+#
+#  The research is based upon work supported by the Office of the Director of National Intelligence (ODNI),
+#  Intelligence Advanced Research Projects Activity (IARPA), via DOI/IBC Contract Number D17PC00287.
+#  The U.S. Government is authorized to reproduce and distribute copies of this work for Governmental purposes.
+#  ===============================================================================================================
+
+
+# persistent index of the parsed WorldView xml files
+#
+# parsing the DigitalGlobe xml with ElementTree dominates the start of image cropping on large archives;
+# the parsed meta_dict and the ground footprint of every image are stored in a sqlite database, keyed by
+# path, modification time and size, so that unchanged files are never parsed again
+
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import multiprocessing
+import numpy as np
+import dateutil.parser
+from lib.parse_meta import parse_meta
+from lib.rpc_model import RPCModel
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER,
+    size INTEGER,
+    digest TEXT,
+    sensor_id TEXT,
+    cap_time TEXT,
+    cloud_cover REAL,
+    sun_azim REAL,
+    sun_elev REAL,
+    sat_azim REAL,
+    sat_elev REAL,
+    min_lat REAL,
+    max_lat REAL,
+    min_lon REAL,
+    max_lon REAL,
+    meta_json TEXT
+);
+CREATE INDEX IF NOT EXISTS meta_digest ON meta (digest);
+'''
+
+_COLUMNS = ['path', 'mtime', 'size', 'digest', 'sensor_id', 'cap_time', 'cloud_cover',
+            'sun_azim', 'sun_elev', 'sat_azim', 'sat_elev',
+            'min_lat', 'max_lat', 'min_lon', 'max_lon', 'meta_json']
+
+
+def compute_footprint(meta_dict):
+    """
+    Localizes the four image corners at the bottom and top of the rpc altitude range.
+
+    Returns:
+        (min_lat, max_lat, min_lon, max_lon)
+    """
+    rpc_model = RPCModel(meta_dict)
+    width = meta_dict['width']
+    height = meta_dict['height']
+    col = np.array([0., width - 1, width - 1, 0.] * 2)
+    row = np.array([0., 0., height - 1, height - 1] * 2)
+    alt = np.array([rpc_model.altOff - rpc_model.altScale] * 4 + [rpc_model.altOff + rpc_model.altScale] * 4)
+    lon, lat, _ = rpc_model.inverse_projection(col, row, alt)
+    return float(np.min(lat)), float(np.max(lat)), float(np.min(lon)), float(np.max(lon))
+
+
+class MetaIndex(object):
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+        self.hit_cnt = 0
+        self.miss_cnt = 0
+
+    def close(self):
+        self.conn.close()
+        logging.info('meta index {}: {} hits, {} xml files parsed'.format(self.db_file, self.hit_cnt, self.miss_cnt))
+
+    def _fetch(self, where, args):
+        cursor = self.conn.execute('SELECT {} FROM meta WHERE {}'.format(', '.join(_COLUMNS), where), args)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(_COLUMNS, row))
+
+    def _find(self, path):
+        """
+        Returns:
+            the indexed record of the file, with its current path, mtime and size, or None; and the
+            digest of its content (None if found by (path, mtime, size))
+        """
+        stat = os.stat(path)
+
+        record = self._fetch('path = ? AND mtime = ? AND size = ?', (path, stat.st_mtime_ns, stat.st_size))
+        if record is not None:
+            return record, None
+
+        # the file may have been copied or rewritten with identical content, e.g. by clean_data
+        with open(path, 'rb') as fp:
+            digest = hashlib.sha1(fp.read()).hexdigest()
+        record = self._fetch('digest = ?', (digest,))
+        if record is not None:
+            record['path'] = path
+            record['mtime'] = stat.st_mtime_ns
+            record['size'] = stat.st_size
+        return record, digest
+
+    def _insert(self, record):
+        self.conn.execute('INSERT OR REPLACE INTO meta ({}) VALUES ({})'.format(
+            ', '.join(_COLUMNS), ', '.join(['?'] * len(_COLUMNS))), [record[x] for x in _COLUMNS])
+
+    @staticmethod
+    def _result(record):
+        meta_dict = json.loads(record['meta_json'])
+        meta_dict['capTime'] = dateutil.parser.parse(meta_dict['capTime'])
+        footprint = (record['min_lat'], record['max_lat'], record['min_lon'], record['max_lon'])
+        return meta_dict, footprint
+
+    def lookup(self, xml_file):
+        """
+        Returns the meta_dict of an xml file, as parse_meta does, and its footprint.
+
+        The xml file is parsed only if neither its (path, mtime, size) nor its
+        content is in the index yet.
+
+        Returns:
+            meta_dict, (min_lat, max_lat, min_lon, max_lon)
+        """
+        return self.lookup_many([xml_file], max_processes=1)[0]
+
+    def lookup_many(self, xml_files, max_processes=-1):
+        """
+        Same as lookup for a list of xml files; the files missing from the index are
+        parsed on a process pool, while all the index updates are done here.
+
+        Returns:
+            list of (meta_dict, (min_lat, max_lat, min_lon, max_lon))
+        """
+        paths = [os.path.abspath(xml_file) for xml_file in xml_files]
+        records = [None] * len(paths)
+
+        # files whose content is not indexed, keyed by digest, so that identical copies are parsed once
+        to_parse = {}
+        for i, path in enumerate(paths):
+            record, digest = self._find(path)
+            if record is None:
+                to_parse.setdefault(digest, []).append(i)
+            else:
+                records[i] = record
+                self.hit_cnt += 1
+                if digest is not None:
+                    self._insert(record)
+
+        if len(to_parse) > 0:
+            digests = sorted(to_parse.keys())
+            args = [(paths[to_parse[digest][0]], digest) for digest in digests]
+            if max_processes <= 0:
+                max_processes = multiprocessing.cpu_count()
+            if max_processes == 1 or len(args) == 1:
+                parsed = [parse_record(*x) for x in args]
+            else:
+                pool = multiprocessing.Pool(min(max_processes, len(args)))
+                parsed = pool.starmap(parse_record, args)
+                pool.close()
+                pool.join()
+
+            for digest, record in zip(digests, parsed):
+                self.miss_cnt += 1
+                for i in to_parse[digest]:
+                    stat = os.stat(paths[i])
+                    records[i] = dict(record, path=paths[i], mtime=stat.st_mtime_ns, size=stat.st_size)
+                    self._insert(records[i])
+        self.conn.commit()
+
+        return [self._result(record) for record in records]
+
+    def get(self, xml_file):
+        return self.lookup(xml_file)[0]
+
+
+def parse_record(path, digest):
+    """
+    Parses an xml file into an index record, without path, mtime and size.
+    """
+    meta_dict = parse_meta(path)
+    min_lat, max_lat, min_lon, max_lon = compute_footprint(meta_dict)
+
+    record = {'digest': digest,
+              'sensor_id': meta_dict['sensor_id'],
+              'cap_time': meta_dict['capTime'].isoformat(),
+              'cloud_cover': meta_dict['cloudCover'],
+              'sun_azim': meta_dict['sunAzim'],
+              'sun_elev': meta_dict['sunElev'],
+              'sat_azim': meta_dict['satAzim'],
+              'sat_elev': meta_dict['satElev'],
+              'min_lat': min_lat,
+              'max_lat': max_lat,
+              'min_lon': min_lon,
+              'max_lon': max_lon}
+    # change datetime object to string
+    meta_dict = dict(meta_dict)
+    meta_dict['capTime'] = record['cap_time']
+    record['meta_json'] = json.dumps(meta_dict)
+    return record
+
+
+if __name__ == '__main__':
+    pass
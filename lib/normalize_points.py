@@ -30,32 +30,23 @@
 #  ===============================================================================================================
 
 
-import pymap3d
-
-
-def latlonalt_to_enu(lat, lon, alt, lat0, lon0, alt0):
-    e, n, u = pymap3d.geodetic2enu(lat, lon, alt, lat0, lon0, alt0)
-
-    return e, n, u
-
-
-def enu_to_latlonalt(e, n, u, lat0, lon0, alt0):
-    lat, lon, alt = pymap3d.enu2geodetic(e, n, u, lat0, lon0, alt0)
-
-    return lat, lon, alt
-
-
-if __name__ == '__main__':
-    lat = -34.450
-    lon = -58.579
-    alt = 20.31
-
-    lat0 = -34.448
-    lon0 = -58.577
-    alt0 = -30.0
-
-    e, n, u = latlonalt_to_enu(lat, lon, alt, lat0, lon0, alt0)
-    lat, lon, alt = enu_to_latlonalt(e, n, u, lat0, lon0, alt0)
-
-    print('{}, {}, {}'.format(e, n, u))
-    print('{}, {}, {}'.format(lat, lon, alt))
+import numpy as np
+
+
+# normalization of the scene points shared by the affine and perspective camera solvers
+def normalize_points(xx, yy, zz):
+    """
+    Centers the points and scales them to an average distance of sqrt(3) from the origin.
+
+    Returns:
+        (M, 4) homogeneous normalized points, and the (4, 4) matrix T such that
+        normalized = T * [xx, yy, zz, 1]^T
+    """
+    points = np.hstack((xx.reshape((-1, 1)), yy.reshape((-1, 1)), zz.reshape((-1, 1))))
+    center = np.mean(points, axis=0)
+    points = points - center
+    scale = np.sqrt(3. / np.mean(np.sum(points ** 2, axis=1)))
+
+    T = np.diag((scale, scale, scale, 1.))
+    T[:3, 3] = -scale * center
+    return np.hstack((points * scale, np.ones((points.shape[0], 1)))), T
@@ -0,0 +1,109 @@
+#  ===============================================================================================================
+#  Copyright (c) 2019, Cornell University. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without modification, are permitted provided that
+#  the following conditions are met:
+#
+#      * Redistributions of source code must retain the above copyright otice, this list of conditions and
+#        the following disclaimer.
+#
+#      * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and
+#        the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#      * Neither the name of Cornell University nor the names of its contributors may be used to endorse or
+#        promote products derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+#  WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+#  OF SUCH DAMAGE.
+#
+#  Author: Kai Zhang (kz298@cornell.edu)
+#
+#  The research is based upon work supported by the Office of the Director of National Intelligence (ODNI),
+#  Intelligence Advanced Research Projects Activity (IARPA), via DOI/IBC Contract Number D17PC00287.
+#  The U.S. Government is authorized to reproduce and distribute copies of this work for Governmental purposes.
+#  ===============================================================================================================
+
+
+
+# write 8-bit grayscale png files strip by strip, without holding the whole image in memory
+
+import os
+import struct
+import zlib
+import numpy as np
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# size of the IDAT chunks written out
+CHUNK_SIZE = 1 << 20
+
+
+class PNGStripWriter(object):
+    """
+    Writes an 8-bit grayscale png file whose rows are given in order, a strip
+    of whole rows at a time; only the compressor state is kept in memory.
+    """
+    def __init__(self, path, width, height, compress_level=6):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+
+        self.fp = open(path, 'wb')
+        self.fp.write(PNG_SIGNATURE)
+        # bit depth 8, color type 0 (grayscale), default compression, filter and interlace methods
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+        self.compressor = zlib.compressobj(compress_level)
+        self.buffer = []
+        self.buffer_size = 0
+
+    def _write_chunk(self, chunk_type, data):
+        self.fp.write(struct.pack('>I', len(data)))
+        self.fp.write(chunk_type)
+        self.fp.write(data)
+        self.fp.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+    def _flush_buffer(self):
+        if self.buffer_size > 0:
+            self._write_chunk(b'IDAT', b''.join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+
+    def _append(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= CHUNK_SIZE:
+            self._flush_buffer()
+
+    def write(self, strip):
+        """
+        Args:
+            strip: (rows, width) uint8 array, the next rows of the image
+        """
+        assert strip.dtype == np.uint8 and strip.ndim == 2 and strip.shape[1] == self.width
+        assert self.rows_written + strip.shape[0] <= self.height
+
+        # every row starts with its filter type, 0 (none)
+        filtered = np.zeros((strip.shape[0], self.width + 1), dtype=np.uint8)
+        filtered[:, 1:] = strip
+        self._append(self.compressor.compress(filtered.tobytes()))
+        self.rows_written += strip.shape[0]
+
+    def close(self):
+        assert self.rows_written == self.height
+        self._append(self.compressor.flush())
+        self._flush_buffer()
+        self._write_chunk(b'IEND', b'')
+        self.fp.close()
+
+    def abort(self):
+        # an unfinished file is not a valid png
+        self.fp.close()
+        os.remove(self.path)
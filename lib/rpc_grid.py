@@ -0,0 +1,218 @@
+#  ===============================================================================================================
+#  Copyright (c) 2019, Cornell University. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without modification, are permitted provided that
+#  the following conditions are met:
+#
+#      * Redistributions of source code must retain the above copyright otice, this list of conditions and
+#        the following disclaimer.
+#
+#      * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and
+#        the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#      * Neither the name of Cornell University nor the names of its contributors may be used to endorse or
+#        promote products derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+#  WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+#  OF SUCH DAMAGE.
+#
+#  Author: Kai Zhang (kz298@cornell.edu)
+#
+#  The research is based upon work supported by the Office of the Director of National Intelligence (ODNI),
+#  Intelligence Advanced Research Projects Activity (IARPA), via DOI/IBC Contract Number D17PC00287.
+#  The U.S. Government is authorized to reproduce and distribute copies of this work for Governmental purposes.
+#  ===============================================================================================================
+
+
+# tabulate the forward and inverse rpc over the aoi volume, and serve queries by trilinear interpolation
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+from lib.rpc_model import RPCModel
+
+
+def trilinear(axes, table, x, y, z):
+    """
+    Args:
+        axes: three uniformly spaced 1D arrays, the lattice coordinates
+        table: (len(axes[0]), len(axes[1]), len(axes[2])) array of tabulated values
+        x, y, z: numpy arrays of same size, the query points
+
+    Returns:
+        interpolated values, of the same size as x; points outside the lattice
+        are linearly extrapolated from the border cells
+    """
+    table = table.reshape((-1,))
+    stride = (len(axes[1]) * len(axes[2]), len(axes[2]), 1)
+
+    flat_idx = 0
+    fracs = []
+    for i, val in enumerate((x, y, z)):
+        axis = axes[i]
+        pos = (np.asarray(val, dtype=np.float64).reshape((-1,)) - axis[0]) / (axis[1] - axis[0])
+        idx = np.clip(np.floor(pos), 0, len(axis) - 2).astype(np.int64)
+        fracs.append(pos - idx)
+        flat_idx = flat_idx + idx * stride[i]
+
+    fx, fy, fz = fracs
+    out = 0.
+    for dx in (0, 1):
+        wx = fx if dx else 1. - fx
+        for dy in (0, 1):
+            wxy = wx * (fy if dy else 1. - fy)
+            for dz in (0, 1):
+                w = wxy * (fz if dz else 1. - fz)
+                out = out + w * table[flat_idx + dx * stride[0] + dy * stride[1] + dz * stride[2]]
+    return out
+
+
+class RPCGrid(object):
+    """
+    Lookup tables of the forward rpc, (lat, lon, alt) -> (col, row), and of the
+    inverse rpc, (col, row, alt) -> (lat, lon), on coarse lattices covering an
+    area of interest.
+    """
+    def __init__(self, fwd_axes, col_table, row_table, inv_axes, lat_table, lon_table, error=None):
+        self.fwd_axes = fwd_axes        # lat, lon, alt
+        self.col_table = col_table
+        self.row_table = row_table
+        self.inv_axes = inv_axes        # col, row, alt
+        self.lat_table = lat_table
+        self.lon_table = lon_table
+        self.error = error
+
+    @classmethod
+    def build(cls, rpc_model, lat_range, lon_range, alt_range, grid_size=(21, 21, 11)):
+        n_lat, n_lon, n_alt = grid_size
+        fwd_axes = (np.linspace(lat_range[0], lat_range[1], n_lat),
+                    np.linspace(lon_range[0], lon_range[1], n_lon),
+                    np.linspace(alt_range[0], alt_range[1], n_alt))
+        lat, lon, alt = np.meshgrid(*fwd_axes, indexing='ij')
+        col, row = rpc_model.projection(lat, lon, alt)
+
+        # the inverse lattice covers the image footprint of the volume
+        inv_axes = (np.linspace(np.min(col), np.max(col), n_lon),
+                    np.linspace(np.min(row), np.max(row), n_lat),
+                    fwd_axes[2])
+        inv_col, inv_row, inv_alt = np.meshgrid(*inv_axes, indexing='ij')
+        inv_lon, inv_lat, _ = rpc_model.inverse_projection(inv_col, inv_row, inv_alt)
+        shape = inv_col.shape
+
+        grid = cls(fwd_axes, col, row, inv_axes, inv_lat.reshape(shape), inv_lon.reshape(shape))
+        grid.error = grid.check_error(rpc_model)
+        return grid
+
+    @classmethod
+    def from_aoi(cls, rpc_model, work_dir, grid_size=(21, 21, 11)):
+        with open(os.path.join(work_dir, 'aoi.json')) as fp:
+            aoi_dict = json.load(fp)
+
+        return cls.build(rpc_model, (aoi_dict['lat_min'], aoi_dict['lat_max']),
+                         (aoi_dict['lon_min'], aoi_dict['lon_max']),
+                         (aoi_dict['alt_min'], aoi_dict['alt_max']), grid_size)
+
+    def projection(self, lat, lon, alt):
+        col = trilinear(self.fwd_axes, self.col_table, lat, lon, alt)
+        row = trilinear(self.fwd_axes, self.row_table, lat, lon, alt)
+        return col, row
+
+    def inverse_projection(self, col, row, alt):
+        lat = trilinear(self.inv_axes, self.lat_table, col, row, alt)
+        lon = trilinear(self.inv_axes, self.lon_table, col, row, alt)
+        return lon, lat, np.asarray(alt, dtype=np.float64).reshape((-1,))
+
+    def check_error(self, rpc_model):
+        # interpolation error peaks at the cell centers
+        def centers(axis):
+            return (axis[:-1] + axis[1:]) / 2.
+
+        lat, lon, alt = np.meshgrid(*[centers(axis) for axis in self.fwd_axes], indexing='ij')
+        col, row = rpc_model.projection(lat, lon, alt)
+        esti_col, esti_row = self.projection(lat, lon, alt)
+        proj_err = np.sqrt((esti_col - col.reshape((-1,))) ** 2 + (esti_row - row.reshape((-1,))) ** 2)
+
+        # measure the inverse error by re-projecting through the exact model
+        col, row, alt = np.meshgrid(*[centers(axis) for axis in self.inv_axes], indexing='ij')
+        esti_lon, esti_lat, esti_alt = self.inverse_projection(col, row, alt)
+        esti_col, esti_row = rpc_model.projection(esti_lat, esti_lon, esti_alt)
+        inv_proj_err = np.sqrt((esti_col - col.reshape((-1,))) ** 2 + (esti_row - row.reshape((-1,))) ** 2)
+
+        error = {'mean_proj_err': float(np.mean(proj_err)),
+                 'max_proj_err': float(np.max(proj_err)),
+                 'mean_inv_proj_err': float(np.mean(inv_proj_err)),
+                 'max_inv_proj_err': float(np.max(inv_proj_err))}
+        logging.info('rpc grid interpolation error (pixels): {}'.format(error))
+        return error
+
+    def save(self, path, signature=''):
+        np.savez(path, fwd_lat=self.fwd_axes[0], fwd_lon=self.fwd_axes[1], fwd_alt=self.fwd_axes[2],
+                 col_table=self.col_table, row_table=self.row_table,
+                 inv_col=self.inv_axes[0], inv_row=self.inv_axes[1], inv_alt=self.inv_axes[2],
+                 lat_table=self.lat_table, lon_table=self.lon_table,
+                 error=json.dumps(self.error), signature=signature)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        grid = cls((data['fwd_lat'], data['fwd_lon'], data['fwd_alt']), data['col_table'], data['row_table'],
+                   (data['inv_col'], data['inv_row'], data['inv_alt']), data['lat_table'], data['lon_table'],
+                   json.loads(str(data['error'])))
+        return grid, str(data['signature'])
+
+
+def load_or_build_rpc_grid(work_dir, img_name, meta_dict, grid_size=(21, 21, 11)):
+    """
+    Reuses the grid saved under {work_dir}/rpc_grids/ if it was built for the same aoi, rpc and grid size.
+    """
+    with open(os.path.join(work_dir, 'aoi.json')) as fp:
+        aoi_dict = json.load(fp)
+    signature = hashlib.sha1(json.dumps([aoi_dict, meta_dict['rpc'], list(grid_size)],
+                                        sort_keys=True).encode()).hexdigest()
+
+    grid_dir = os.path.join(work_dir, 'rpc_grids')
+    if not os.path.exists(grid_dir):
+        os.mkdir(grid_dir)
+    grid_file = os.path.join(grid_dir, os.path.splitext(img_name)[0] + '.npz')
+
+    if os.path.exists(grid_file):
+        grid, saved_signature = RPCGrid.load(grid_file)
+        if saved_signature == signature:
+            return grid
+
+    grid = RPCGrid.from_aoi(RPCModel(meta_dict), work_dir, grid_size)
+    grid.save(grid_file, signature)
+    return grid
+
+
+def build_rpc_grids(work_dir, grid_size=(21, 21, 11)):
+    """
+    Loads or builds the grids of all the images in {work_dir}/metas/, and removes the grids of images no longer there.
+
+    Returns:
+        dict mapping the image names to their grids
+    """
+    metas_subdir = os.path.join(work_dir, 'metas')
+    grids = {}
+    for item in sorted(os.listdir(metas_subdir)):
+        img_name = item[:-5] + '.png'
+        with open(os.path.join(metas_subdir, item)) as fp:
+            meta_dict = json.load(fp)
+        grids[img_name] = load_or_build_rpc_grid(work_dir, img_name, meta_dict, grid_size)
+        logging.info('rpc grid of {}, interpolation error (pixels): {}'.format(img_name, grids[img_name].error))
+
+    grid_dir = os.path.join(work_dir, 'rpc_grids')
+    if os.path.exists(grid_dir):
+        kept = set([os.path.splitext(img_name)[0] + '.npz' for img_name in grids])
+        for item in os.listdir(grid_dir):
+            if item not in kept:
+                os.remove(os.path.join(grid_dir, item))
+    return grids
@@ -36,6 +36,15 @@
 
 
 import numpy as np
+import logging
+import time
+
+try:
+    import numba
+except ImportError:
+    # numba is optional; apply_rfm_pair then evaluates the polynoms chunk by chunk with numpy
+    numba = None
+
 
 def apply_poly(poly, x, y, z):
     """
@@ -79,6 +88,198 @@ def apply_rfm(num, den, x, y, z):
     return apply_poly(num, x, y, z) / apply_poly(den, x, y, z)
 
 
+# exponents of (x, y, z) for the 20 monomials, ordered following the RPC convention
+MONOMIAL_EXPONENTS = np.array([[0, 0, 0], [0, 1, 0], [1, 0, 0], [0, 0, 1],
+                               [1, 1, 0], [0, 1, 1], [1, 0, 1],
+                               [0, 2, 0], [2, 0, 0], [0, 0, 2],
+                               [1, 1, 1], [0, 3, 0],
+                               [2, 1, 0], [0, 1, 2], [1, 2, 0],
+                               [3, 0, 0], [1, 0, 2], [0, 2, 1], [2, 0, 1],
+                               [0, 0, 3]])
+
+
+def cubic_monomials(x, y, z, dtype=np.float64):
+    """
+    Evaluates the 20 monomials of a 3-variables polynom of degree 3.
+
+    Args:
+        x, y, z: numpy arrays of same size.
+        dtype: floating point type of the computation
+
+    Returns:
+        (M, 20) array, M being the number of input points; the columns are
+        ordered following the RPC convention, so that the polynom is
+        np.dot(cubic_monomials(x, y, z), poly).
+    """
+    x = np.asarray(x, dtype=dtype).reshape((-1,))
+    y = np.asarray(y, dtype=dtype).reshape((-1,))
+    z = np.asarray(z, dtype=dtype).reshape((-1,))
+
+    out = np.empty((x.size, 20), dtype=dtype)
+    out[:, 0] = 1.
+    out[:, 1] = y
+    out[:, 2] = x
+    out[:, 3] = z
+    np.multiply(y, x, out=out[:, 4])
+    np.multiply(y, z, out=out[:, 5])
+    np.multiply(x, z, out=out[:, 6])
+    np.multiply(y, y, out=out[:, 7])
+    np.multiply(x, x, out=out[:, 8])
+    np.multiply(z, z, out=out[:, 9])
+    np.multiply(out[:, 4], z, out=out[:, 10])
+    np.multiply(out[:, 7], y, out=out[:, 11])
+    np.multiply(out[:, 8], y, out=out[:, 12])
+    np.multiply(out[:, 9], y, out=out[:, 13])
+    np.multiply(out[:, 7], x, out=out[:, 14])
+    np.multiply(out[:, 8], x, out=out[:, 15])
+    np.multiply(out[:, 9], x, out=out[:, 16])
+    np.multiply(out[:, 7], z, out=out[:, 17])
+    np.multiply(out[:, 8], z, out=out[:, 18])
+    np.multiply(out[:, 9], z, out=out[:, 19])
+    return out
+
+
+def _lowered_monomials(axis):
+    # d(monomial k)/d(axis) = factor[k] * monomial index[k]
+    index = np.zeros((20,), dtype=np.int64)
+    factor = np.zeros((20,))
+    lookup = dict((tuple(e), k) for k, e in enumerate(MONOMIAL_EXPONENTS))
+    for k, e in enumerate(MONOMIAL_EXPONENTS):
+        if e[axis] > 0:
+            lowered = e.copy()
+            lowered[axis] -= 1
+            index[k] = lookup[tuple(lowered)]
+            factor[k] = e[axis]
+    return index, factor
+
+
+MONOMIAL_DERIVATIVES = [_lowered_monomials(axis) for axis in range(3)]
+
+
+def cubic_monomials_grad(monomials, axis):
+    """
+    Derivatives of the 20 monomials with respect to x (axis=0), y (axis=1) or z (axis=2).
+
+    Args:
+        monomials: (M, 20) output of cubic_monomials
+
+    Returns:
+        (M, 20) array, so that the derivative of the polynom is
+        np.dot(cubic_monomials_grad(monomials, axis), poly).
+    """
+    index, factor = MONOMIAL_DERIVATIVES[axis]
+    return monomials[:, index] * factor.astype(monomials.dtype)
+
+
+def substitute_polys(polys, scale, offset):
+    """
+    Re-expresses cubic polynoms in an affinely transformed frame.
+
+    Args:
+        polys: (N, P, 20) array of coefficients, ordered following the RPC convention.
+        scale, offset: (N, 3) arrays; the n-th polynoms are composed with
+            (x, y, z) -> scale[n] * (x, y, z) + offset[n].
+
+    Returns:
+        (N, P, 20) array q such that q(x, y, z) = p(scale * (x, y, z) + offset).
+    """
+    polys = np.asarray(polys, dtype=np.float64)
+    cnt = polys.shape[0]
+    ex, ey, ez = MONOMIAL_EXPONENTS[:, 0], MONOMIAL_EXPONENTS[:, 1], MONOMIAL_EXPONENTS[:, 2]
+
+    # scatter to 4*4*4 tensors indexed by the exponents of x, y, z
+    tensor = np.zeros(polys.shape[:2] + (4, 4, 4))
+    tensor[:, :, ex, ey, ez] = polys
+
+    # binomial expansion of (s*u + t)^k = sum_j C(k, j) s^j t^(k-j) u^j, per axis
+    binom = np.array([[1, 0, 0, 0], [1, 1, 0, 0], [1, 2, 1, 0], [1, 3, 3, 1]], dtype=np.float64)
+    k = np.arange(4).reshape((4, 1))
+    j = np.arange(4).reshape((1, 4))
+    power = np.maximum(k - j, 0)
+    expand = []
+    for axis in range(3):
+        s = scale[:, axis].reshape((cnt, 1, 1))
+        t = offset[:, axis].reshape((cnt, 1, 1))
+        expand.append(binom * s ** j * t ** power)
+
+    tensor = np.einsum('nad,nbe,ncf,npabc->npdef', expand[0], expand[1], expand[2], tensor)
+    return tensor[:, :, ex, ey, ez]
+
+
+def _rfm_pair_kernel(polys, x, y, z, out_col, out_row):
+    # the 20 monomials of a point are computed once and shared by the four polynoms
+    mono = np.empty(20)
+    val = np.empty(4)
+    for i in range(x.shape[0]):
+        xi = x[i]
+        yi = y[i]
+        zi = z[i]
+        mono[0] = 1.
+        mono[1] = yi
+        mono[2] = xi
+        mono[3] = zi
+        mono[4] = yi * xi
+        mono[5] = yi * zi
+        mono[6] = xi * zi
+        mono[7] = yi * yi
+        mono[8] = xi * xi
+        mono[9] = zi * zi
+        mono[10] = mono[4] * zi
+        mono[11] = mono[7] * yi
+        mono[12] = mono[8] * yi
+        mono[13] = mono[9] * yi
+        mono[14] = mono[7] * xi
+        mono[15] = mono[8] * xi
+        mono[16] = mono[9] * xi
+        mono[17] = mono[7] * zi
+        mono[18] = mono[8] * zi
+        mono[19] = mono[9] * zi
+        for k in range(4):
+            acc = 0.
+            for j in range(20):
+                acc += polys[k, j] * mono[j]
+            val[k] = acc
+        out_col[i] = val[0] / val[1]
+        out_row[i] = val[2] / val[3]
+
+if numba is not None:
+    _rfm_pair_kernel = numba.njit(cache=True, nogil=True)(_rfm_pair_kernel)
+
+
+def apply_rfm_pair(polys, x, y, z, out_col=None, out_row=None, chunk_size=65536):
+    """
+    Evaluates the col and row rfms of a camera in a single pass over the points.
+
+    Args:
+        polys: (4, 20) array of coefficients: colNum, colDen, rowNum, rowDen
+        x, y, z: 1D numpy arrays of same length
+        out_col, out_row: optional output buffers of the same length
+        chunk_size: number of points evaluated at once when numba is not available
+
+    Returns:
+        out_col, out_row
+    """
+    polys = np.ascontiguousarray(polys, dtype=np.float64)
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    z = np.ascontiguousarray(z, dtype=np.float64)
+    if out_col is None:
+        out_col = np.empty(x.shape)
+    if out_row is None:
+        out_row = np.empty(x.shape)
+
+    if numba is not None:
+        _rfm_pair_kernel(polys, x, y, z, out_col, out_row)
+    else:
+        for idx1 in range(0, x.size, chunk_size):
+            idx2 = min(idx1 + chunk_size, x.size)
+            val = np.dot(cubic_monomials(x[idx1:idx2], y[idx1:idx2], z[idx1:idx2]), polys.T)
+            np.divide(val[:, 0], val[:, 1], out=out_col[idx1:idx2])
+            np.divide(val[:, 2], val[:, 3], out=out_row[idx1:idx2])
+
+    return out_col, out_row
+
+
 # # this function was written to use numpy.polynomial.polynomial.polyval3d
 # # function, instead of our apply_poly function.
 # def reshape_coefficients_vector(c):
@@ -128,6 +329,46 @@ def apply_rfm(num, den, x, y, z):
 #     return a/b
 
 
+def fit_rpc(lat, lon, alt, col, row):
+    """
+    Fits the 78 coefficients of a rational polynomial camera to ground/image
+    correspondences by linear least squares, the constant term of each
+    denominator being fixed to 1.
+
+    Args:
+        lat, lon, alt, col, row: numpy arrays of same size
+
+    Returns:
+        rpc_dict (in the same format as parse_meta), and the max residual in pixels
+    """
+    lat, lon, alt, col, row = [np.asarray(x, dtype=np.float64).reshape((-1,)) for x in (lat, lon, alt, col, row)]
+
+    rpc_dict = {}
+    normalized = {}
+    for name, val in (('lat', lat), ('lon', lon), ('alt', alt), ('col', col), ('row', row)):
+        off = (np.min(val) + np.max(val)) / 2.
+        scale = max((np.max(val) - np.min(val)) / 2., 1e-12)
+        rpc_dict[name + 'Off'] = float(off)
+        rpc_dict[name + 'Scale'] = float(scale)
+        normalized[name] = (val - off) / scale
+
+    monomials = cubic_monomials(normalized['lat'], normalized['lon'], normalized['alt'])
+    for name in ('col', 'row'):
+        target = normalized[name]
+        # target * (1 + den[1:] . m[1:]) = num . m
+        A = np.hstack((monomials, -target.reshape((-1, 1)) * monomials[:, 1:]))
+        sol = np.linalg.lstsq(A, target, rcond=None)[0]
+        rpc_dict[name + 'Num'] = [float(x) for x in sol[:20]]
+        rpc_dict[name + 'Den'] = [1.0] + [float(x) for x in sol[20:]]
+
+    esti_col = apply_rfm(rpc_dict['colNum'], rpc_dict['colDen'], normalized['lat'], normalized['lon'], normalized['alt'])
+    esti_row = apply_rfm(rpc_dict['rowNum'], rpc_dict['rowDen'], normalized['lat'], normalized['lon'], normalized['alt'])
+    residual = np.sqrt(((esti_col - normalized['col']) * rpc_dict['colScale']) ** 2 +
+                       ((esti_row - normalized['row']) * rpc_dict['rowScale']) ** 2)
+
+    return rpc_dict, float(np.max(residual))
+
+
 class RPCModel(object):
     def __init__(self, meta_dict):
         rpc_dict = meta_dict['rpc']
@@ -157,96 +398,279 @@ class RPCModel(object):
         self.width = meta_dict['width']
         self.height = meta_dict['height']
 
-    def projection(self, lat, lon, alt):
-        cLon = (lon - self.lonOff) / self.lonScale
+    def projection(self, lat, lon, alt, chunk_size=1048576):
+        """
+        Args:
+            lat, lon, alt: floats or numpy arrays of same shape
+            chunk_size: number of points normalized and evaluated at once,
+                which bounds the temporary memory for very large inputs
+
+        Returns:
+            col, row, of the same shape as the inputs
+        """
+        lat, lon, alt = np.broadcast_arrays(np.asarray(lat, dtype=np.float64),
+                                            np.asarray(lon, dtype=np.float64),
+                                            np.asarray(alt, dtype=np.float64))
+        shape = lat.shape
+        lat, lon, alt = lat.reshape((-1,)), lon.reshape((-1,)), alt.reshape((-1,))
+
+        polys = np.array([self.colNum, self.colDen, self.rowNum, self.rowDen], dtype=np.float64)
+        col = np.empty(lat.shape)
+        row = np.empty(lat.shape)
+        for idx1 in range(0, lat.size, chunk_size):
+            idx2 = min(idx1 + chunk_size, lat.size)
+            cLat = (lat[idx1:idx2] - self.latOff) / self.latScale
+            cLon = (lon[idx1:idx2] - self.lonOff) / self.lonScale
+            cAlt = (alt[idx1:idx2] - self.altOff) / self.altScale
+            apply_rfm_pair(polys, cLat, cLon, cAlt, col[idx1:idx2], row[idx1:idx2])
+
+        col *= self.colScale
+        col += self.colOff
+        row *= self.rowScale
+        row += self.rowOff
+        return col.reshape(shape)[()], row.reshape(shape)[()]
+
+    def _normalized_jacobian(self, x, y, z, axes=(0, 1, 2), dtype=np.float64):
+        # evaluates the normalized rfms and their derivatives in one pass over the monomials
+        polys = np.array([self.colNum, self.colDen, self.rowNum, self.rowDen], dtype=dtype).T
+        monomials = cubic_monomials(x, y, z, dtype=dtype)
+        val = np.dot(monomials, polys)
+
+        f_col = val[:, 0] / val[:, 1]
+        f_row = val[:, 2] / val[:, 3]
+
+        # jacobian of the rational functions: (n / d)' = (n' - (n / d) d') / d
+        jac = np.empty((f_col.size, 2, len(axes)), dtype=dtype)
+        for i, axis in enumerate(axes):
+            val_d = np.dot(cubic_monomials_grad(monomials, axis), polys)
+            jac[:, 0, i] = (val_d[:, 0] - f_col * val_d[:, 1]) / val[:, 1]
+            jac[:, 1, i] = (val_d[:, 2] - f_row * val_d[:, 3]) / val[:, 3]
+
+        return f_col, f_row, jac
+
+    def jacobian(self, lat, lon, alt):
+        """
+        Args:
+            lat, lon, alt: numpy arrays of same size (M points)
+
+        Returns:
+            col, row: (M, ) arrays of image coordinates
+            jac: (M, 2, 3) array, the derivatives of (col, row) with respect to (lat, lon, alt)
+        """
+        lat = np.asarray(lat, dtype=np.float64).reshape((-1,))
+        lon = np.asarray(lon, dtype=np.float64).reshape((-1,))
+        alt = np.asarray(alt, dtype=np.float64).reshape((-1,))
+
         cLat = (lat - self.latOff) / self.latScale
+        cLon = (lon - self.lonOff) / self.lonScale
         cAlt = (alt - self.altOff) / self.altScale
-        cCol = apply_rfm(self.colNum, self.colDen, cLat, cLon, cAlt)
-        cRow = apply_rfm(self.rowNum, self.rowDen, cLat, cLon, cAlt)
-        col = cCol*self.colScale + self.colOff
-        row = cRow*self.rowScale + self.rowOff
-        return col, row
+        cCol, cRow, jac = self._normalized_jacobian(cLat, cLon, cAlt)
+
+        # undo the normalization
+        col = cCol * self.colScale + self.colOff
+        row = cRow * self.rowScale + self.rowOff
+        jac *= np.array([self.colScale, self.rowScale]).reshape((1, 2, 1))
+        jac /= np.array([self.latScale, self.lonScale, self.altScale]).reshape((1, 1, 3))
+        return col, row, jac
+
+    def local_affine(self, lat, lon, alt):
+        """
+        First-order approximation of the projection around the given point(s).
+
+        Args:
+            lat, lon, alt: floats, or numpy arrays of same size (M points)
 
-    def inverse_projection(self, col, row, alt, return_normalized=False):
+        Returns:
+            (2, 4) affine matrix P, such that [col, row]^T ~ P [lat, lon, alt, 1]^T near the point;
+            (M, 2, 4) if the inputs are arrays. The layout is the same as in solve_affine.
         """
+        is_scalar = np.isscalar(lat)
+        col, row, jac = self.jacobian(lat, lon, alt)
+
+        point = np.stack((np.asarray(lat, dtype=np.float64).reshape((-1,)),
+                          np.asarray(lon, dtype=np.float64).reshape((-1,)),
+                          np.asarray(alt, dtype=np.float64).reshape((-1,))), axis=1)
+        P = np.empty((col.size, 2, 4))
+        P[:, :, :3] = jac
+        P[:, 0, 3] = col - np.sum(jac[:, 0, :] * point, axis=1)
+        P[:, 1, 3] = row - np.sum(jac[:, 1, :] * point, axis=1)
+
+        if is_scalar:
+            return P[0]
+        return P
+
+    def inverse_projection(self, col, row, alt, return_normalized=False, return_info=False,
+                           max_iter=20, tol=None, dtype=np.float64):
+        """
+        Localizes image points at given altitudes by Newton's method, using the
+        analytic jacobian of the rational polynoms.
+
+        Points are dropped from the active set as soon as they converge; the
+        others are iterated at most max_iter times.
+
         Args:
             col, row: image coordinates
             alt: altitude (in meters above the ellipsoid) of the corresponding
                 3D point
             return_normalized: boolean flag. If true, then return normalized
                 coordinates
+            return_info: boolean flag. If true, also return the per-point
+                convergence flag and iteration count
+            max_iter: maximum number of Newton iterations
+            tol: convergence tolerance on the reprojection error, in pixels;
+                defaults to 1e-5 for float64 and 1e-2 for float32
+            dtype: floating point type of the computation
         Returns:
-            lon, lat, alt
+            lon, lat, alt; plus converged, n_iter if return_info is true
         """
-        # normalise input image coordinates
-        cCol = (col - self.colOff) / self.colScale
-        cRow = (row - self.rowOff) / self.rowScale
-        cAlt = (alt - self.altOff) / self.altScale
+        if tol is None:
+            tol = 1e-5 if np.dtype(dtype) == np.float64 else 1e-2
 
-        # target point: Xf (f for final)
-        Xf = np.vstack([cCol, cRow]).T
-
-        # use 3 corners of the lon, lat domain and project them into the image
-        # to get the first estimation of (lon, lat)
-        # EPS is 2 for the first iteration, then 0.1.
-        lon = -np.ones(len(Xf))
-        lat = -np.ones(len(Xf))
-        EPS = 2
-        x0 = apply_rfm(self.colNum, self.colDen, lat, lon, cAlt)
-        y0 = apply_rfm(self.rowNum, self.rowDen, lat, lon, cAlt)
-        x1 = apply_rfm(self.colNum, self.colDen, lat, lon + EPS, cAlt)
-        y1 = apply_rfm(self.rowNum, self.rowDen, lat, lon + EPS, cAlt)
-        x2 = apply_rfm(self.colNum, self.colDen, lat + EPS, lon, cAlt)
-        y2 = apply_rfm(self.rowNum, self.rowDen, lat + EPS, lon, cAlt)
-
-        # n = 0
-        while not np.all((x0 - cCol) ** 2 + (y0 - cRow) ** 2 < 1e-18):
-            X0 = np.vstack([x0, y0]).T
-            X1 = np.vstack([x1, y1]).T
-            X2 = np.vstack([x2, y2]).T
-            e1 = X1 - X0
-            e2 = X2 - X0
-            u  = Xf - X0
-
-            # project u on the base (e1, e2): u = a1*e1 + a2*e2
-            # the exact computation is given by:
-            #   M = np.vstack((e1, e2)).T
-            #   a = np.dot(np.linalg.inv(M), u)
-            # but I don't know how to vectorize this.
-            # Assuming that e1 and e2 are orthogonal, a1 is given by
-            # <u, e1> / <e1, e1>
-            num = np.sum(np.multiply(u, e1), axis=1)
-            den = np.sum(np.multiply(e1, e1), axis=1)
-            a1 = np.divide(num, den)
-
-            num = np.sum(np.multiply(u, e2), axis=1)
-            den = np.sum(np.multiply(e2, e2), axis=1)
-            a2 = np.divide(num, den)
-
-            # use the coefficients a1, a2 to compute an approximation of the
-            # point on the gound which in turn will give us the new X0
-            lon += a1 * EPS
-            lat += a2 * EPS
-
-            # update X0, X1 and X2
-            EPS = .1
-            x0 = apply_rfm(self.colNum, self.colDen, lat, lon, cAlt)
-            y0 = apply_rfm(self.rowNum, self.rowDen, lat, lon, cAlt)
-            x1 = apply_rfm(self.colNum, self.colDen, lat, lon + EPS, cAlt)
-            y1 = apply_rfm(self.rowNum, self.rowDen, lat, lon + EPS, cAlt)
-            x2 = apply_rfm(self.colNum, self.colDen, lat + EPS, lon, cAlt)
-            y2 = apply_rfm(self.rowNum, self.rowDen, lat + EPS, lon, cAlt)
-            #n += 1
-
-        #logging.info('# of iterations: %d' % n)
+        col = np.asarray(col, dtype=np.float64).reshape((-1,))
+        row = np.asarray(row, dtype=np.float64).reshape((-1,))
+        alt = np.asarray(alt, dtype=np.float64).reshape((-1,))
+        if alt.size == 1:
+            alt = np.tile(alt, col.size)
+        point_cnt = col.size
 
+        # normalise input image coordinates
+        cCol = ((col - self.colOff) / self.colScale).astype(dtype)
+        cRow = ((row - self.rowOff) / self.rowScale).astype(dtype)
+        cAlt = ((alt - self.altOff) / self.altScale).astype(dtype)
+
+        # tolerance in the normalized image space
+        tol_col = np.dtype(dtype).type(tol / self.colScale)
+        tol_row = np.dtype(dtype).type(tol / self.rowScale)
+
+        # start from the center of the normalized (lat, lon) domain
+        lat = np.zeros((point_cnt, ), dtype=dtype)
+        lon = np.zeros((point_cnt, ), dtype=dtype)
+        converged = np.zeros((point_cnt, ), dtype=np.bool_)
+        n_iter = np.zeros((point_cnt, ), dtype=np.int32)
+
+        active = np.arange(point_cnt)
+        for it in range(max_iter + 1):
+            if active.size == 0:
+                break
+
+            x = lat[active]
+            y = lon[active]
+            f_col, f_row, jac = self._normalized_jacobian(x, y, cAlt[active], axes=(0, 1), dtype=dtype)
+            r_col = cCol[active] - f_col
+            r_row = cRow[active] - f_row
+
+            done = np.logical_and(np.abs(r_col) < tol_col, np.abs(r_row) < tol_row)
+            converged[active[done]] = True
+            if it == max_iter:
+                break
+
+            j_col_x, j_col_y = jac[:, 0, 0], jac[:, 0, 1]
+            j_row_x, j_row_y = jac[:, 1, 0], jac[:, 1, 1]
+            det = j_col_x * j_row_y - j_col_y * j_row_x
+
+            # degenerate points can not be localized; give up on them
+            degenerate = np.logical_not(np.isfinite(det)) | (det == 0)
+            keep = np.logical_not(done | degenerate)
+            if not np.all(keep):
+                active = active[keep]
+                x, y = x[keep], y[keep]
+                r_col, r_row = r_col[keep], r_row[keep]
+                j_col_x, j_col_y, j_row_x, j_row_y = j_col_x[keep], j_col_y[keep], j_row_x[keep], j_row_y[keep]
+                det = det[keep]
+
+            # solve the 2*2 linear system
+            lat[active] = x + (j_row_y * r_col - j_col_y * r_row) / det
+            lon[active] = y + (j_col_x * r_row - j_row_x * r_col) / det
+            n_iter[active] += 1
+
+        n_failed = point_cnt - np.sum(converged)
+        if n_failed > 0:
+            logging.warning('inverse projection: {} / {} points did not converge'.format(n_failed, point_cnt))
+
+        lat = lat.astype(np.float64)
+        lon = lon.astype(np.float64)
         if return_normalized:
-           return lon, lat, cAlt
+            result = (lon, lat, cAlt.astype(np.float64))
+        else:
+            # else denormalize and return
+            result = (lon * self.lonScale + self.lonOff, lat * self.latScale + self.latOff, alt)
+
+        if return_info:
+            return result + (converged, n_iter)
+        return result
+
+    def to_meta_dict(self):
+        rpc_dict = {}
+        for name in ['rowOff', 'rowScale', 'colOff', 'colScale', 'latOff', 'latScale',
+                     'lonOff', 'lonScale', 'altOff', 'altScale']:
+            rpc_dict[name] = float(getattr(self, name))
+        for name in ['rowNum', 'rowDen', 'colNum', 'colDen']:
+            rpc_dict[name] = [float(x) for x in getattr(self, name)]
+        return {'rpc': rpc_dict, 'width': int(self.width), 'height': int(self.height)}
+
+    def transform(self, A, width, height, alt_range=None, grid_size=(20, 20, 10)):
+        """
+        Composes the camera with an image-space affine transform.
+
+        Crops and scalings are composed exactly; other transforms (e.g. rotations)
+        can not be expressed by the same rational polynoms, so a new rpc is fitted
+        on a ground grid that covers the transformed image.
+
+        Args:
+            A: 2*3 matrix mapping [col, row, 1] of this image to the new image
+            width, height: size of the new image
+            alt_range: (alt_min, alt_max) of the ground grid used for re-fitting;
+                defaults to the altitude range of the rpc
+            grid_size: number of (col, row, alt) samples used for re-fitting
 
-        # else denormalize and return
-        lon = lon*self.lonScale + self.lonOff
-        lat = lat*self.latScale + self.latOff
-        return lon, lat, alt
+        Returns:
+            the new RPCModel, and the max re-fitting residual in pixels (0 if exact)
+        """
+        A = np.asarray(A, dtype=np.float64).reshape((2, 3))
+        meta_dict = self.to_meta_dict()
+        meta_dict['width'] = int(width)
+        meta_dict['height'] = int(height)
+
+        if A[0, 1] == 0 and A[1, 0] == 0:
+            # col' = a * col + b, where col = cCol * colScale + colOff
+            rpc_dict = meta_dict['rpc']
+            rpc_dict['colScale'] = float(A[0, 0] * self.colScale)
+            rpc_dict['colOff'] = float(A[0, 0] * self.colOff + A[0, 2])
+            rpc_dict['rowScale'] = float(A[1, 1] * self.rowScale)
+            rpc_dict['rowOff'] = float(A[1, 1] * self.rowOff + A[1, 2])
+            return RPCModel(meta_dict), 0.
+
+        if alt_range is None:
+            alt_range = (self.altOff - self.altScale, self.altOff + self.altScale)
+
+        # sample the new image, and localize the samples through the current camera
+        new_col, new_row, alt = np.meshgrid(np.linspace(0, width - 1, grid_size[0]),
+                                            np.linspace(0, height - 1, grid_size[1]),
+                                            np.linspace(alt_range[0], alt_range[1], grid_size[2]),
+                                            indexing='ij')
+        new_col, new_row, alt = new_col.reshape((-1,)), new_row.reshape((-1,)), alt.reshape((-1,))
+        A_inv = np.linalg.inv(np.vstack((A, [0., 0., 1.])))
+        col = A_inv[0, 0] * new_col + A_inv[0, 1] * new_row + A_inv[0, 2]
+        row = A_inv[1, 0] * new_col + A_inv[1, 1] * new_row + A_inv[1, 2]
+        lon, lat, alt = self.inverse_projection(col, row, alt)
+
+        rpc_dict, residual = fit_rpc(lat, lon, alt, new_col, new_row)
+        logging.info('re-fitted rpc, max residual (pixels): {}'.format(residual))
+        meta_dict['rpc'] = rpc_dict
+        return RPCModel(meta_dict), residual
+
+    def crop(self, ul_col, ul_row, width, height):
+        return self.transform([[1., 0., -ul_col], [0., 1., -ul_row]], width, height)[0]
+
+    def scale(self, factor):
+        """
+        Camera of the image downsampled by factor, e.g. 2 or 4; pixel (0, 0) of the
+        new image covers pixels [0, factor) * [0, factor) of this one.
+        """
+        offset = 0.5 / factor - 0.5
+        width = int(np.round(self.width / factor))
+        height = int(np.round(self.height / factor))
+        return self.transform([[1. / factor, 0., offset], [0., 1. / factor, offset]], width, height)[0]
 
     def __repr__(self):
         return '''        
@@ -283,11 +707,121 @@ class RPCModel(object):
             altScale=self.altScale)
 
 
-if __name__ == '__main__':
-    from lib.parse_meta import parse_meta
-    meta_dict = parse_meta('/data2/kz298/dataset/core3d/performer_source_data/jacksonville/satellite_imagery/WV3/PAN/cleaned_data/17APR22163213-P1BS-501504472100_01_P004.XML')
-    rpc_model = RPCModel(meta_dict['rpc'])
+class RPCModelBatch(object):
+    """
+    Stacks the RPC models of several images, so that a set of ground points
+    can be projected into all of them with a single matrix product.
+
+    The 20 monomials are computed once per point in a frame shared by all the
+    images; each image's polynoms are re-expressed in that frame.
+    """
+    def __init__(self, rpc_models, chunk_size=16384):
+        self.rpc_models = list(rpc_models)
+        self.cnt = len(self.rpc_models)
+        self.chunk_size = chunk_size
+
+        def stack(attr):
+            return np.array([getattr(x, attr) for x in self.rpc_models], dtype=np.float64)
+
+        # (N, 4, 20) coefficients: colNum, colDen, rowNum, rowDen
+        self.polys = np.stack((stack('colNum'), stack('colDen'), stack('rowNum'), stack('rowDen')), axis=1)
+
+        # normalization constants; the order (lat, lon, alt) matches (x, y, z) of the polynoms
+        self.ground_off = np.stack((stack('latOff'), stack('lonOff'), stack('altOff')), axis=1)
+        self.ground_scale = np.stack((stack('latScale'), stack('lonScale'), stack('altScale')), axis=1)
+
+        self.colOff = stack('colOff')
+        self.colScale = stack('colScale')
+        self.rowOff = stack('rowOff')
+        self.rowScale = stack('rowScale')
+
+        self.width = stack('width')
+        self.height = stack('height')
+
+    def shared_polys(self, center):
+        """
+        Args:
+            center: (lat, lon, alt) origin of the shared frame
+
+        Returns:
+            (20, 4N) coefficient matrix in the shared frame, and the frame's scale
+        """
+        center = np.asarray(center, dtype=np.float64).reshape((1, 3))
+        shared_scale = np.mean(self.ground_scale, axis=0, keepdims=True)
+
+        # image normalized coordinate = shared normalized coordinate * scale + offset
+        scale = shared_scale / self.ground_scale
+        offset = (center - self.ground_off) / self.ground_scale
+        polys = substitute_polys(self.polys, scale, offset)
+
+        return polys.reshape((self.cnt * 4, 20)).T, shared_scale[0]
+
+    def projection(self, lat, lon, alt):
+        """
+        Args:
+            lat, lon, alt: numpy arrays of same size (M points)
+
+        Returns:
+            col, row: (M, N) arrays; column n holds the projection into the n-th image
+        """
+        lat = np.asarray(lat, dtype=np.float64).reshape((-1,))
+        lon = np.asarray(lon, dtype=np.float64).reshape((-1,))
+        alt = np.asarray(alt, dtype=np.float64).reshape((-1,))
+        point_cnt = lat.size
+
+        col = np.empty((point_cnt, self.cnt))
+        row = np.empty((point_cnt, self.cnt))
+        if point_cnt == 0:
+            return col, row
+
+        # center the shared frame on the query points to keep the re-expressed polynoms well-conditioned
+        center = [(np.min(lat) + np.max(lat)) / 2., (np.min(lon) + np.max(lon)) / 2.,
+                  (np.min(alt) + np.max(alt)) / 2.]
+        coefs, scale = self.shared_polys(center)
+
+        for idx1 in range(0, point_cnt, self.chunk_size):
+            idx2 = min(idx1 + self.chunk_size, point_cnt)
+            basis = cubic_monomials((lat[idx1:idx2] - center[0]) / scale[0],
+                                    (lon[idx1:idx2] - center[1]) / scale[1],
+                                    (alt[idx1:idx2] - center[2]) / scale[2])
+            values = np.dot(basis, coefs).reshape((idx2 - idx1, self.cnt, 4))
+            col[idx1:idx2] = values[:, :, 0] / values[:, :, 1] * self.colScale + self.colOff
+            row[idx1:idx2] = values[:, :, 2] / values[:, :, 3] * self.rowScale + self.rowOff
+
+        return col, row
 
-    import logging
 
-    logging.info(rpc_model)
+def benchmark(point_cnt=10**6):
+    """
+    Compares apply_rfm_pair with the reference apply_rfm, in speed and accuracy.
+    """
+    rng = np.random.RandomState(0)
+    polys = np.zeros((4, 20))
+    polys[:, 1:4] = [[1., 0.02, -0.03], [0., 0., 0.], [0.03, -1., 0.01], [0., 0., 0.]]
+    polys[:, 4:] += rng.randn(4, 16) * 1e-3
+    polys[[1, 3], 0] = 1.
+    polys[[1, 3], 1:] += rng.randn(2, 19) * 1e-4
+    x, y, z = rng.uniform(-1., 1., (3, point_cnt))
+
+    start = time.time()
+    ref_col = apply_rfm(polys[0], polys[1], x, y, z)
+    ref_row = apply_rfm(polys[2], polys[3], x, y, z)
+    ref_time = time.time() - start
+
+    apply_rfm_pair(polys, x[:10], y[:10], z[:10])  # trigger the jit compilation
+    start = time.time()
+    col, row = apply_rfm_pair(polys, x, y, z)
+    fused_time = time.time() - start
+
+    # difference in units in the last place of the output range; values close to 0
+    # are dominated by cancellation in either evaluation order
+    ulp = max(np.max(np.abs(col - ref_col)) / np.spacing(np.max(np.abs(ref_col))),
+              np.max(np.abs(row - ref_row)) / np.spacing(np.max(np.abs(ref_row))))
+    logging.info('{} points, apply_rfm: {:.4f} s, apply_rfm_pair ({}): {:.4f} s, max difference: {} ulp'.format(
+        point_cnt, ref_time, 'numba' if numba is not None else 'numpy', fused_time, ulp))
+    return ref_time, fused_time, ulp
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    benchmark()
@@ -32,6 +32,7 @@
 
 import numpy as np
 import logging
+from lib.normalize_points import normalize_points
 
 
 def solve_affine(xx, yy, zz, col, row, keep_mask=None):
@@ -70,3 +71,59 @@ def solve_affine(xx, yy, zz, col, row, keep_mask=None):
     P = res[0].reshape((2, 4))
 
     return P
+
+
+def solve_affine_batch(xx, yy, zz, col, row, keep_mask=None, chunk_size=16384):
+    """
+    Fits an affine camera per image to points projected into several images, from the
+    4x4 normal matrices of the normalized points instead of the full design matrices.
+    The sums are taken over chunks of chunk_size points, so that the temporaries
+    stay of size (chunk_size, N).
+
+    Args:
+        xx, yy, zz: M points
+        col, row: (M, N) projections of the points into the N images
+        keep_mask: (M, N) boolean mask of the points used for each image
+
+    Returns:
+        (N, 2, 4) array of affine cameras
+    """
+    point_cnt, img_cnt = col.shape
+
+    def chunk_mask(start, end):
+        if keep_mask is None:
+            return np.ones((end - start, img_cnt), dtype=bool)
+        return keep_mask[start:end]
+
+    X, T = normalize_points(xx, yy, zz)
+
+    # normal equations, one 4x4 system per image
+    S = np.zeros((img_cnt, 16))
+    b = np.zeros((img_cnt, 4, 2))
+    for start in range(0, point_cnt, chunk_size):
+        end = min(start + chunk_size, point_cnt)
+        mask = chunk_mask(start, end)
+        c = np.where(mask, col[start:end], 0.)
+        r = np.where(mask, row[start:end], 0.)
+
+        outer = (X[start:end, :, np.newaxis] * X[start:end, np.newaxis, :]).reshape((end - start, 16))
+        S += np.dot(mask.T.astype(np.float64), outer)
+        b += np.stack((np.dot(c.T, X[start:end]), np.dot(r.T, X[start:end])), axis=2)
+    P = np.linalg.solve(S.reshape((img_cnt, 4, 4)), b).transpose((0, 2, 1))
+
+    # residual, using the same points as the fitting
+    err = np.zeros(img_cnt)
+    cnt = np.zeros(img_cnt)
+    for start in range(0, point_cnt, chunk_size):
+        end = min(start + chunk_size, point_cnt)
+        mask = chunk_mask(start, end)
+        sq_err = (np.dot(X[start:end], P[:, 0, :].T) - col[start:end]) ** 2 \
+            + (np.dot(X[start:end], P[:, 1, :].T) - row[start:end]) ** 2
+        err += np.sum(np.where(mask, sq_err, 0.), axis=0)
+        cnt += np.sum(mask, axis=0)
+    err = np.sqrt(err / cnt)
+    for i in range(img_cnt):
+        logging.info('residual error (pixels): {}'.format(err[i]))
+
+    # undo the normalization of the points
+    return np.matmul(P, T)
@@ -33,6 +33,7 @@
 import numpy as np
 from scipy import linalg
 import logging
+from lib.normalize_points import normalize_points
 
 
 def factorize(matrix):
@@ -127,3 +128,100 @@ def solve_perspective(xx, yy, zz, col, row, keep_mask=None):
 
     return r, q, t
 
+
+
+def solve_perspective_batch(xx, yy, zz, col, row, keep_mask=None, chunk_size=16384):
+    """
+    Fits a perspective camera per image to points projected into several images.
+
+    The 12x12 normal matrix A^T A of each image is accumulated directly from
+    weighted sums over the points, without forming A; the coordinates are
+    normalized beforehand (Hartley) to keep the normal matrices well conditioned.
+    The sums are taken over chunks of chunk_size points, so that the temporaries
+    stay of size (chunk_size, N).
+
+    Args:
+        xx, yy, zz: M points
+        col, row: (M, N) projections of the points into the N images
+        keep_mask: (M, N) boolean mask of the points used for each image
+
+    Returns:
+        list of N un-factorized (3, 4) camera matrices
+    """
+    point_cnt, img_cnt = col.shape
+
+    def chunk_mask(start, end):
+        if keep_mask is None:
+            return np.ones((end - start, img_cnt), dtype=bool)
+        return keep_mask[start:end]
+
+    X, T = normalize_points(xx, yy, zz)
+
+    # per-image normalization of the pixels
+    cnt = np.zeros(img_cnt)
+    col_sum = np.zeros(img_cnt)
+    row_sum = np.zeros(img_cnt)
+    for start in range(0, point_cnt, chunk_size):
+        end = min(start + chunk_size, point_cnt)
+        mask = chunk_mask(start, end)
+        cnt += np.sum(mask, axis=0)
+        col_sum += np.sum(np.where(mask, col[start:end], 0.), axis=0)
+        row_sum += np.sum(np.where(mask, row[start:end], 0.), axis=0)
+    col_mean = col_sum / cnt
+    row_mean = row_sum / cnt
+
+    # A^T A = [[S, 0, -Sc], [0, S, -Sr], [-Sc, -Sr, Scr]], S being the sum of w X X^T,
+    # Sc of w c X X^T, Sr of w r X X^T and Scr of w (c^2 + r^2) X X^T;
+    # the sums are taken on the centered pixels, and scaled afterwards
+    S = np.zeros((img_cnt, 16))
+    Sc = np.zeros((img_cnt, 16))
+    Sr = np.zeros((img_cnt, 16))
+    Scr = np.zeros((img_cnt, 16))
+    sq_sum = np.zeros(img_cnt)
+    for start in range(0, point_cnt, chunk_size):
+        end = min(start + chunk_size, point_cnt)
+        mask = chunk_mask(start, end)
+        c = np.where(mask, col[start:end] - col_mean, 0.)
+        r = np.where(mask, row[start:end] - row_mean, 0.)
+        cr = c ** 2 + r ** 2
+        sq_sum += np.sum(cr, axis=0)
+
+        outer = (X[start:end, :, np.newaxis] * X[start:end, np.newaxis, :]).reshape((end - start, 16))
+        S += np.dot(mask.T.astype(np.float64), outer)
+        Sc += np.dot(c.T, outer)
+        Sr += np.dot(r.T, outer)
+        Scr += np.dot(cr.T, outer)
+
+    scale = np.sqrt(2. * cnt / sq_sum)
+    S = S.reshape((img_cnt, 4, 4))
+    Sc = (Sc * scale[:, np.newaxis]).reshape((img_cnt, 4, 4))
+    Sr = (Sr * scale[:, np.newaxis]).reshape((img_cnt, 4, 4))
+    Scr = (Scr * (scale ** 2)[:, np.newaxis]).reshape((img_cnt, 4, 4))
+
+    AtA = np.zeros((img_cnt, 12, 12))
+    AtA[:, 0:4, 0:4] = S
+    AtA[:, 4:8, 4:8] = S
+    AtA[:, 0:4, 8:12] = -Sc
+    AtA[:, 8:12, 0:4] = -Sc
+    AtA[:, 4:8, 8:12] = -Sr
+    AtA[:, 8:12, 4:8] = -Sr
+    AtA[:, 8:12, 8:12] = Scr
+
+    # the eigenvector of the smallest eigenvalue is the smallest right singular vector of A
+    eig_values, eig_vectors = np.linalg.eigh(AtA)
+
+    P_list = []
+    for i in range(img_cnt):
+        singular_values = ''
+        for j in range(12):
+            singular_values += ' {}'.format(np.sqrt(max(eig_values[i, j], 0.)))
+        logging.info('singular values (normalized): {}'.format(singular_values))
+
+        P = eig_vectors[i, :, 0].reshape((3, 4))
+        # undo the normalizations
+        T_pixel_inv = np.array([[1. / scale[i], 0., col_mean[i]],
+                                [0., 1. / scale[i], row_mean[i]],
+                                [0., 0., 1.]])
+        P_list.append(np.dot(np.dot(T_pixel_inv, P), T))
+
+    return P_list
@@ -35,11 +35,77 @@ import imageio
 import os
 
 
-# hdr_img is 16-bit, while ldr_img is 8 bit
-def tone_map(hdr_img, ldr_img):
-    im = imageio.imread(hdr_img).astype(dtype=np.float64)
+# number of pixels processed at once by the histogram and lookup table passes
+CHUNK_SIZE = 1 << 22
+
+GAMMA = 1.0 / 2.2
+
+
+def compute_histogram(im, hist=None):
+    """
+    Accumulates the histogram of an uint8 or uint16 image, chunk by chunk so
+    that np.bincount's int64 copy of the input stays small.
+    """
+    if hist is None:
+        hist = np.zeros(np.iinfo(im.dtype).max + 1, dtype=np.int64)
+    im = im.reshape((-1,))
+    for idx1 in range(0, im.size, CHUNK_SIZE):
+        idx2 = min(idx1 + CHUNK_SIZE, im.size)
+        hist += np.bincount(im[idx1:idx2], minlength=hist.size)
+    return hist
+
+
+def hist_percentile(hist, q):
+    """
+    Same as np.percentile(np.power(im, GAMMA), q) with linear interpolation,
+    computed from the histogram of the integer image.
+    """
+    cdf = np.cumsum(hist)
+    virtual_idx = q / 100.0 * (cdf[-1] - 1)
+    idx = int(np.floor(virtual_idx))
+    t = virtual_idx - idx
+    # the value at sorted position k is the first level whose cumulated count exceeds k
+    a = np.power(float(np.searchsorted(cdf, idx, side='right')), GAMMA)
+    b = np.power(float(np.searchsorted(cdf, min(idx + 1, cdf[-1] - 1), side='right')), GAMMA)
+    # same lerp as numpy
+    if t >= 0.5:
+        return b - (b - a) * (1 - t)
+    return a + (b - a) * t
+
+
+def tone_map_lut(hist):
+    """
+    Returns:
+        uint8 lookup table mapping every input level to its tone mapped value
+    """
+    below_thres = hist_percentile(hist, 0.5)
+    above_thres = hist_percentile(hist, 99.5)
+
+    lut = np.power(np.arange(hist.size, dtype=np.float64), GAMMA)
+    np.clip(lut, below_thres, above_thres, out=lut)
+    if above_thres > below_thres:
+        lut = 255 * (lut - below_thres) / (above_thres - below_thres)
+    else:
+        # constant image
+        lut[:] = 0
+    return lut.astype(dtype=np.uint8)
+
 
-    im = np.power(im, 1.0 / 2.2)  # gamma correction
+def apply_lut(lut, im, out=None):
+    if out is None:
+        out = np.empty(im.shape, dtype=lut.dtype)
+    im_flat = im.reshape((-1,))
+    out_flat = out.reshape((-1,))
+    for idx1 in range(0, im_flat.size, CHUNK_SIZE):
+        idx2 = min(idx1 + CHUNK_SIZE, im_flat.size)
+        np.take(lut, im_flat[idx1:idx2], out=out_flat[idx1:idx2])
+    return out
+
+
+def tone_map_float(hdr_im):
+    im = hdr_im.astype(dtype=np.float64)
+
+    im = np.power(im, GAMMA)  # gamma correction
 
     # cut off the small values
     below_thres = np.percentile(im.reshape((-1, 1)), 0.5)
@@ -49,8 +115,23 @@ def tone_map(hdr_img, ldr_img):
     im[im > above_thres] = above_thres
     im = 255 * (im - below_thres) / (above_thres - below_thres)
 
+    return im.astype(dtype=np.uint8)
+
+
+# hdr_im is a 16-bit array; returns the 8-bit array
+def tone_map_array(hdr_im):
+    # integer images go through their histogram and a lookup table; this never builds a float copy
+    if hdr_im.dtype in (np.uint8, np.uint16):
+        return apply_lut(tone_map_lut(compute_histogram(hdr_im)), hdr_im)
+    return tone_map_float(hdr_im)
+
+
+# hdr_img is 16-bit, while ldr_img is 8 bit
+def tone_map(hdr_img, ldr_img):
+    im = tone_map_array(imageio.imread(hdr_img))
+
     # remove the unneeded one
     if os.path.exists(ldr_img):
         os.remove(ldr_img)
 
-    imageio.imwrite(ldr_img, im.astype(dtype=np.uint8))
+    imageio.imwrite(ldr_img, im)
@@ -30,7 +30,7 @@
 #  ===============================================================================================================
 
 
-from colmap.read_model import read_model
+from colmap.columnar_model import read_columnar_model
 import numpy as np
 from pyquaternion import Quaternion
 import os
@@ -39,13 +39,13 @@ import logging
 
 def robust_depth_range(depth_range):
     for img_name in depth_range:
-        if depth_range[img_name]:
-            tmp = depth_range[img_name]
-            max_val = max(tmp)
-            min_val = min(tmp)
+        if len(depth_range[img_name]) > 0:
+            # same ordering as sorted() for the python floats these used to be
+            tmp = np.sort(depth_range[img_name])
+            max_val = tmp[-1]
+            min_val = tmp[0]
             logging.info('img_name: {}, depth min: {}, max: {}, ratio: {}'.format(img_name, min_val,
                                                                 max_val, max_val / min_val))
-            tmp = sorted(depth_range[img_name])
             cnt = len(tmp)
             min_depth = tmp[int(0.02 * cnt)]
             max_depth = tmp[int(0.98 * cnt)]
@@ -58,7 +58,7 @@ def robust_depth_range(depth_range):
                 min_depth_new = min_depth
                 max_depth_new = max_depth
 
-            depth_range[img_name] = (min_depth_new, max_depth_new)
+            depth_range[img_name] = (float(min_depth_new), float(max_depth_new))
         else:
             depth_range[img_name] = (-1e20, -1e20)
 
@@ -70,88 +70,81 @@ def robust_depth_range(depth_range):
 def reparam_depth(sparse_dir, save_dir, camera_model='perspective'):
     assert (camera_model == 'perspective' or camera_model == 'pinhole')
 
-    colmap_cameras, colmap_images, colmap_points3D = read_model(sparse_dir, ext='.txt')
+    colmap_cameras, colmap_images, colmap_points3D = read_columnar_model(sparse_dir)
+
+    # flatten the tracks into (point, image) observations
+    xyz = colmap_points3D.xyz
+    obs_point = colmap_points3D.observation_points()
+    obs_image = colmap_images.rows(colmap_points3D.image_ids)
+    img_cnt = len(colmap_images)
+    obs_cnt = len(obs_point)
+
+    # per-image 3 by 4 projection matrices
+    proj_mats = np.zeros((img_cnt, 3, 4))
+    for i in range(img_cnt):
+        qvec = colmap_images.qvecs[i]
+        tvec = colmap_images.tvecs[i].reshape((3, 1))
+        R = Quaternion(qvec[0], qvec[1], qvec[2], qvec[3]).rotation_matrix
+
+        cam_id = colmap_images.camera_ids[i]
+        if camera_model == 'pinhole':
+            fx, fy, cx, cy = colmap_cameras[cam_id].params
+            K = np.array([[fx, 0., cx],
+                          [0., fy, cy],
+                          [0., 0., 1.]])
+        else:
+            fx, fy, cx, cy, s = colmap_cameras[cam_id].params
+            K = np.array([[fx, s, cx],
+                          [0., fy, cy],
+                          [0., 0., 1.]])
+
+        proj_mats[i] = np.dot(K, np.hstack((R, tvec)))
+
+    # group the observations by image; the stable sort keeps the track order within each image
+    order = np.argsort(obs_image, kind='stable')
+    bounds = np.searchsorted(obs_image[order], np.arange(img_cnt + 1))
+    # the last row of K is [0, 0, 1], so the third row of K[R, t] is the depth
+    depth = np.einsum('ij,ij->i', xyz[obs_point], proj_mats[obs_image, 2, :3]) + proj_mats[obs_image, 2, 3]
 
     depth_range = {}
-    for img_id in colmap_images:
-        img_name = colmap_images[img_id].name
-        depth_range[img_name] = []
-
-    z_values = []
-    for point3D_id in colmap_points3D:
-        point3D = colmap_points3D[point3D_id]
-        x = point3D.xyz.reshape((3, 1))
-        z_values.append(x[2, 0])
-        for img_id in point3D.image_ids:
-            img_name = colmap_images[img_id].name
-            qvec = colmap_images[img_id].qvec
-            tvec = colmap_images[img_id].tvec.reshape((3, 1))
-            R = Quaternion(qvec[0], qvec[1], qvec[2], qvec[3]).rotation_matrix
-            x1 = np.dot(R, x) + tvec  # do not change x
-            depth = x1[2, 0]
-            if depth > 0:
-                depth_range[img_name].append(depth)
+    for i in range(img_cnt):
+        tmp = depth[order[bounds[i]:bounds[i + 1]]]
+        depth_range[colmap_images.names[i]] = tmp[tmp > 0]
 
     depth_range = robust_depth_range(depth_range)
 
     # protective margin 20 meters
     margin = 20.0
-    min_z_value = np.percentile(z_values, 1) - margin
+    min_z_value = np.percentile(xyz[:, 2], 1) - margin
     logging.info('min_z_value: {}'.format(min_z_value))
-    z_values = None
 
     # reparametrize depth
     last_row = np.array([0., 0., 1., -min_z_value]).reshape((1, 4))
     last_rows = {}
 
+    # the fourth row of each 4 by 4 projection matrix is depth_min * last_row
+    depth_min = np.array([depth_range[colmap_images.names[i]][0] for i in range(img_cnt)])
+    for i in range(img_cnt):
+        if bounds[i + 1] > bounds[i]:
+            last_rows[colmap_images.names[i]] = depth_min[i] * last_row
+    # last two rows of the 4 by 4 projection matrix of each observation
+    P_rows = np.concatenate((proj_mats[obs_image, 2:3, :],
+                             depth_min[obs_image, np.newaxis, np.newaxis] * last_row), axis=1)
+    x1 = np.hstack((xyz[obs_point], np.ones((obs_cnt, 1))))
+    tmp = np.einsum('ij,ikj->ik', x1, P_rows)
+    # depth is the fourth component, instead of its inverse
+    reparam = tmp[:, 1] / tmp[:, 0]
+
     reparam_depth_range = {}
-    for img_id in colmap_images:
-        img_name = colmap_images[img_id].name
-        reparam_depth_range[img_name] = []
-
-    common_reparam_depth_range = []
-
-    for point3D_id in colmap_points3D:
-        point3D = colmap_points3D[point3D_id]
-        x = point3D.xyz.reshape((3, 1))
-        depth = 0
-        for img_id in point3D.image_ids:
-            img_name = colmap_images[img_id].name
-            qvec = colmap_images[img_id].qvec
-            tvec = colmap_images[img_id].tvec.reshape((3, 1))
-            R = Quaternion(qvec[0], qvec[1], qvec[2], qvec[3]).rotation_matrix
-
-            cam_id = colmap_images[img_id].camera_id
-            if camera_model == 'pinhole':
-                fx, fy, cx, cy = colmap_cameras[cam_id].params
-                K = np.array([[fx, 0., cx],
-                              [0., fy, cy],
-                              [0., 0., 1.]])
-            else:
-                fx, fy, cx, cy, s = colmap_cameras[cam_id].params
-                K = np.array([[fx, s, cx],
-                              [0., fy, cy],
-                              [0., 0., 1.]])
-
-            P_3by4 = np.dot(K, np.hstack((R, tvec)))
-
-            depth_min = depth_range[img_name][0]
-            # depth_max = depth_range[img_name][1]
-            # logging.info('depth_min: {}, depth_max: {}, ratio: {}'.format(depth_min, depth_max, depth_max / depth_min))
-            P_4by4 = np.vstack((P_3by4, depth_min * last_row))
-
-            if img_name not in last_rows:
-                last_rows[img_name] = depth_min * last_row
-
-            x1 = np.vstack((x, np.array([[1.,]])))
-            tmp = np.dot(P_4by4, x1)
-            # depth is the fourth component, instead of its inverse
-            depth = tmp[3, 0] / tmp[2, 0]
-            if depth > 0:
-                reparam_depth_range[img_name].append(depth)
-
-        if depth > 0:
-            common_reparam_depth_range.append(depth)
+    for i in range(img_cnt):
+        tmp = reparam[order[bounds[i]:bounds[i + 1]]]
+        reparam_depth_range[colmap_images.names[i]] = tmp[tmp > 0]
+
+    # each point contributes the reparametrized depth of its last observation
+    is_last = np.ones(obs_cnt, dtype=bool)
+    is_last[:-1] = obs_point[1:] != obs_point[:-1]
+    common_reparam_depth_range = reparam[is_last]
+    common_reparam_depth_range = common_reparam_depth_range[common_reparam_depth_range > 0]
 
     reparam_depth_range = robust_depth_range(reparam_depth_range)
 
@@ -176,7 +169,7 @@ def reparam_depth(sparse_dir, save_dir, camera_model='perspective'):
     with open(os.path.join(save_dir, 'reference_plane.txt'), 'w') as fp:
         fp.write('{} {} {} {}\n'.format(last_row[0, 0], last_row[0, 1], last_row[0, 2], last_row[0, 3]))
 
-    common_reparam_depth_range = sorted(common_reparam_depth_range)
+    common_reparam_depth_range = np.sort(common_reparam_depth_range)
     cnt = len(common_reparam_depth_range)
     lower_stretch = 10
     upper_stretch = 100.
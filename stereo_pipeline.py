@@ -35,6 +35,7 @@ import json
 from clean_data import clean_data
 from image_crop import image_crop
 from camera_approx import CameraApprox
+from lib.rpc_grid import build_rpc_grids
 import colmap_sfm_perspective
 import shutil
 import logging
@@ -236,16 +237,19 @@ class StereoPipeline(object):
         local_timer = Timer('Data cleaning Module')
         local_timer.start()
 
-        # clean data
+        # clean data; cleaned_data_dir is kept between runs, and only new or changed items are processed
         cleaned_data_dir = os.path.join(work_dir, 'cleaned_data')
-        if os.path.exists(cleaned_data_dir):  # remove cleaned_data_dir
-            shutil.rmtree(cleaned_data_dir)
-        os.mkdir(cleaned_data_dir)
+        if not os.path.exists(cleaned_data_dir):
+            os.mkdir(cleaned_data_dir)
+
+        max_processes = -1
+        if 'clean_data_max_processes' in self.config:
+            max_processes = self.config['clean_data_max_processes']
 
         # check if dataset_dir is a list or tuple
         if not (isinstance(dataset_dir, list) or isinstance(dataset_dir, tuple)):
             dataset_dir = [dataset_dir, ]
-        clean_data(dataset_dir, cleaned_data_dir)
+        clean_data(dataset_dir, cleaned_data_dir, max_processes=max_processes)
 
         # stop local timer
         local_timer.mark('Data cleaning done')
@@ -263,7 +267,20 @@ class StereoPipeline(object):
         local_timer.start()
 
         # crop image and tone map
-        image_crop(work_dir)
+        meta_index_file = None
+        if 'meta_index_file' in self.config:
+            meta_index_file = self.config['meta_index_file']
+        # crops larger than crop_tile_size x crop_tile_size pixels are tone mapped tile by tile,
+        # and written to the png one strip of crop_tile_size rows at a time
+        tile_size = None
+        if 'crop_tile_size' in self.config:
+            tile_size = self.config['crop_tile_size']
+        image_crop(work_dir, meta_index_file=meta_index_file, tile_size=tile_size)
+
+        # optional lookup tables of the forward and inverse rpc of the cropped images over the AOI,
+        # saved under rpc_grids/ for the later stages, e.g. "rpc_grid_size": [21, 21, 11]
+        if 'rpc_grid_size' in self.config:
+            build_rpc_grids(work_dir, tuple(self.config['rpc_grid_size']))
 
         # stop local timer
         local_timer.mark('image cropping done')
@@ -283,8 +300,26 @@ class StereoPipeline(object):
         # derive approximations for later uses
         appr = CameraApprox(work_dir)
 
-        appr.approx_affine_latlonalt()
-        appr.approx_perspective_enu()
+        # optional coarse-to-fine grid levels, e.g. [[10, 4], [20, 6], [40, 10], [70, 15], [100, 20]];
+        # the errors of all the images, and the affine approximation, then use the finest level fitted,
+        # or the grid given by approx_check_grid, e.g. [100, 20]
+        adaptive_levels = None
+        if 'approx_grid_levels' in self.config:
+            adaptive_levels = [tuple(x) for x in self.config['approx_grid_levels']]
+        check_grid = None
+        if 'approx_check_grid' in self.config:
+            check_grid = tuple(self.config['approx_check_grid'])
+        check_grid = appr.approx_perspective_enu(adaptive_levels=adaptive_levels, check_grid=check_grid)
+
+        appr.approx_affine_latlonalt(*check_grid)
+
+        # optional piecewise approximation, e.g. "approx_tiles": [2, 2]
+        if 'approx_tiles' in self.config:
+            tile_rows, tile_cols = self.config['approx_tiles']
+            overlap = 0.1
+            if 'approx_tile_overlap' in self.config:
+                overlap = self.config['approx_tile_overlap']
+            appr.approx_perspective_enu_tiled(tile_rows, tile_cols, overlap=overlap)
 
         # stop local timer
         local_timer.mark('Derive approximation done')
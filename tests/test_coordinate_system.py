@@ -0,0 +1,146 @@
+#  ===============================================================================================================
+#  Copyright (c) 2019, Cornell University. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without modification, are permitted provided that
+#  the following conditions are met:
+#
+#      * Redistributions of source code must retain the above copyright otice, this list of conditions and
+#        the following disclaimer.
+#
+#      * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and
+#        the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#      * Neither the name of Cornell University nor the names of its contributors may be used to endorse or
+#        promote products derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+#  WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+#  OF SUCH DAMAGE.
+#
+#  Author: Kai Zhang (kz298@cornell.edu)
+#
+#  The research is based upon work supported by the Office of the Director of National Intelligence (ODNI),
+#  Intelligence Advanced Research Projects Activity (IARPA), via DOI/IBC Contract Number D17PC00287.
+#  The U.S. Government is authorized to reproduce and distribute copies of this work for Governmental purposes.
+#  ===============================================================================================================
+
+
+
+import unittest
+import numpy as np
+from coordinate_system import geodetic_to_ecef, ecef_to_geodetic, LocalFrame
+
+try:
+    import pymap3d
+except ImportError:
+    pymap3d = None
+
+DEG_TOL = 1e-9      # degrees
+METER_TOL = 1e-6    # meters
+
+
+def lon_difference(lon, lon_ref, lat):
+    # longitude error as an angle on the parallel, so that it vanishes at the poles where lon is undefined
+    diff = np.abs((lon - lon_ref + 180.) % 360. - 180.)
+    return diff * np.cos(np.radians(lat))
+
+
+def sample_points(rng, point_cnt):
+    """
+    (name, lat, lon, alt) test sets: near the surface, close to and exactly at the poles,
+    and at altitudes up to geostationary orbit
+    """
+    pole_lat = np.concatenate((rng.uniform(89.9, 90., point_cnt // 2), rng.uniform(-90., -89.9, point_cnt // 2)))
+    sets = [('surface', rng.uniform(-90., 90., point_cnt), rng.uniform(-500., 9000., point_cnt)),
+            ('poles', pole_lat, rng.uniform(-500., 9000., point_cnt)),
+            ('exact poles', np.array([90., -90., 90., -90.]), np.array([0., 100., 1e6, 4e7])),
+            ('high altitude', rng.uniform(-90., 90., point_cnt), rng.uniform(1e5, 4e7, point_cnt)),
+            ('high altitude poles', pole_lat, rng.uniform(1e5, 4e7, point_cnt))]
+    return [(name, lat, rng.uniform(-180., 180., lat.size), alt) for name, lat, alt in sets]
+
+
+class TestGeodeticEcef(unittest.TestCase):
+    def setUp(self):
+        self.sets = sample_points(np.random.RandomState(0), 100000)
+
+    def test_round_trip(self):
+        for name, lat, lon, alt in self.sets:
+            lat2, lon2, alt2 = ecef_to_geodetic(*geodetic_to_ecef(lat, lon, alt))
+            self.assertTrue(np.all(np.isfinite(lat2)) and np.all(np.isfinite(alt2)), name)
+            self.assertLessEqual(np.max(np.abs(lat2 - lat)), DEG_TOL, name)
+            self.assertLessEqual(np.max(lon_difference(lon2, lon, lat)), DEG_TOL, name)
+            self.assertLessEqual(np.max(np.abs(alt2 - alt)), METER_TOL, name)
+
+    @unittest.skipIf(pymap3d is None, 'pymap3d is not installed')
+    def test_against_pymap3d(self):
+        for name, lat, lon, alt in self.sets:
+            x, y, z = geodetic_to_ecef(lat, lon, alt)
+            x_ref, y_ref, z_ref = pymap3d.geodetic2ecef(lat, lon, alt)
+            self.assertLessEqual(np.max(np.abs(np.stack((x - x_ref, y - y_ref, z - z_ref)))), METER_TOL, name)
+
+        # pymap3d's own ecef -> geodetic loses accuracy far from the surface, only compare near it
+        name, lat, lon, alt = self.sets[0]
+        x, y, z = geodetic_to_ecef(lat, lon, alt)
+        lat2, lon2, alt2 = ecef_to_geodetic(x, y, z)
+        lat_ref, lon_ref, alt_ref = pymap3d.ecef2geodetic(x, y, z)
+        self.assertLessEqual(np.max(np.abs(lat2 - lat_ref)), DEG_TOL)
+        self.assertLessEqual(np.max(lon_difference(lon2, lon_ref, lat_ref)), DEG_TOL)
+        self.assertLessEqual(np.max(np.abs(alt2 - alt_ref)), METER_TOL)
+
+
+class TestLocalFrame(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        point_cnt = 100000
+        self.e = rng.uniform(-5000., 5000., point_cnt)
+        self.n = rng.uniform(-5000., 5000., point_cnt)
+        self.u = rng.uniform(-100., 500., point_cnt)
+        # AOI-sized frames, including ones at a pole and high above the ellipsoid
+        self.origins = [(-34.448, -58.577, -30.), (30.3, -81.6, 10.), (89.99, 45., 0.), (-90., 0., 2000.),
+                        (10., 120., 7e5)]
+
+    def test_round_trip(self):
+        for origin in self.origins:
+            frame = LocalFrame(*origin)
+            lat, lon, alt = frame.enu_to_geodetic(self.e, self.n, self.u)
+            e, n, u = frame.geodetic_to_enu(lat, lon, alt)
+            diff = np.stack((e - self.e, n - self.n, u - self.u))
+            self.assertLessEqual(np.max(np.abs(diff)), METER_TOL, origin)
+
+    def test_origin(self):
+        for origin in self.origins:
+            frame = LocalFrame(*origin)
+            e, n, u = frame.geodetic_to_enu(*origin)
+            self.assertLessEqual(max(abs(e), abs(n), abs(u)), METER_TOL, origin)
+
+    @unittest.skipIf(pymap3d is None, 'pymap3d is not installed')
+    def test_against_pymap3d(self):
+        for origin in self.origins[:2]:
+            frame = LocalFrame(*origin)
+            lat, lon, alt = frame.enu_to_geodetic(self.e, self.n, self.u)
+            lat_ref, lon_ref, alt_ref = pymap3d.enu2geodetic(self.e, self.n, self.u, *origin)
+            self.assertLessEqual(np.max(np.abs(lat - lat_ref)), DEG_TOL, origin)
+            self.assertLessEqual(np.max(lon_difference(lon, lon_ref, lat_ref)), DEG_TOL, origin)
+            self.assertLessEqual(np.max(np.abs(alt - alt_ref)), METER_TOL, origin)
+
+            e, n, u = frame.geodetic_to_enu(lat_ref, lon_ref, alt_ref)
+            e_ref, n_ref, u_ref = pymap3d.geodetic2enu(lat_ref, lon_ref, alt_ref, *origin)
+            diff = np.stack((e - e_ref, n - n_ref, u - u_ref))
+            self.assertLessEqual(np.max(np.abs(diff)), METER_TOL, origin)
+
+    def test_shapes(self):
+        frame = LocalFrame(*self.origins[0])
+        lat, lon, alt = frame.enu_to_geodetic(self.e[:10].reshape((10, 1)), self.n[:10].reshape((10, 1)),
+                                              self.u[:10].reshape((10, 1)))
+        self.assertEqual(lat.shape, (10, 1))
+        e, n, u = frame.geodetic_to_enu(lat, lon, alt)
+        self.assertEqual(e.shape, (10, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#  ===============================================================================================================
+#  Copyright (c) 2019, Cornell University. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without modification, are permitted provided that
+#  the following conditions are met:
+#
+#      * Redistributions of source code must retain the above copyright otice, this list of conditions and
+#        the following disclaimer.
+#
+#      * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and
+#        the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#      * Neither the name of Cornell University nor the names of its contributors may be used to endorse or
+#        promote products derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+#  WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+#  OF SUCH DAMAGE.
+#
+#  Author: Kai Zhang (kz298@cornell.edu)
+#
+#  The research is based upon work supported by the Office of the Director of National Intelligence (ODNI),
+#  Intelligence Advanced Research Projects Activity (IARPA), via DOI/IBC Contract Number D17PC00287.
+#  The U.S. Government is authorized to reproduce and distribute copies of this work for Governmental purposes.
+#  ===============================================================================================================
+
+
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from lib.rpc_model import RPCModel
+from lib.rpc_grid import RPCGrid, load_or_build_rpc_grid, build_rpc_grids
+from tests.test_rpc_model import synthetic_polys
+
+# interpolation error allowed over the synthetic aoi, in pixels
+MAX_ERR = 0.05
+
+
+def synthetic_meta_dict(seed):
+    polys = synthetic_polys(np.random.RandomState(seed))
+    rpc_dict = {'rowOff': 20000., 'rowScale': 20000., 'colOff': 17500., 'colScale': 17500.,
+                'latOff': 30.3, 'latScale': 0.08, 'lonOff': -81.6, 'lonScale': 0.09,
+                'altOff': 10., 'altScale': 500.,
+                'colNum': list(polys[0]), 'colDen': list(polys[1]),
+                'rowNum': list(polys[2]), 'rowDen': list(polys[3])}
+    return {'rpc': rpc_dict, 'width': 35000, 'height': 40000}
+
+
+class TestRPCGrid(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        aoi_dict = {'lat_min': 30.30, 'lat_max': 30.31, 'lon_min': -81.60, 'lon_max': -81.59,
+                    'alt_min': -20., 'alt_max': 80.}
+        with open(os.path.join(self.work_dir, 'aoi.json'), 'w') as fp:
+            json.dump(aoi_dict, fp)
+        self.meta_dict = synthetic_meta_dict(0)
+        self.rpc = RPCModel(self.meta_dict)
+
+        rng = np.random.RandomState(2)
+        self.lat = rng.uniform(30.30, 30.31, 1000)
+        self.lon = rng.uniform(-81.60, -81.59, 1000)
+        self.alt = rng.uniform(-20., 80., 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_error(self):
+        grid = RPCGrid.from_aoi(self.rpc, self.work_dir)
+        for key in ['mean_proj_err', 'max_proj_err', 'mean_inv_proj_err', 'max_inv_proj_err']:
+            self.assertLess(grid.error[key], MAX_ERR)
+
+        col, row = self.rpc.projection(self.lat, self.lon, self.alt)
+        esti_col, esti_row = grid.projection(self.lat, self.lon, self.alt)
+        self.assertLess(np.max(np.hypot(esti_col - col, esti_row - row)), MAX_ERR)
+
+        # localize through the grid, and re-project through the exact model
+        lon, lat, alt = grid.inverse_projection(col, row, self.alt)
+        esti_col, esti_row = self.rpc.projection(lat, lon, alt)
+        self.assertLess(np.max(np.hypot(esti_col - col, esti_row - row)), MAX_ERR)
+
+    def test_persistence(self):
+        grid = load_or_build_rpc_grid(self.work_dir, '0000_x.png', self.meta_dict)
+        grid_file = os.path.join(self.work_dir, 'rpc_grids', '0000_x.npz')
+        mtime = os.stat(grid_file).st_mtime_ns
+
+        loaded = load_or_build_rpc_grid(self.work_dir, '0000_x.png', self.meta_dict)
+        self.assertEqual(os.stat(grid_file).st_mtime_ns, mtime)
+        self.assertEqual(loaded.error, grid.error)
+        np.testing.assert_array_equal(loaded.lat_table, grid.lat_table)
+        np.testing.assert_array_equal(loaded.col_table, grid.col_table)
+
+        # another rpc under the same name is rebuilt
+        other = load_or_build_rpc_grid(self.work_dir, '0000_x.png', synthetic_meta_dict(1))
+        self.assertFalse(np.array_equal(other.col_table, grid.col_table))
+
+    def test_build_rpc_grids(self):
+        metas_subdir = os.path.join(self.work_dir, 'metas')
+        os.mkdir(metas_subdir)
+        for i in range(2):
+            with open(os.path.join(metas_subdir, '{:04d}_x.json'.format(i)), 'w') as fp:
+                json.dump(synthetic_meta_dict(i), fp)
+        build_rpc_grids(self.work_dir)
+
+        # grids of images no longer in metas/ are removed
+        os.remove(os.path.join(metas_subdir, '0001_x.json'))
+        grids = build_rpc_grids(self.work_dir)
+        self.assertEqual(list(grids.keys()), ['0000_x.png'])
+        self.assertEqual(os.listdir(os.path.join(self.work_dir, 'rpc_grids')), ['0000_x.npz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#  ===============================================================================================================
+#  Copyright (c) 2019, Cornell University. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without modification, are permitted provided that
+#  the following conditions are met:
+#
+#      * Redistributions of source code must retain the above copyright otice, this list of conditions and
+#        the following disclaimer.
+#
+#      * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and
+#        the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#      * Neither the name of Cornell University nor the names of its contributors may be used to endorse or
+#        promote products derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+#  WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+#  OF SUCH DAMAGE.
+#
+#  Author: Kai Zhang (kz298@cornell.edu)
+#
+#  The research is based upon work supported by the Office of the Director of National Intelligence (ODNI),
+#  Intelligence Advanced Research Projects Activity (IARPA), via DOI/IBC Contract Number D17PC00287.
+#  The U.S. Government is authorized to reproduce and distribute copies of this work for Governmental purposes.
+#  ===============================================================================================================
+
+
+
+import unittest
+from unittest import mock
+import numpy as np
+import lib.rpc_model as rpc_model
+from lib.rpc_model import apply_rfm, apply_rfm_pair, RPCModel
+
+# apply_rfm_pair may evaluate the polynoms in another order than apply_rfm;
+# the difference must stay within this many units in the last place of the output range
+# (about 5 ulp is observed with both numba and numpy)
+ULP_BOUND = 16
+
+
+def synthetic_polys(rng):
+    # close to a linear camera, with small higher-order terms and denominators close to 1
+    polys = np.zeros((4, 20))
+    polys[:, 1:4] = [[1., 0.02, -0.03], [0., 0., 0.], [0.03, -1., 0.01], [0., 0., 0.]]
+    polys[:, 4:] += rng.randn(4, 16) * 1e-3
+    polys[[1, 3], 0] = 1.
+    polys[[1, 3], 1:] += rng.randn(2, 19) * 1e-4
+    return polys
+
+
+def ulp_difference(val, ref):
+    return np.max(np.abs(val - ref)) / np.spacing(np.max(np.abs(ref)))
+
+
+class TestApplyRfmPair(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.polys = synthetic_polys(rng)
+        self.x, self.y, self.z = rng.uniform(-1., 1., (3, 10007))
+        self.ref_col = apply_rfm(self.polys[0], self.polys[1], self.x, self.y, self.z)
+        self.ref_row = apply_rfm(self.polys[2], self.polys[3], self.x, self.y, self.z)
+
+    def check(self, col, row):
+        self.assertEqual(col.shape, self.ref_col.shape)
+        self.assertEqual(row.shape, self.ref_row.shape)
+        self.assertLessEqual(ulp_difference(col, self.ref_col), ULP_BOUND)
+        self.assertLessEqual(ulp_difference(row, self.ref_row), ULP_BOUND)
+
+    @unittest.skipIf(rpc_model.numba is None, 'numba is not installed')
+    def test_numba_kernel(self):
+        self.check(*apply_rfm_pair(self.polys, self.x, self.y, self.z))
+
+    def test_numpy_fallback(self):
+        with mock.patch.object(rpc_model, 'numba', None):
+            # one chunk, and chunks that do not divide the number of points
+            for chunk_size in [65536, 1000, 97, 1]:
+                self.check(*apply_rfm_pair(self.polys, self.x, self.y, self.z, chunk_size=chunk_size))
+
+    def test_output_buffers(self):
+        out_col = np.empty(self.x.shape)
+        out_row = np.empty(self.x.shape)
+        col, row = apply_rfm_pair(self.polys, self.x, self.y, self.z, out_col, out_row)
+        self.assertIs(col, out_col)
+        self.assertIs(row, out_row)
+        self.check(col, row)
+
+
+class TestProjection(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        polys = synthetic_polys(rng)
+        rpc_dict = {'rowOff': 20000., 'rowScale': 20000., 'colOff': 17500., 'colScale': 17500.,
+                    'latOff': 30.3, 'latScale': 0.08, 'lonOff': -81.6, 'lonScale': 0.09,
+                    'altOff': 10., 'altScale': 500.,
+                    'colNum': list(polys[0]), 'colDen': list(polys[1]),
+                    'rowNum': list(polys[2]), 'rowDen': list(polys[3])}
+        self.rpc = RPCModel({'rpc': rpc_dict, 'width': 35000, 'height': 40000})
+
+        point_cnt = 5003
+        self.lat = rng.uniform(30.22, 30.38, point_cnt)
+        self.lon = rng.uniform(-81.69, -81.51, point_cnt)
+        self.alt = rng.uniform(-490., 510., point_cnt)
+
+        # the original evaluation: normalize, apply_rfm on each polynom pair, denormalize
+        cLat = (self.lat - self.rpc.latOff) / self.rpc.latScale
+        cLon = (self.lon - self.rpc.lonOff) / self.rpc.lonScale
+        cAlt = (self.alt - self.rpc.altOff) / self.rpc.altScale
+        self.ref_col = apply_rfm(polys[0], polys[1], cLat, cLon, cAlt) * self.rpc.colScale + self.rpc.colOff
+        self.ref_row = apply_rfm(polys[2], polys[3], cLat, cLon, cAlt) * self.rpc.rowScale + self.rpc.rowOff
+
+    def check(self, chunk_size):
+        col, row = self.rpc.projection(self.lat, self.lon, self.alt, chunk_size=chunk_size)
+        self.assertLessEqual(ulp_difference(col, self.ref_col), ULP_BOUND)
+        self.assertLessEqual(ulp_difference(row, self.ref_row), ULP_BOUND)
+
+    def test_chunks(self):
+        for chunk_size in [1048576, 1000, 7]:
+            self.check(chunk_size)
+
+    def test_chunks_numpy_fallback(self):
+        with mock.patch.object(rpc_model, 'numba', None):
+            for chunk_size in [1048576, 1000, 7]:
+                self.check(chunk_size)
+
+    def test_shapes(self):
+        col, row = self.rpc.projection(self.lat[:12].reshape((3, 4)), self.lon[:12].reshape((3, 4)),
+                                       self.alt[:12].reshape((3, 4)), chunk_size=5)
+        self.assertEqual(col.shape, (3, 4))
+        np.testing.assert_array_equal(col.ravel(), self.rpc.projection(self.lat[:12], self.lon[:12],
+                                                                       self.alt[:12])[0])
+
+        col, row = self.rpc.projection(self.lat[0], self.lon[0], self.alt[0])
+        self.assertTrue(np.isscalar(col) and np.isscalar(row))
+        self.assertLessEqual(abs(col - self.ref_col[0]), ULP_BOUND * np.spacing(np.max(np.abs(self.ref_col))))
+
+
+if __name__ == '__main__':
+    unittest.main()